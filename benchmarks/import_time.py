@@ -0,0 +1,81 @@
+"""
+Import-time benchmark for pylomap.
+
+Measures how long `import pylomap` takes in a fresh interpreter, compared with importing pandas
+alone, and checks that none of the slow plotting, clustering or file format libraries are
+imported with the module (beyond those pandas itself imports). It exits with status 1 if either check fails, so it can guard against
+regressions in CI.
+
+Usage:
+    python benchmarks/import_time.py [--repeats 5] [--budget 0.3]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Libraries that pylomap must only import when the code that needs them runs
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'skbio', 'scipy', 'openpyxl', 'tqdm', 'h5py', 'pyarrow']
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': sorted(sys.modules)}}))
+"""
+
+
+def time_import(module, repeats):
+    """
+    Imports a module in fresh interpreters and returns the fastest time and the modules loaded.
+
+    Args:
+    module (str): The name of the module to import.
+    repeats (int): The number of interpreters to time.
+
+    Returns:
+    tuple: The fastest import time in seconds, and the names of the modules loaded by that import.
+    """
+    best, modules = None, None
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', MEASURE.format(module=module)], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best:
+            best, modules = result['seconds'], result['modules']
+    return best, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5, help='number of fresh interpreters to time')
+    parser.add_argument('--budget', type=float, default=0.3,
+                        help='seconds that importing pylomap may take on top of importing pandas')
+    args = parser.parse_args()
+
+    pandas_seconds, pandas_modules = time_import('pandas', args.repeats)
+    pylomap_seconds, modules = time_import('pylomap', args.repeats)
+    # pandas may pull in some of these itself (e.g. pyarrow), which pylomap cannot avoid
+    added = {name.split('.')[0] for name in set(modules) - set(pandas_modules)}
+    heavy = sorted(added & set(HEAVY_MODULES))
+    overhead = pylomap_seconds - pandas_seconds
+
+    report = {'pandas_seconds': round(pandas_seconds, 4), 'pylomap_seconds': round(pylomap_seconds, 4),
+              'overhead_seconds': round(overhead, 4), 'budget_seconds': args.budget, 'heavy_modules': heavy}
+    print(json.dumps(report, indent=2))
+
+    if heavy:
+        print(f'FAIL: importing pylomap also imports {", ".join(heavy)}', file=sys.stderr)
+        sys.exit(1)
+    if overhead > args.budget:
+        print(f'FAIL: importing pylomap takes {overhead:.3f}s more than pandas (budget {args.budget}s)',
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
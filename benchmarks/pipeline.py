@@ -0,0 +1,213 @@
+"""
+Per-stage benchmark of the pylomap pipeline on synthetic data.
+
+Generates input files with benchmarks/synthetic.py (or reuses those generated by an earlier run with the
+same sizes), then runs each stage of the pipeline in turn and records its wall time and the peak memory
+it allocates. The results are printed, or written with --output, as JSON, so that runs at different
+sizes or on different versions can be compared.
+
+Each stage is timed --repeats times and the fastest time reported. Its peak memory is measured by a
+separate run under tracemalloc, which slows the code down and so is never timed.
+
+Usage:
+    python benchmarks/pipeline.py [--preset small] [--taxa N] [--samples N] [--parent-rows N] [--output FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import pylomap  # noqa: E402
+import synthetic  # noqa: E402
+
+# Sizes as (taxa, samples, Parent rows, pathways)
+PRESETS = {
+    'small': (100, 10, 10000, 200),
+    'medium': (5000, 200, 500000, 2000),
+    'large': (20000, 1000, 2000000, 5000),
+    'xlarge': (100000, 5000, 5000000, 10000),
+}
+
+# The stages that read all four files with get_data, and the value of its parallel argument in each
+GET_DATA_STAGES = {'get_data': None, 'get_data_threads': 'threads', 'get_data_processes': 'processes'}
+
+STAGES = list(GET_DATA_STAGES) + ['read_all_sample_data', 'read_taxon_dict', 'read_function_dict', 'read_parent',
+                                   'read_parent_index', 'create_samples', 'create_microbes', 'create_pathways',
+                                   'process_heatmap_data', 'process_heatmap_data_grouped', 'clustering', 'rendering']
+
+
+def measure(function, repeats):
+    """
+    Runs a function repeats times, then once more under tracemalloc.
+
+    Args:
+    function (callable): The stage to measure, called without arguments.
+    repeats (int): The number of timed runs.
+
+    Returns:
+    tuple: The result of the last run, the fastest time in seconds, and the peak memory in bytes.
+    """
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(seconds), peak_bytes
+
+
+def run_stages(paths, stages, repeats, threshold, taxon_level, output_dir):
+    """
+    Runs the pipeline on a set of input files, measuring each of the chosen stages.
+
+    Stages that are not chosen still run (untimed) when a later stage needs their result.
+
+    Args:
+    paths (dict): The input files, as returned by synthetic.generate.
+    stages (list): The names of the stages to measure, from STAGES.
+    repeats (int): The number of timed runs of each stage.
+    threshold (float): The percentage threshold used by the clustering and rendering stages.
+    taxon_level (str): The level that the process_heatmap_data_grouped stage groups by.
+    output_dir (str): The directory the rendering stage saves its figure to.
+
+    Returns:
+    list: One dictionary per measured stage, with its 'stage', 'seconds' and 'peak_bytes'. When the get_data stage
+          is measured, the records of get_data_threads and get_data_processes also give their 'speedup' over it.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    reader = pylomap.ReadDataFiles(paths['all_sample_data'], paths['taxon_dict'], paths['function_dict'],
+                                   paths['parent'])
+    results = {}
+    records = []
+
+    def run(stage, function):
+        if stage in stages:
+            results[stage], seconds, peak_bytes = measure(function, repeats)
+            records.append({'stage': stage, 'seconds': seconds, 'peak_bytes': peak_bytes})
+            print(f'{stage}: {seconds:.3f}s, {peak_bytes / 1024 ** 2:.1f} MiB', file=sys.stderr)
+        else:
+            results[stage] = function()
+        return results[stage]
+
+    def render():
+        # A few pathways, as a figure has a column of colours for each
+        user_pathways = pylomap.PathwaySearchIndex(function_dict).search('sulf')[:5]
+        heatmap_plot = pylomap.HeatmapPlot(heatmap_data, all_pathways, function_dict)
+        g = heatmap_plot.heatmap_plot(user_pathways, threshold, taxon_dict, show=False)
+        g.savefig(os.path.join(output_dir, 'heatmap.png'))
+        plt.close(g.fig)
+
+    # Read the four files one after another, then at the same time, for comparison
+    for stage, parallel in GET_DATA_STAGES.items():
+        if stage in stages:
+            run(stage, lambda parallel=parallel: pylomap.get_data(
+                paths['all_sample_data'], paths['taxon_dict'], paths['function_dict'], paths['parent'],
+                parallel=parallel))
+    sequential = next((record['seconds'] for record in records if record['stage'] == 'get_data'), None)
+    for record in records:
+        if sequential is not None and record['stage'] in ('get_data_threads', 'get_data_processes'):
+            record['speedup'] = sequential / record['seconds']
+
+    all_sample_data = run('read_all_sample_data', reader.read_all_sample_data)
+    taxon_dict = run('read_taxon_dict', reader.read_taxon_dict)
+    function_dict = run('read_function_dict', reader.read_function_dict)
+    parent = run('read_parent', reader.read_parent)
+    if 'read_parent_index' in stages:
+        run('read_parent_index', reader.read_parent_index)
+    samples = run('create_samples', lambda: pylomap.CreateSamples(all_sample_data, taxon_dict, parent).create())
+    if 'create_microbes' in stages:
+        run('create_microbes', lambda: pylomap.CreateMicrobes(parent).create())
+    all_pathways = run('create_pathways', lambda: pylomap.Pathways(parent).create())
+    heatmap_data = pylomap.HeatmapData(samples)
+    data = run('process_heatmap_data', heatmap_data.process_heatmap_data)
+    if 'process_heatmap_data_grouped' in stages:
+        def group():
+            # The rollups are cached by the matrix, so group a fresh copy of it each time
+            matrix = samples[0].matrix
+            matrix = pylomap.AbundanceMatrix(matrix.taxa, matrix.taxon_ids, matrix.sample_names, matrix.values,
+                                             matrix.taxonomy)
+            return pylomap.HeatmapData(matrix.samples()).process_heatmap_data(taxon_level)
+        run('process_heatmap_data_grouped', group)
+    if 'clustering' in stages:
+        filtered_data = data[(data.drop('Taxa', axis=1) > threshold / 100).any(axis=1)].fillna(0)
+        run('clustering', lambda: pylomap.aitchison_linkage(
+            filtered_data.drop('Taxa', axis=1).values.T, method='complete'))
+    if 'rendering' in stages:
+        run('rendering', render)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=PRESETS, default='small', help='input sizes, default small')
+    parser.add_argument('--taxa', type=int, help='number of taxa, overriding the preset')
+    parser.add_argument('--samples', type=int, help='number of samples, overriding the preset')
+    parser.add_argument('--parent-rows', type=int, help='number of Parent rows, overriding the preset')
+    parser.add_argument('--pathways', type=int, help='number of pathways, overriding the preset')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to measure')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs of each stage')
+    parser.add_argument('--threshold', type=float, default=1, help='percentage threshold for clustering')
+    parser.add_argument('--taxon-level', choices=pylomap.TAXON_LEVELS, default='family',
+                        help='level for the grouped process_heatmap_data stage')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'pylomap-benchmarks'),
+                        help='directory for the generated inputs, which are reused between runs')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of printing them')
+    args = parser.parse_args()
+
+    n_taxa, n_samples, n_parent_rows, n_pathways = PRESETS[args.preset]
+    sizes = {'taxa': args.taxa or n_taxa, 'samples': args.samples or n_samples,
+             'parent_rows': args.parent_rows or n_parent_rows, 'pathways': args.pathways or n_pathways,
+             'seed': args.seed}
+
+    # Inputs are named after their sizes, so that each size is only generated once
+    input_dir = os.path.join(args.data_dir, '_'.join(f'{key}{value}' for key, value in sizes.items()))
+    paths = {key: os.path.join(input_dir, name) for key, name in synthetic.FILE_NAMES.items()}
+    generate_seconds = None
+    if not all(os.path.exists(path) for path in paths.values()):
+        print(f'Generating inputs in {input_dir}', file=sys.stderr)
+        start = time.perf_counter()
+        synthetic.generate(input_dir, sizes['taxa'], sizes['samples'], sizes['parent_rows'], sizes['pathways'],
+                           sizes['seed'])
+        generate_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        records = run_stages(paths, args.stages, args.repeats, args.threshold, args.taxon_level, output_dir)
+
+    report = {
+        'sizes': sizes,
+        'input_bytes': {key: os.path.getsize(path) for key, path in paths.items()},
+        'generate_seconds': generate_seconds,
+        'repeats': args.repeats,
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'stages': records,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
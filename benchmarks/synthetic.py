@@ -0,0 +1,176 @@
+"""
+Synthetic input generator for the pylomap benchmarks.
+
+Writes a sample data file, taxon and function dictionaries and a Parent file, in the layouts read by
+pylomap.ReadDataFiles, for any number of taxa, samples, pathways and Parent rows. The same arguments
+and seed always give the same files. Abundances are generated in blocks of taxa, so memory use does
+not grow with the size of the sample file, but writing Excel files is slow: a sheet of 100,000 taxa
+and 5,000 samples takes hours, and Excel itself cannot open more than 16,384 columns.
+
+Usage:
+    python benchmarks/synthetic.py OUTPUT_DIR [--taxa 1000] [--samples 50] [--parent-rows 100000]
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# File names used by generate(), in the order of pylomap.get_data's arguments
+FILE_NAMES = {'all_sample_data': 'F data.xlsx', 'taxon_dict': 'Taxon Dictionary.xlsx',
+              'function_dict': 'Function Dictionary.xlsx', 'parent': 'FL Parent.csv'}
+
+# The number of taxa generated at a time
+BLOCK_SIZE = 2000
+
+# Words used to build the pathway descriptions, so that searches such as 'sulf' find some pathways
+DESCRIPTION_WORDS = ['sulfur oxidation', 'sulfate reduction', 'nitrogen fixation', 'glucose degradation',
+                     'methanogenesis', 'amino acid biosynthesis', 'fatty acid beta-oxidation', 'TCA cycle']
+
+
+def taxon_ranks(n_taxa):
+    """
+    Builds the six ranks of each taxon, as a nested hierarchy of genera, families, orders, classes,
+    phyla and domains. Every tenth taxon is unresolved at genus level ('__').
+
+    Args:
+    n_taxa (int): The number of taxa.
+
+    Returns:
+    ranks (list): A list of six rank strings per taxon.
+    """
+    ranks = []
+    for i in range(n_taxa):
+        ranks.append([f'd__Domain{i % 2}', f'p__Phylum{i // 2000}', f'c__Class{i // 500}',
+                      f'o__Order{i // 100}', f'f__Family{i // 8}', '__' if i % 10 == 0 else f'g__Genus{i}'])
+    return ranks
+
+
+def abundance_block(seed, n_taxa, n_samples):
+    """
+    Generates the abundances of a block of taxa before they are made relative. Most taxa are absent from
+    most samples, and those present have log-normally distributed abundances.
+    """
+    rng = np.random.default_rng(seed)
+    prevalence = rng.beta(0.5, 2, size=(n_taxa, 1))
+    present = rng.random((n_taxa, n_samples)) < prevalence
+    return np.where(present, rng.lognormal(0, 2, size=(n_taxa, n_samples)), 0)
+
+
+def write_sample_data(path, ranks, n_samples, seed):
+    """
+    Writes the sample data file: a title row, a header of the six ranks and the sample names, and the
+    relative abundance of each taxon in each sample. The seed is a numpy SeedSequence.
+    """
+    import openpyxl
+
+    n_taxa = len(ranks)
+    block_seeds = seed.spawn(-(-n_taxa // BLOCK_SIZE))
+    blocks = [(block_seed, start, min(start + BLOCK_SIZE, n_taxa))
+              for block_seed, start in zip(block_seeds, range(0, n_taxa, BLOCK_SIZE))]
+
+    # Total each sample first, regenerating each block from its seed to write it, so that every
+    # sample sums to one without holding the whole matrix in memory
+    totals = np.zeros(n_samples)
+    for block_seed, start, stop in blocks:
+        totals += abundance_block(block_seed, stop - start, n_samples).sum(axis=0)
+    totals[totals == 0] = 1
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['Relative frequency table'])
+    sheet.append(['Domain', 'Phylum', 'Class', 'Order', 'Family', 'Genus'] +
+                 [f'Sample{j}' for j in range(n_samples)])
+    for block_seed, start, stop in blocks:
+        block = abundance_block(block_seed, stop - start, n_samples) / totals
+        for taxon, row in zip(ranks[start:stop], block.tolist()):
+            sheet.append(taxon + row)
+    workbook.save(path)
+
+
+def write_table(path, title_rows, header, rows):
+    """
+    Writes a sheet of title rows, a header and the given rows to an Excel file.
+    """
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for title_row in title_rows:
+        sheet.append(title_row)
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def write_parent(path, n_rows, n_taxa, n_pathways, seed, chunk_size=1000000):
+    """
+    Writes the Parent file: an index column and one (pathway, taxon ID) association per row. Pathways are
+    drawn with a skewed distribution, so that some are associated with many more taxa than others.
+    """
+    rng = np.random.default_rng(seed)
+    # Pathway popularity follows a power law over a random order of the pathways
+    weights = rng.permutation(1 / np.arange(1, n_pathways + 1))
+    weights /= weights.sum()
+    with open(path, 'w', newline='') as f:
+        f.write(',Pathway,Taxon ID\n')
+        for start in range(0, n_rows, chunk_size):
+            size = min(chunk_size, n_rows - start)
+            pathways = rng.choice(n_pathways, size=size, p=weights)
+            chunk = pd.DataFrame({'Pathway': 'PWY-' + pathways.astype(str).astype(object),
+                                  'Taxon ID': 1000 + rng.integers(0, n_taxa, size=size)},
+                                 index=pd.RangeIndex(start, start + size))
+            chunk.to_csv(f, header=False)
+
+
+def generate(output_dir, n_taxa=1000, n_samples=50, n_parent_rows=100000, n_pathways=2000, seed=0):
+    """
+    Writes a complete set of synthetic input files.
+
+    Args:
+    output_dir (str): The directory to write the files to. It is created if it does not exist.
+    n_taxa (int): The number of taxa. Default is 1000.
+    n_samples (int): The number of samples. Default is 50.
+    n_parent_rows (int): The number of (pathway, taxon) rows in the Parent file. Default is 100000.
+    n_pathways (int): The number of pathways in the function dictionary. Default is 2000.
+    seed (int): The seed of the random data. Default is 0.
+
+    Returns:
+    dict: The paths of the files written, keyed by the names of pylomap.get_data's arguments.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {key: os.path.join(output_dir, name) for key, name in FILE_NAMES.items()}
+    sample_seed, parent_seed = np.random.SeedSequence(seed).spawn(2)
+
+    ranks = taxon_ranks(n_taxa)
+    write_sample_data(paths['all_sample_data'], ranks, n_samples, sample_seed)
+
+    # The taxon strings are built as ReadDataFiles.read_all_sample_data builds them
+    taxa = ['; '.join(rank for rank in taxon if rank != '__') for taxon in ranks]
+    write_table(paths['taxon_dict'], [['Taxon dictionary'], []], ['Taxon ID', 'Taxon'],
+                ([1000 + i, taxon] for i, taxon in enumerate(taxa)))
+    write_table(paths['function_dict'], [['Function dictionary']], ['Pathway', 'Pathway description'],
+                ([f'PWY-{p}', f'{DESCRIPTION_WORDS[p % len(DESCRIPTION_WORDS)]} pathway {p}']
+                 for p in range(n_pathways)))
+    write_parent(paths['parent'], n_parent_rows, n_taxa, n_pathways, parent_seed)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output_dir', help='directory to write the files to')
+    parser.add_argument('--taxa', type=int, default=1000, help='number of taxa')
+    parser.add_argument('--samples', type=int, default=50, help='number of samples')
+    parser.add_argument('--parent-rows', type=int, default=100000, help='number of rows in the Parent file')
+    parser.add_argument('--pathways', type=int, default=2000, help='number of pathways')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random data')
+    args = parser.parse_args()
+
+    for path in generate(args.output_dir, args.taxa, args.samples, args.parent_rows, args.pathways,
+                         args.seed).values():
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
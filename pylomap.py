@@ -1,12 +1,267 @@
-from scipy.spatial.distance import euclidean
-from skbio.stats.composition import clr
-import seaborn as sns
+# Only numpy and pandas are imported with the module. The plotting, clustering and file format
+# libraries are slow to import, so each is imported by the code that needs it, when it first runs.
+import numpy as np
 import pandas as pd
+from pandas.io.parsers import TextParser
 # import modin.pandas as pd
-import matplotlib.pyplot as plt
-from tqdm import tqdm
 import os
-import openpyxl
+import functools
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import multiprocessing
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# Value used in place of zero abundances before taking logarithms in the Aitchison distance
+AITCHISON_ZERO = 0.000000001
+
+# The six taxonomic ranks in the sample data, and the taxon levels they can be grouped by
+TAXON_RANKS = ['Domain', 'Phylum', 'Class', 'Order', 'Family', 'Genus']
+TAXON_LEVELS = ['domain', 'phylum', 'class', 'order', 'family', 'genus']
+
+# Version of the preprocessed data layout stored by IngestCache. Increase it whenever a reader's
+# output changes so that stale cache entries are not reused.
+INGEST_CACHE_VERSION = 2
+
+# Version of the clusterings and figures stored by PlotCache. Increase it whenever either is computed or
+# drawn differently so that stale cache entries are not reused.
+PLOT_CACHE_VERSION = 1
+
+# Job keys that are passed on to HeatmapPlot.heatmap_plot as they are
+HEATMAP_PLOT_OPTIONS = ['bootstrap', 'top_n', 'raster', 'max_pixels']
+
+# Replacements for the characters that LaTeX treats as special, used by LatexTable.write_table
+LATEX_ESCAPES = str.maketrans({'&': r'\&', '%': r'\%', '$': r'\$', '#': r'\#', '_': r'\_', '{': r'\{', '}': r'\}',
+                               '~': r'\textasciitilde{}', '^': r'\textasciicircum{}', '\\': r'\textbackslash{}'})
+
+
+# Functions called with the record of each instrumented stage as it ends. See add_stage_hook.
+_stage_hooks = []
+_stage_hooks_lock = threading.Lock()
+# The stages that are running, on every thread, in the order they started. See StageTimer.
+_open_stages = []
+_open_stages_lock = threading.Lock()
+
+
+def add_stage_hook(hook):
+    """
+    Registers a function to be called with the record of each instrumented stage as it ends.
+
+    The pipeline's stages, from the ReadDataFiles readers to clustering and rendering, are only measured
+    while at least one hook is registered. A record is a dictionary with the 'stage' name, its
+    'wall_seconds' and 'cpu_seconds', the 'peak_rss_bytes' of the process during the stage, an 'error'
+    message if the stage raised an exception (otherwise None), and any fields the stage adds, such as
+    its number of 'rows'.
+
+    Args:
+    hook (callable): A function taking one record, e.g. a JsonLogHook or list.append.
+
+    Returns:
+    hook (callable): The hook, so that this function can be used as a decorator.
+    """
+    with _stage_hooks_lock:
+        if hook not in _stage_hooks:
+            _stage_hooks.append(hook)
+    return hook
+
+
+def remove_stage_hook(hook):
+    """
+    Unregisters a function registered with add_stage_hook. Nothing happens if it is not registered.
+
+    Args:
+    hook (callable): The hook to remove.
+    """
+    with _stage_hooks_lock:
+        if hook in _stage_hooks:
+            _stage_hooks.remove(hook)
+
+
+def stage(name, **fields):
+    """
+    Returns a context manager that measures a stage and passes its record to the registered hooks.
+
+    When no hook is registered, a shared context manager that does nothing is returned, so an
+    instrumented stage costs one function call. Fields known only inside the stage can be added with
+    the update method of the context manager, e.g.
+
+        with stage('read_parent') as timer:
+            parent = ...
+            timer.update(rows=len(parent))
+
+    Args:
+    name (str): The name of the stage.
+    **fields: Fields to add to the record.
+
+    Returns:
+    (StageTimer): The context manager, or one with the same update method that does nothing.
+    """
+    if not _stage_hooks:
+        return _NO_STAGE
+    return StageTimer(name, fields)
+
+
+def staged(name, rows=None):
+    """
+    Decorates a function so that each call is measured as a stage. See stage.
+
+    Args:
+    name (str): The name of the stage.
+    rows (callable, optional): A function that takes the result of the call and returns the number of
+                               rows to record, e.g. len. Default is None, in which case no rows are recorded.
+
+    Returns:
+    (callable): The decorator.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def measured(*args, **kwargs):
+            if not _stage_hooks:
+                return function(*args, **kwargs)
+            with StageTimer(name, {}) as timer:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    timer.update(rows=rows(result))
+            return result
+        return measured
+    return decorate
+
+
+def _read_peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes. On Linux this is the peak since it was
+    last reset by _reset_peak_rss, elsewhere the peak since the process started, or None if unknown.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Bytes on macOS, kilobytes elsewhere
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:  # Not Linux, or not permitted
+        pass
+
+
+class StageTimer:
+    """
+    StageTimer Class.
+
+    A context manager that measures one run of a stage and passes its record to the registered hooks.
+    It is returned by stage().
+
+    Stages may be nested, and may run at the same time in several threads. The peak resident set size
+    is that of the whole process. Where the operating system allows it, the peak is reset when a stage
+    starts, after folding the peak so far into every running stage on every thread, so no stage reports
+    less than the peak reached while it ran. The reset is skipped while a stage is running on another
+    thread, as it would lose that stage's peak. A stage that starts then reports the peak since the last
+    reset, which may have been reached before it started. So stages that run at the same time in several
+    threads each report at least their own peak, but it may include the memory of the others and of the
+    stages that enclose them.
+
+    Attributes
+    ----------
+    record : dict
+        The record of the stage, which is complete once the stage has ended.
+    """
+
+    def __init__(self, name, fields):
+        self.record = {'stage': name, 'wall_seconds': None, 'cpu_seconds': None,
+                       'peak_rss_bytes': None, 'error': None, **fields}
+        self._peak_rss = None
+
+    def update(self, **fields):
+        """
+        Adds fields to the record of the stage.
+        """
+        self.record.update(fields)
+
+    def __enter__(self):
+        self._thread = threading.get_ident()
+        with _open_stages_lock:
+            if _open_stages:
+                # Fold the peak so far into every running stage, on any thread, before it can be reset
+                peak_rss = _read_peak_rss()
+                for running in _open_stages:
+                    running._peak_rss = max(running._peak_rss or 0, peak_rss or 0)
+            # The peak is process-wide, so it is only reset when no stage is running on another thread
+            if all(running._thread == self._thread for running in _open_stages):
+                _reset_peak_rss()
+            _open_stages.append(self)
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record['wall_seconds'] = time.perf_counter() - self._wall_start
+        self.record['cpu_seconds'] = time.process_time() - self._cpu_start
+        with _open_stages_lock:
+            peak_rss = _read_peak_rss()
+            _open_stages.remove(self)
+        if peak_rss is not None:
+            self.record['peak_rss_bytes'] = max(peak_rss, self._peak_rss or 0)
+        if exc_type is not None:
+            self.record['error'] = f'{exc_type.__name__}: {exc_value}'
+        for hook in list(_stage_hooks):
+            hook(self.record)
+        return False
+
+
+class _NoStage:
+    # The context manager returned by stage() when no hook is registered
+
+    def update(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class JsonLogHook:
+    """
+    JsonLogHook Class.
+
+    A stage hook that appends each record to a file as one line of JSON (the JSON Lines format).
+
+    Attributes
+    ----------
+    path : str
+        The path of the log file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
 
 
 class Sample:
@@ -16,6 +271,9 @@ class Sample:
     This class represents a biological sample, characterised by its name, taxa, abundances,
     and pathways.
 
+    A Sample created by CreateSamples is a lightweight view into the AbundanceMatrix shared by
+    all samples, and its taxa and abundances are read from that matrix when they are accessed.
+
     Attributes
     ----------
     sample_name : str
@@ -26,14 +284,619 @@ class Sample:
         The abundances of each taxon in the sample.
     pathways : dict
         The metabolic pathways present in the sample.
+    matrix : AbundanceMatrix or None
+        The shared abundance matrix this sample is a view into, if any.
     """
 
-    def __init__(self, sample_name, taxa, abundances):
+    def __init__(self, sample_name, taxa=None, abundances=None, matrix=None):
         self.sample_name = sample_name
-        self.taxa = taxa
-        self.abundances = abundances
+        self.matrix = matrix
+        self._taxa = taxa
+        self._abundances = abundances
         self.pathways = {}
 
+    @property
+    def taxa(self):
+        if self._taxa is None and self.matrix is not None:
+            rows, _ = self.matrix.sample_column(self.sample_name)
+            return pd.DataFrame({'Taxon': self.matrix.taxa[rows],
+                                 'Taxon ID': self.matrix.taxon_ids[rows]})
+        return self._taxa
+
+    @taxa.setter
+    def taxa(self, taxa):
+        self._taxa = taxa
+
+    @property
+    def abundances(self):
+        if self._abundances is None and self.matrix is not None:
+            _, abundances = self.matrix.sample_column(self.sample_name)
+            return abundances.tolist()
+        return self._abundances
+
+    @abundances.setter
+    def abundances(self, abundances):
+        self._abundances = abundances
+
+
+class TaxonomyTable:
+    """
+    TaxonomyTable Class.
+
+    This class holds the domain to genus rank of each taxon as categorical columns, with NaN
+    where a rank is missing. It is used to group abundances by taxon level without splitting
+    the 'Taxon' strings, whose positions shift when a rank is missing.
+
+    Attributes
+    ----------
+    ranks : pandas.DataFrame
+        One categorical column per taxon level, and one row per taxon.
+    """
+
+    def __init__(self, ranks):
+        self.ranks = pd.DataFrame(
+            {level: pd.Categorical(ranks.iloc[:, i]) for i, level in enumerate(TAXON_LEVELS)})
+
+    @staticmethod
+    def from_index(index):
+        """
+        Creates a TaxonomyTable from the rank index of the data returned by
+        ReadDataFiles.read_all_sample_data.
+
+        Args:
+        index (pandas.Index): The row index of the sample data.
+
+        Returns:
+        (TaxonomyTable or None): The taxonomy table, or None if the index does not hold the ranks.
+        """
+        if list(index.names) != TAXON_RANKS:
+            return None
+        return TaxonomyTable(index.to_frame(index=False))
+
+    def group_matrices(self):
+        """
+        Returns, for each taxon level, the names of the groups at that level and a sparse
+        groups x taxa matrix that sums the abundances of the taxa in each group.
+
+        Returns:
+        dict: A dictionary mapping each taxon level to a (pandas.Index, scipy.sparse.csr_matrix) tuple.
+        """
+        from scipy import sparse
+
+        n_taxa = len(self.ranks)
+        group_matrices = {}
+        for level in TAXON_LEVELS:
+            codes = self.ranks[level].cat.codes.to_numpy()
+            taxa = np.flatnonzero(codes >= 0)  # Taxa without a name at this level are left out
+            groups = self.ranks[level].cat.categories
+            group_matrices[level] = (groups, sparse.csr_matrix(
+                (np.ones(len(taxa)), (codes[taxa], taxa)), shape=(len(groups), n_taxa)))
+        return group_matrices
+
+
+class HeatmapQuery:
+    """
+    HeatmapQuery Class.
+
+    This class describes which samples and taxa a heatmap shows, so that the others can be left out while
+    the sample data is read and the abundance matrix is built, rather than being read in full and filtered
+    afterwards. A taxon is kept if its abundance in any of the chosen samples is above the threshold, and,
+    if top_n is given, only the top_n taxa with the highest such abundances are kept. When the heatmap
+    groups taxa by level, the taxon filters apply to the groups rather than to single taxa, as a group can
+    pass a threshold that none of its taxa pass, so they are not applied at ingest.
+
+    Attributes
+    ----------
+    sample_list : list or None
+        The names of the samples to keep, or None to keep every sample.
+    threshold : float or None
+        The percent abundance a taxon must exceed in at least one sample, or None for no threshold.
+    top_n : int or None
+        The number of most abundant taxa to keep, or None to keep every taxon that passes the threshold.
+    taxon_level : str or None
+        The level the heatmap groups taxa by, or None if it does not group them.
+    """
+
+    def __init__(self, sample_list=None, threshold=None, top_n=None, taxon_level=None):
+        self.sample_list = None if sample_list is None else list(sample_list)
+        self.threshold = threshold
+        self.top_n = top_n
+        self.taxon_level = taxon_level
+
+    @property
+    def filters_taxa(self):
+        """
+        Whether single taxa can be left out at ingest.
+        """
+        return self.taxon_level is None and (self.threshold is not None or self.top_n is not None)
+
+    def sample_columns(self, header):
+        """
+        Returns the positions of the chosen samples in a header of column names.
+
+        Args:
+        header (list): The column names.
+
+        Returns:
+        (list): The positions of the columns of the chosen samples, in header order.
+        """
+        if self.sample_list is None:
+            return list(range(len(header)))
+        chosen = set(self.sample_list)
+        return [position for position, name in enumerate(header) if name in chosen]
+
+    def passes_threshold(self, abundances):
+        """
+        Returns whether a taxon passes the threshold, given its abundances as read from a file. Cells that
+        are not numbers are ignored.
+
+        Args:
+        abundances (list): The abundances of the taxon in the chosen samples.
+
+        Returns:
+        (bool): Whether any abundance is above the threshold, or True if there is no threshold.
+        """
+        if self.threshold is None:
+            return True
+        return any(isinstance(value, (int, float)) and value > self.threshold / 100 for value in abundances)
+
+    def taxon_mask(self, values):
+        """
+        Returns which rows of an abundance array the threshold and top_n keep. Missing abundances are never
+        above the threshold.
+
+        Args:
+        values (numpy array): The abundances, with one row per taxon (or group) and one column per sample.
+
+        Returns:
+        (numpy array): A boolean array that is True for each row that is kept.
+        """
+        values = np.asarray(values, dtype=float)
+        if values.shape[1] == 0:
+            return np.zeros(len(values), dtype=bool)
+        # A row passes the threshold if any of its abundances does, i.e. if its largest abundance does
+        largest = np.max(np.where(np.isnan(values), -np.inf, values), axis=1)
+        mask = largest > self.threshold / 100 if self.threshold is not None else np.ones(len(values), dtype=bool)
+        if self.top_n is not None and np.count_nonzero(mask) > self.top_n:
+            # Keep the top_n largest, choosing the earlier rows among equal abundances
+            ranked = np.flatnonzero(mask)[np.argsort(-largest[mask], kind='stable')]
+            mask = np.zeros(len(values), dtype=bool)
+            mask[ranked[:self.top_n]] = True
+        return mask
+
+
+class AbundanceMatrix:
+    """
+    AbundanceMatrix Class.
+
+    This class holds the abundances of every taxon in every sample as a single taxa x samples
+    float matrix with one shared taxon index. Missing abundances are stored as NaN, so they can
+    be told apart from zero abundances. When most abundances are zero, the matrix is stored as a
+    scipy CSC sparse matrix in which zeros are implicit and missing abundances are explicit NaN entries.
+
+    Attributes
+    ----------
+    taxa : pandas.Index
+        The name of the taxon in each row.
+    taxon_ids : numpy.ndarray
+        The taxon ID of each row (NaN where the taxon is not in the taxon dictionary).
+    sample_names : pandas.Index
+        The name of the sample in each column.
+    values : numpy.ndarray or scipy.sparse.csc_matrix
+        The abundances, with one row per taxon and one column per sample.
+    taxonomy : TaxonomyTable or None
+        The ranks of the taxon in each row, if known.
+    """
+
+    def __init__(self, taxa, taxon_ids, sample_names, values, taxonomy=None):
+        self.taxa = pd.Index(taxa)
+        self.taxon_ids = np.asarray(taxon_ids)
+        self.sample_names = pd.Index(sample_names)
+        self.values = values
+        self.taxonomy = taxonomy
+        self._rollups = None
+
+    @property
+    def is_sparse(self):
+        return not isinstance(self.values, np.ndarray)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @staticmethod
+    def from_sample_data(all_sample_data, taxon_dict, sample_names=None, sparse_threshold=0.5, query=None):
+        """
+        Creates an AbundanceMatrix from the data returned by ReadDataFiles.read_all_sample_data.
+
+        Args:
+        all_sample_data (DataFrame): DataFrame containing all sample data.
+        taxon_dict (DataFrame): DataFrame containing the taxon dictionary.
+        sample_names (list, optional): The names of the samples to include. Default is None, in which
+                                       case the samples of the query, or every sample, are included.
+        sparse_threshold (float): The fraction of zero abundances above which the matrix is stored
+                                  as a sparse matrix. Missing abundances are not counted as zero, as the
+                                  sparse matrix stores them as explicit entries. Default is 0.5.
+        query (HeatmapQuery, optional): If given, only the taxa that pass its threshold and top_n limit in the
+                                        included samples are included. Default is None.
+
+        Returns:
+        (AbundanceMatrix): The abundance matrix.
+        """
+        from scipy import sparse
+
+        if sample_names is None:
+            if query is not None and query.sample_list is not None:
+                sample_names = query.sample_list
+            else:
+                sample_names = all_sample_data.columns[1:]
+
+        values = all_sample_data[list(sample_names)].to_numpy(dtype=float)
+        taxa, ranks = all_sample_data['Taxon'], all_sample_data.index
+        if query is not None and query.filters_taxa:
+            rows = query.taxon_mask(values)
+            values, taxa, ranks = values[rows], taxa[rows], ranks[rows]
+
+        # Map each taxon to its ID once for every sample
+        taxon_ids = taxa.map(taxon_dict.set_index('Taxon')['Taxon ID'].to_dict())
+
+        # Only zeros count towards the density, as NaNs are kept as explicit entries to tell them apart
+        # from zeros, and so take as much room in the sparse matrix as any other abundance
+        if values.size and np.count_nonzero(values == 0) > sparse_threshold * values.size:
+            values = sparse.csc_matrix(values)
+
+        return AbundanceMatrix(taxa, taxon_ids.to_numpy(), sample_names, values, TaxonomyTable.from_index(ranks))
+
+    def append(self, all_sample_data, taxon_dict, sample_names=None):
+        """
+        Adds the samples of another sample data file, such as a new sequencing batch, as new columns.
+
+        The matrix is extended in place, so Sample views into it stay valid. Taxa that are not yet in
+        the matrix are added as rows, missing from the existing samples, and taxa that are not in the
+        new file are missing from the new samples. Group sums already computed by rollup_frame are
+        extended by summing the new columns only, unless new taxa were added, in which case they are
+        computed again the next time they are needed.
+
+        Args:
+        all_sample_data (DataFrame): The new sample data, as returned by ReadDataFiles.read_all_sample_data.
+        taxon_dict (DataFrame): DataFrame containing the taxon dictionary.
+        sample_names (list, optional): The names of the new samples to add. Default is None, in which case
+                                       every sample in the data is added.
+
+        Returns:
+        list: A Sample view of each new column.
+
+        Raises:
+        ValueError: If a sample is already in the matrix.
+        """
+        from scipy import sparse
+
+        batch = AbundanceMatrix.from_sample_data(all_sample_data, taxon_dict, sample_names, sparse_threshold=1)
+        for sample_name in batch.sample_names:
+            if sample_name in self.sample_names:
+                raise ValueError(f"Sample already loaded: {sample_name}")
+
+        # Add a row for each taxon that is new to the matrix, missing from the existing samples
+        rows = self.taxa.get_indexer(batch.taxa)
+        new_taxa = np.flatnonzero(rows < 0)
+        if len(new_taxa):
+            rows[new_taxa] = len(self.taxa) + np.arange(len(new_taxa))
+            missing = np.full((len(new_taxa), self.shape[1]), np.nan)
+            if self.is_sparse:
+                self.values = sparse.vstack([self.values, sparse.csc_matrix(missing)], format='csc')
+            else:
+                self.values = np.vstack([self.values, missing])
+            self.taxa = self.taxa.append(batch.taxa[new_taxa])
+            self.taxon_ids = np.concatenate([self.taxon_ids, batch.taxon_ids[new_taxa]])
+            if self.taxonomy is not None:
+                if batch.taxonomy is not None:
+                    new_ranks = batch.taxonomy.ranks.iloc[new_taxa]
+                else:
+                    new_ranks = pd.DataFrame(np.nan, index=new_taxa, columns=TAXON_LEVELS)
+                self.taxonomy = TaxonomyTable(pd.concat(
+                    [self.taxonomy.ranks.astype(object), new_ranks.astype(object)], ignore_index=True))
+            self._rollups = None
+
+        # Place the new abundances in the rows of their taxa, with the taxa not in the new file missing
+        values = np.full((len(self.taxa), len(batch.sample_names)), np.nan)
+        values[rows] = batch.values
+        if self.is_sparse:
+            self.values = sparse.hstack([self.values, sparse.csc_matrix(values)], format='csc')
+        else:
+            self.values = np.hstack([self.values, values])
+        self.sample_names = self.sample_names.append(batch.sample_names)
+
+        if self._rollups is not None:
+            # Sum the new columns only, and add them to the sums of the existing columns
+            values = np.nan_to_num(values)
+            for level, (groups, group_matrix) in self.taxonomy.group_matrices().items():
+                rollup = self._rollups[level][1]
+                self._rollups[level] = (groups, sparse.hstack(
+                    [rollup, sparse.csc_matrix(group_matrix @ values)], format='csc'))
+
+        return self.samples(batch.sample_names)
+
+    @staticmethod
+    def merge(sources, taxon_dict, sample_names=None, sparse_threshold=0.5, query=None):
+        """
+        Creates one AbundanceMatrix from several sample data files, such as the exports of different sequencing
+        runs, by outer-joining them on their taxa.
+
+        The taxa of every file are matched in one pass over their hashes, and the abundances of each file are
+        then placed in the rows of its taxa as one block, so the work done grows with the size of the merged
+        matrix rather than with the number of samples. A taxon that is not in a file is missing (NaN) from the
+        samples of that file, as in append, and a taxon listed more than once in a file has the sum of its
+        abundances there.
+
+        Args:
+        sources (list): The sample data of each file, as returned by ReadDataFiles.read_all_sample_data.
+        taxon_dict (DataFrame): DataFrame containing the taxon dictionary.
+        sample_names (list, optional): The names of the samples to include. Default is None, in which case the
+                                       samples of the query, or every sample of every file, are included.
+        sparse_threshold (float): The fraction of zero abundances above which the matrix is stored as a sparse
+                                  matrix. Missing abundances, including those of the taxa that are not in a file,
+                                  are not counted as zero, as the sparse matrix stores them as explicit entries.
+                                  Default is 0.5.
+        query (HeatmapQuery, optional): If given, only the taxa that pass its threshold and top_n limit in the
+                                        included samples are included. Default is None.
+
+        Returns:
+        (AbundanceMatrix): The merged abundance matrix, with the taxa in the order they are first listed.
+
+        Raises:
+        ValueError: If a sample is in more than one file or in none of them, or if two different taxa have the
+                    same hash.
+        """
+        from scipy import sparse
+
+        # Sample names must be unique across the files, as each names one column of the merged matrix
+        all_names = pd.Index([name for source in sources for name in source.columns[1:]])
+        if all_names.has_duplicates:
+            raise ValueError(f"Sample found in more than one sample data file: {all_names[all_names.duplicated()][0]}")
+        if sample_names is None and query is not None:
+            sample_names = query.sample_list
+        sample_names = all_names if sample_names is None else pd.Index(sample_names)
+        for sample_name in sample_names:
+            if sample_name not in all_names:
+                raise ValueError(f"No data found for sample: {sample_name}")
+
+        # Number the taxa of every file at once, so each file's rows are positions in the merged matrix
+        all_taxa = pd.concat([source['Taxon'] for source in sources], ignore_index=True)
+        codes, first = AbundanceMatrix._taxon_codes(all_taxa)
+
+        # Take the included samples of each file as one block, with its rows and columns in the merged matrix
+        blocks = []
+        starts = np.cumsum([0] + [len(source) for source in sources])
+        for source, start, stop in zip(sources, starts[:-1], starts[1:]):
+            names = [name for name in source.columns[1:] if name in sample_names]
+            block = source[names].to_numpy(dtype=float)
+            rows = codes[start:stop]
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            if len(unique_rows) < len(rows):
+                # Sum the abundances of a taxon listed more than once, leaving it missing if it always is
+                block = pd.DataFrame(block).groupby(inverse.ravel()).sum(min_count=1).to_numpy(dtype=float)
+                rows = unique_rows
+            blocks.append((rows, sample_names.get_indexer(names), block))
+
+        if query is not None and query.filters_taxa:
+            # A taxon's largest abundance is the largest of its largest abundances in each file
+            largest = np.full(len(first), -np.inf)
+            for rows, _, block in blocks:
+                if block.shape[1]:
+                    largest[rows] = np.maximum(largest[rows],
+                                               np.max(np.where(np.isnan(block), -np.inf, block), axis=1))
+            if len(sample_names):
+                keep = query.taxon_mask(np.where(np.isneginf(largest), np.nan, largest)[:, None])
+            else:
+                keep = np.zeros(len(first), dtype=bool)
+            positions = np.cumsum(keep) - 1
+            blocks = [(positions[rows[keep[rows]]], columns, block[keep[rows]]) for rows, columns, block in blocks]
+            first = first[keep]
+
+        shape = (len(first), len(sample_names))
+        # Only zeros count towards the density, as in from_sample_data, so the NaNs of missing taxa do not
+        n_zero = sum(np.count_nonzero(block == 0) for _, _, block in blocks)
+        if shape[0] * shape[1] and n_zero > sparse_threshold * shape[0] * shape[1]:
+            # Convert each file's columns in turn, with NaN for the taxa the file does not have, so that only
+            # one file's columns are held densely at a time
+            parts, order = [], []
+            for rows, columns, block in blocks:
+                part = np.full((shape[0], len(columns)), np.nan)
+                part[rows] = block
+                parts.append(sparse.csc_matrix(part))
+                order.append(columns)
+            values = sparse.hstack(parts, format='csc')
+            order = np.concatenate(order)
+            if np.any(order != np.arange(len(order))):
+                values = values[:, np.argsort(order)]
+        else:
+            values = np.full(shape, np.nan)
+            for rows, columns, block in blocks:
+                values[np.ix_(rows, columns)] = block
+
+        taxa = all_taxa.iloc[first].reset_index(drop=True)
+        taxon_ids = taxa.map(taxon_dict.set_index('Taxon')['Taxon ID'].to_dict())
+        taxonomy = None
+        if all(list(source.index.names) == TAXON_RANKS for source in sources):
+            ranks = pd.concat([source.index.to_frame(index=False) for source in sources], ignore_index=True)
+            taxonomy = TaxonomyTable(ranks.iloc[first].reset_index(drop=True))
+        return AbundanceMatrix(taxa, taxon_ids.to_numpy(), sample_names, values, taxonomy)
+
+    @staticmethod
+    def from_samples(samples):
+        """
+        Creates an AbundanceMatrix from Sample objects that are not views into one matrix, aligning each
+        sample's abundances by its own taxa rather than by their positions. A taxon that is not in a sample
+        is missing (NaN) from it.
+
+        Args:
+        samples (list): A list of Sample objects, each with its taxa and abundances.
+
+        Returns:
+        (AbundanceMatrix): The abundance matrix, with the taxa in the order they are first listed.
+
+        Raises:
+        ValueError: If a sample does not have one abundance per taxon, or if two different taxa have the same hash.
+        """
+        for sample in samples:
+            if len(sample.abundances) != len(sample.taxa):
+                raise ValueError(f"Sample {sample.sample_name} has {len(sample.abundances)} abundances "
+                                 f"for {len(sample.taxa)} taxa")
+        taxa = pd.concat([sample.taxa['Taxon'] for sample in samples], ignore_index=True)
+        taxon_ids = pd.concat([sample.taxa['Taxon ID'] for sample in samples], ignore_index=True)
+        codes, first = AbundanceMatrix._taxon_codes(taxa)
+
+        # Place every abundance of every sample in the row of its taxon with one assignment
+        columns = np.repeat(np.arange(len(samples)), [len(sample.abundances) for sample in samples])
+        values = np.full((len(first), len(samples)), np.nan)
+        values[codes, columns] = np.concatenate([np.asarray(sample.abundances, dtype=float) for sample in samples])
+        return AbundanceMatrix(taxa.iloc[first], taxon_ids.iloc[first].to_numpy(),
+                               [sample.sample_name for sample in samples], values)
+
+    @staticmethod
+    def _taxon_codes(taxa):
+        # Number the distinct taxa by their 64-bit hashes, which are quicker to match than the strings, and
+        # return the number of each taxon and the position where each number is first used
+        taxa = np.asarray(taxa, dtype=object)
+        codes, _ = pd.factorize(pd.util.hash_array(taxa, categorize=False))
+        _, first = np.unique(codes, return_index=True)
+        # Two different taxa with the same hash would be merged, so check every taxon against the first
+        # taxon with its number
+        collided = np.flatnonzero((taxa[first[codes]] != taxa) & ~pd.isna(taxa))
+        if len(collided):
+            taxon = taxa[collided[0]]
+            raise ValueError(f"Taxa {taxa[first[codes[collided[0]]]]!r} and {taxon!r} have the same hash")
+        return codes, first
+
+    def column_index(self, sample_name):
+        """
+        Returns the column position of a sample.
+
+        Args:
+        sample_name (str): The name of the sample.
+
+        Returns:
+        (int): The position of the sample's column.
+
+        Raises:
+        ValueError: If the sample is not in the matrix.
+        """
+        if sample_name not in self.sample_names:
+            raise ValueError(f"No data found for sample: {sample_name}")
+        return self.sample_names.get_loc(sample_name)
+
+    def dense_columns(self, sample_names=None):
+        """
+        Returns the abundances of some samples as a dense float array, with NaN for missing values.
+
+        Args:
+        sample_names (list, optional): The names of the samples. Default is None, in which case all
+                                       samples are returned.
+
+        Returns:
+        (numpy.ndarray): A taxa x samples array.
+        """
+        if sample_names is None:
+            columns = slice(None)
+        else:
+            columns = [self.column_index(sample_name) for sample_name in sample_names]
+        values = self.values[:, columns]
+        if self.is_sparse:
+            values = values.toarray()
+        return values
+
+    def sample_column(self, sample_name):
+        """
+        Returns the taxa present in a sample and their abundances.
+
+        Args:
+        sample_name (str): The name of the sample.
+
+        Returns:
+        tuple: The row positions of the taxa with a (non-NaN) abundance, and those abundances.
+        """
+        column = self.dense_columns([sample_name])[:, 0]
+        rows = np.flatnonzero(~np.isnan(column))
+        return rows, column[rows]
+
+    def samples(self, sample_names=None):
+        """
+        Creates Sample objects that are views into this matrix.
+
+        Args:
+        sample_names (list, optional): The names of the samples. Default is None, in which case a
+                                       Sample is created for every column.
+
+        Returns:
+        list: A list of Sample objects.
+        """
+        if sample_names is None:
+            sample_names = self.sample_names
+        return [Sample(sample_name, matrix=self) for sample_name in sample_names]
+
+    def to_frame(self, sample_names=None):
+        """
+        Returns the abundances of some samples as a DataFrame with a 'Taxa' column followed by one
+        column per sample. Taxa that are missing from all of the samples are left out.
+
+        Args:
+        sample_names (list, optional): The names of the samples. Default is None, in which case all
+                                       samples are returned.
+
+        Returns:
+        (DataFrame): The abundance data.
+        """
+        if sample_names is None:
+            sample_names = self.sample_names
+        values = self.dense_columns(sample_names)
+        rows = ~np.isnan(values).all(axis=1)
+        frame = pd.DataFrame(values[rows], columns=list(sample_names))
+        frame.insert(0, 'Taxa', self.taxa[rows])
+        return frame
+
+    def rollup_frame(self, taxon_level, sample_names=None):
+        """
+        Returns the abundances of some samples summed by taxon level, as a DataFrame with a 'Taxa'
+        column of group names followed by one column per sample. Missing abundances count as zero.
+
+        The sums for every taxon level are computed together the first time any level is requested,
+        so switching between levels afterwards is a lookup.
+
+        Args:
+        taxon_level (str): One of 'domain', 'phylum', 'class', 'order', 'family', 'genus'.
+        sample_names (list, optional): The names of the samples. Default is None, in which case all
+                                       samples are returned.
+
+        Returns:
+        (DataFrame): The summed abundance data, sorted by group name.
+
+        Raises:
+        ValueError: If the matrix has no taxonomy table.
+        """
+        if self.taxonomy is None:
+            raise ValueError('The abundance matrix has no taxonomy to group taxa by')
+
+        if self._rollups is None:
+            from scipy import sparse
+
+            # Replace missing abundances with zeros once, then sum every level from the same values
+            if self.is_sparse:
+                values = self.values.copy()
+                values.data = np.nan_to_num(values.data)
+            else:
+                values = np.nan_to_num(self.values)
+            self._rollups = {}
+            for level, (groups, group_matrix) in self.taxonomy.group_matrices().items():
+                self._rollups[level] = (groups, sparse.csc_matrix(group_matrix @ values))
+
+        groups, rollup = self._rollups[taxon_level]
+        if sample_names is None:
+            sample_names = self.sample_names
+        columns = [self.column_index(sample_name) for sample_name in sample_names]
+        frame = pd.DataFrame(rollup[:, columns].toarray(), columns=list(sample_names))
+        frame.insert(0, 'Taxa', groups.astype(object))
+        return frame
+
 
 class CreateSamples:
     """
@@ -43,14 +906,16 @@ class CreateSamples:
 
     Attributes
     ----------
-    all_sample_data : pandas.DataFrame
-        The data containing all sample information.
+    all_sample_data : pandas.DataFrame or list
+        The data containing all sample information, or a list of the data of several sample data files.
     taxon_dict : pandas.DataFrame
         The dictionary mapping taxa to their IDs.
     parent : pandas.DataFrame
         The parent data.
     samples : list
         The list of Sample objects created.
+    matrix : AbundanceMatrix or None
+        The abundance matrix shared by the created samples.
     """
 
     def __init__(self, all_sample_data, taxon_dict, parent):
@@ -58,18 +923,24 @@ class CreateSamples:
         self.taxon_dict = taxon_dict
         self.parent = parent
         self.samples = []
+        self.matrix = None
 
-    def create(self, sample_names=None):
+    @staged('create_samples', rows=len)
+    def create(self, sample_names=None, query=None):
         """
         Create Sample objects from data.
 
         If a list of sample names is provided, it creates Sample objects for those samples.
-        If no list is provided, it creates Sample objects for all samples in the data.
+        If no list is provided, it creates Sample objects for the samples of the query, or for
+        all samples in the data. The data of several sample data files are merged on their taxa
+        (see AbundanceMatrix.merge).
 
         Parameters
         ----------
         sample_names : list, optional
             The names of the samples to create objects for.
+        query : HeatmapQuery, optional
+            If given, only the taxa that pass its threshold and top_n limit are included.
 
         Returns
         -------
@@ -77,6 +948,15 @@ class CreateSamples:
             A list of Sample objects.
         """
 
+        if isinstance(self.all_sample_data, list):
+            # Outer-join the files on their taxa into one matrix, which checks the sample names
+            self.matrix = AbundanceMatrix.merge(
+                self.all_sample_data, self.taxon_dict, sample_names, query=query)
+            self.samples.extend(self.matrix.samples())
+            return self.samples
+
+        if sample_names is None and query is not None:
+            sample_names = query.sample_list
         if sample_names is None:  # If no list of sample names is provided, use all sample names
             sample_names = self.all_sample_data.columns[1:]
 
@@ -84,21 +964,10 @@ class CreateSamples:
             if sample not in self.all_sample_data.columns:
                 raise ValueError(f"No data found for sample: {sample}")
 
-            # Select the data for this sample and remove rows with NaN abundances
-            sample_data = self.all_sample_data[['Taxon', sample]]
-            sample_data = sample_data[sample_data[sample].notna()]
-
-            taxa = sample_data['Taxon'].tolist()
-            abundances = sample_data[sample].tolist()
-
-            # Create a DataFrame for each sample with Taxon as one column and Taxon ID as the other column
-            taxa_df = pd.DataFrame(taxa, columns=['Taxon'])
-            taxa_df['Taxon ID'] = taxa_df['Taxon'].map(
-                self.taxon_dict.set_index('Taxon')['Taxon ID'].to_dict())
-
-            # Create a Sample object for this sample and append it to the list of samples
-            sample_obj = Sample(sample, taxa_df, abundances)
-            self.samples.append(sample_obj)
+        # Build one matrix shared by all samples, and create a Sample view for each column
+        self.matrix = AbundanceMatrix.from_sample_data(
+            self.all_sample_data, self.taxon_dict, sample_names, query=query)
+        self.samples.extend(self.matrix.samples())
 
         return self.samples
 
@@ -109,74 +978,302 @@ class Microbe:
 
     This class represents a microbial taxon, characterised by its taxon_id and associated pathways.
 
+    A Microbe created by CreateMicrobes reads its pathways from the shared PathwayIndex when they
+    are accessed.
+
     Attributes
     ----------
     taxon_id : str
         The unique identifier for the microbe.
     pathways : list
         The metabolic pathways associated with the microbe.
+    index : PathwayIndex or None
+        The pathway index this microbe is a view into, if any.
     """
 
-    def __init__(self, taxon_id, pathways):
+    def __init__(self, taxon_id, pathways=None, index=None):
         self.taxon_id = taxon_id
-        self.pathways = pathways  # List of pathways
+        self.index = index
+        self._pathways = pathways  # List of pathways
 
+    @property
+    def pathways(self):
+        if self._pathways is None and self.index is not None:
+            return self.index.pathways_for_taxon(self.taxon_id)
+        return self._pathways
 
-class CreateMicrobes:
+    @pathways.setter
+    def pathways(self, pathways):
+        self._pathways = pathways
+
+
+class PathwayIndex:
     """
-    CreateMicrobes Class.
+    PathwayIndex Class.
 
-    This class is used to create a list of Microbe objects from provided data.
+    This class holds the links between pathways and taxa from the Parent data as a sparse
+    pathways x taxa incidence matrix. Pathways and taxon IDs are stored as integer codes, and
+    each pathway-taxon pair is stored once, however often it appears in the Parent data.
 
     Attributes
     ----------
-    parent : pandas.DataFrame
-        The parent data.
-    microbes : list
-        The list of Microbe objects created.
+    pathways : pandas.Index
+        The pathway of each row of the incidence matrix.
+    taxon_ids : pandas.Index
+        The taxon ID of each column of the incidence matrix.
+    incidence : scipy.sparse.csr_matrix
+        A boolean matrix that is True where a pathway is associated with a taxon.
     """
 
-    def __init__(self, parent):
-        self.parent = parent
-        self.microbes = []
+    def __init__(self, pathways, taxon_ids, pathway_codes, taxon_codes, sorted_unique=False):
+        """
+        Initialise the PathwayIndex class.
 
-    def create(self):
+        Args:
+        pathways (array-like): The unique pathways.
+        taxon_ids (array-like): The unique taxon IDs.
+        pathway_codes (numpy array): The position in pathways of the pathway in each Parent row.
+        taxon_codes (numpy array): The position in taxon_ids of the taxon in each Parent row.
+        sorted_unique (bool): Whether the pairs of codes are already unique and sorted by pathway code and
+                              then taxon code, so that they need not be sorted again. Default is False.
         """
-        Create Microbe objects from data.
+        from scipy import sparse
+
+        self.pathways = pd.Index(pathways)
+        self.taxon_ids = pd.Index(taxon_ids)
+
+        # Sort and de-duplicate the pairs, then build the CSR arrays from them directly
+        n_taxa = len(self.taxon_ids)
+        if not sorted_unique:
+            pairs = np.unique(np.asarray(pathway_codes, dtype=np.int64) * n_taxa +
+                              np.asarray(taxon_codes, dtype=np.int64))
+            pathway_codes, taxon_codes = pairs // n_taxa, pairs % n_taxa
+            del pairs
+        indptr = np.zeros(len(self.pathways) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pathway_codes, minlength=len(self.pathways)), out=indptr[1:])
+        self.incidence = sparse.csr_matrix(
+            (np.ones(len(taxon_codes), dtype=bool), taxon_codes, indptr),
+            shape=(len(self.pathways), n_taxa))
+
+        # The transpose answers taxon to pathway lookups
+        self._taxon_incidence = self.incidence.T.tocsr()
+
+    @staticmethod
+    @staged('pathway_index', rows=lambda index: index.incidence.nnz)
+    def from_parent(parent):
+        """
+        Creates a PathwayIndex from the data returned by ReadDataFiles.read_parent.
 
-        Creates a Microbe object for each unique taxon ID in the data.
+        Args:
+        parent (DataFrame): DataFrame containing the parent data.
 
-        Returns
-        -------
-        list
-            A list of Microbe objects.
+        Returns:
+        (PathwayIndex): The pathway index.
         """
-        unique_taxon_ids = self.parent['Taxon ID'].unique()
-        for taxon_id in tqdm(unique_taxon_ids, desc='Creating microbes', unit='microbe'):
-            pathways = self.parent[self.parent['Taxon ID']
-                                   == taxon_id]['Pathway'].tolist()
-            microbe_obj = Microbe(taxon_id, pathways)
-            self.microbes.append(microbe_obj)
-        return self.microbes
+        pathway_codes, pathways = pd.factorize(parent['Pathway'])
+        taxon_codes, taxon_ids = pd.factorize(parent['Taxon ID'])
 
+        # Ignore rows with a missing pathway or taxon ID
+        valid = (pathway_codes >= 0) & (taxon_codes >= 0)
+        return PathwayIndex(pathways, taxon_ids, pathway_codes[valid], taxon_codes[valid])
 
-class Pathways:
-    """
-    Pathways Class.
+    def taxa_for_pathway(self, pathway):
+        """
+        Returns the taxon IDs associated with a pathway.
 
-    This class represents the collection of unique metabolic pathways found in the data.
+        Raises:
+        KeyError: If the pathway is not in the index.
+        """
+        row = self.pathways.get_loc(pathway)
+        start, end = self.incidence.indptr[row], self.incidence.indptr[row + 1]
+        return self.taxon_ids[self.incidence.indices[start:end]].tolist()
+
+    def pathways_for_taxon(self, taxon_id):
+        """
+        Returns the pathways associated with a taxon ID.
+
+        Raises:
+        KeyError: If the taxon ID is not in the index.
+        """
+        row = self.taxon_ids.get_loc(taxon_id)
+        start, end = self._taxon_incidence.indptr[row], self._taxon_incidence.indptr[row + 1]
+        return self.pathways[self._taxon_incidence.indices[start:end]].tolist()
+
+    def pathways_covering(self, taxon_ids):
+        """
+        Returns the pathways that are associated with at least one of the given taxon IDs.
+
+        Args:
+        taxon_ids (list): The taxon IDs. IDs that are not in the index are ignored.
+
+        Returns:
+        (list): The pathways, in index order.
+        """
+        columns = self.taxon_ids.get_indexer(taxon_ids)
+        columns = columns[columns >= 0]
+        covered = self._taxon_incidence[columns].indices
+        return self.pathways[np.unique(covered)].tolist()
+
+    def membership(self, pathways, taxon_ids):
+        """
+        Returns which of the given taxon IDs are associated with each of the given pathways.
+
+        Args:
+        pathways (list): The pathways. Pathways that are not in the index have no taxa.
+        taxon_ids (list): The taxon IDs. IDs that are not in the index have no pathways.
+
+        Returns:
+        (numpy array): A boolean array with one row per pathway and one column per taxon ID.
+        """
+        rows = self.pathways.get_indexer(pathways)
+        columns = self.taxon_ids.get_indexer(taxon_ids)
+        membership = np.zeros((len(rows), len(columns)), dtype=bool)
+        valid_rows, valid_columns = np.flatnonzero(rows >= 0), np.flatnonzero(columns >= 0)
+        membership[np.ix_(valid_rows, valid_columns)] = self.incidence[
+            rows[valid_rows]][:, columns[valid_columns]].toarray()
+        return membership
+
+    def abundances(self, matrix, sample_names=None):
+        """
+        Returns the abundance of every pathway in some samples: the total abundance of the taxa associated
+        with the pathway. Missing abundances count as zero, and taxa whose IDs are not in the index are
+        left out.
+
+        The abundances are computed as one sparse product, incidence @ (mapping @ abundances), where
+        mapping is a sparse 0/1 matrix that takes each row of the abundance matrix to the column of its
+        taxon ID.
+
+        Args:
+        matrix (AbundanceMatrix): The abundances of the taxa.
+        sample_names (list, optional): The names of the samples. Default is None, in which case all samples
+                                       are used.
+
+        Returns:
+        (numpy array or scipy.sparse.csr_matrix): A pathways x samples array, sparse if the abundance
+                                                  matrix is sparse.
+        """
+        from scipy import sparse
+
+        columns = self.taxon_ids.get_indexer(matrix.taxon_ids)
+        rows = np.flatnonzero(columns >= 0)
+        mapping = sparse.csr_matrix((np.ones(len(rows)), (columns[rows], rows)),
+                                    shape=(len(self.taxon_ids), matrix.shape[0]))
+
+        if sample_names is None:
+            values = matrix.values
+        else:
+            values = matrix.values[:, [matrix.column_index(sample_name) for sample_name in sample_names]]
+        if matrix.is_sparse:
+            values = values.copy()
+            values.data = np.nan_to_num(values.data)
+        else:
+            values = np.nan_to_num(values)
+        return self.incidence.astype(float) @ (mapping @ values)
 
-    Attributes
-    ----------
-    parent : pandas.DataFrame
-        The parent data.
-    pathways : dict
-        A dictionary where keys are pathway names and values are lists of taxon IDs associated with the pathway.
-    """
 
-    def __init__(self, parent):
+class PathwayTaxa(Mapping):
+    """
+    PathwayTaxa Class.
+
+    A read-only dictionary view of a PathwayIndex, where keys are pathway names and values are
+    lists of the taxon IDs associated with the pathway.
+
+    Attributes
+    ----------
+    index : PathwayIndex
+        The pathway index being viewed.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, pathway):
+        return self.index.taxa_for_pathway(pathway)
+
+    def __contains__(self, pathway):
+        return pathway in self.index.pathways
+
+    def __iter__(self):
+        return iter(self.index.pathways)
+
+    def __len__(self):
+        return len(self.index.pathways)
+
+
+class CreateMicrobes:
+    """
+    CreateMicrobes Class.
+
+    This class is used to create a list of Microbe objects from provided data.
+
+    Attributes
+    ----------
+    parent : pandas.DataFrame or None
+        The parent data, or None if a PathwayIndex was given in its place.
+    microbes : list
+        The list of Microbe objects created.
+    index : PathwayIndex or None
+        The pathway index shared by the created microbes.
+    """
+
+    def __init__(self, parent, index=None):
+        if isinstance(parent, PathwayIndex) and index is None:
+            parent, index = None, parent  # Already indexed, e.g. by ReadDataFiles.read_parent_index
+        self.parent = parent
+        self.microbes = []
+        self.index = index
+
+    @staged('create_microbes', rows=len)
+    def create(self, progress=True):
+        """
+        Create Microbe objects from data.
+
+        Creates a Microbe object for each unique taxon ID in the data.
+
+        Parameters
+        ----------
+        progress : bool, optional
+            Whether to show a progress bar, if tqdm is installed. Default is True.
+
+        Returns
+        -------
+        list
+            A list of Microbe objects.
+        """
+        if self.index is None:
+            self.index = PathwayIndex.from_parent(self.parent)
+        taxon_ids = self.index.taxon_ids
+        if progress and importlib.util.find_spec('tqdm') is not None:
+            from tqdm import tqdm
+            taxon_ids = tqdm(taxon_ids, desc='Creating microbes', unit='microbe')
+        for taxon_id in taxon_ids:
+            microbe_obj = Microbe(taxon_id, index=self.index)
+            self.microbes.append(microbe_obj)
+        return self.microbes
+
+
+class Pathways:
+    """
+    Pathways Class.
+
+    This class represents the collection of unique metabolic pathways found in the data.
+
+    Attributes
+    ----------
+    parent : pandas.DataFrame or None
+        The parent data, or None if a PathwayIndex was given in its place.
+    pathways : dict
+        A dictionary where keys are pathway names and values are lists of taxon IDs associated with the pathway.
+    index : PathwayIndex or None
+        The pathway index the pathways dictionary is a view of.
+    """
+
+    def __init__(self, parent, index=None):
+        if isinstance(parent, PathwayIndex) and index is None:
+            parent, index = None, parent  # Already indexed, e.g. by ReadDataFiles.read_parent_index
         self.parent = parent
         self.pathways = {}
+        self.index = index
 
     # def create(self):
     #     """
@@ -195,20 +1292,22 @@ class Pathways:
     #         self.pathways[pathway] = taxon_ids
     #     return self.pathways
 
-    def create(self):  # Groupby to speed up program (uses more memory)
+    @staged('create_pathways', rows=len)
+    def create(self):  # Sparse incidence index to speed up program
         """
         Create pathways dictionary from data.
 
         Creates a dictionary where each unique pathway in the data is a key and the associated values are the taxon IDs.
+        The dictionary is a read-only view of a PathwayIndex, so the lists are built when they are looked up.
 
         Returns
         -------
         dict
             A dictionary of pathways and their associated taxon IDs.
         """
-        grouped = self.parent.groupby('Pathway')['Taxon ID']
-        for pathway, taxon_ids in tqdm(grouped, desc="Creating pathways"):
-            self.pathways[pathway] = taxon_ids.tolist()
+        if self.index is None:
+            self.index = PathwayIndex.from_parent(self.parent)
+        self.pathways = PathwayTaxa(self.index)
         return self.pathways
 
 
@@ -221,7 +1320,7 @@ class ReadDataFiles:
     Attributes
     ----------
     all_sample_data_path : str
-        Path to the All Sample Data Excel file.
+        Path to the All Sample Data Excel file, or a BIOM table (.biom) read by ReadBiomFile.
     taxon_dict_path : str
         Path to the Taxon Dictionary Excel file.
     function_dict_path : str
@@ -241,6 +1340,8 @@ class ReadDataFiles:
         Reads the Function Dictionary file.
     read_parent():
         Reads the Parent file.
+    read_parent_index(max_bytes=1024 ** 3, chunk_size=None):
+        Reads the Parent file in chunks into a PathwayIndex.
     """
 
     def __init__(self, all_sample_data_path, taxon_dict_path, function_dict_path, parent_path):
@@ -250,15 +1351,18 @@ class ReadDataFiles:
         self.function_dict_path = function_dict_path
         self.parent_path = parent_path
 
-    def read_excel_file(self, file_path, usecols=None, skiprows=None, column_names=None):
+    def read_excel_file(self, file_path, usecols=None, skiprows=None, column_names=None, keep_row=None):
         """
         Reads an Excel file with specified columns, skipped rows, and column names.
 
         Parameters:
         file_path (str): Path to the Excel file.
-        usecols (list, optional): List of column indices to read. Default is None.
+        usecols (list or callable, optional): List of column indices to read, or a function that is given the
+                                              header row and returns them. Default is None.
         skiprows (int, optional): Number of rows to skip at the start. Default is None.
         column_names (list, optional): List of column names. Default is None.
+        keep_row (callable, optional): A function that is given the cells of each row below the header, in the
+                                       columns read, and returns whether to keep the row. Default is None.
 
         Returns:
         df (DataFrame): Pandas DataFrame containing the data read from the Excel file.
@@ -280,72 +1384,231 @@ class ReadDataFiles:
             raise ValueError(
                 f"File at {file_path} is not an Excel file (.xlsx or .xls)")
 
+        if file_path.endswith(".xls"):
+            # Legacy .xls workbooks cannot be streamed by openpyxl, so pandas parses them once, and the columns
+            # are selected afterwards so that they can be checked against the columns of the file
+            df = pd.read_excel(file_path, skiprows=skiprows)
+            if df.empty and len(df.columns) == 0:
+                raise ValueError(f"Excel file at {file_path} is empty")
+            if callable(usecols):
+                usecols = usecols(list(df.columns))
+
+            # Check if the requested columns exist
+            if usecols and max(usecols) > len(df.columns) - 1:
+                raise ValueError(
+                    "usecols parameter exceeds the total number of columns in the Excel file")
+
+            # Check if the requested number of rows to skip does not exceed the total number of rows
+            if skiprows and skiprows > len(df):
+                raise ValueError(
+                    "skiprows parameter exceeds the total number of rows in the Excel file")
+
+            if usecols:
+                df = df.iloc[:, list(usecols)]
+            if keep_row is not None:
+                df = df[[keep_row(list(row)) for row in df.itertuples(index=False)]]
+        else:
+            df = self._stream_excel_file(file_path, usecols, skiprows, keep_row)
+
+        # Apply column names if specified
+        if column_names:
+            df.columns = column_names
+
+        return df
+
+    def _stream_excel_file(self, file_path, usecols=None, skiprows=None, keep_row=None):
+        """
+        Reads the active sheet of an .xlsx file in a single streaming (read-only) pass.
+
+        Rows are skipped, filtered and columns are selected as the sheet is streamed, so only the
+        requested cells are ever held in memory. The emptiness and bounds checks are made against the
+        data that has been streamed, rather than by loading the workbook a second time. Blank rows, empty
+        header cells and empty data cells are read as pd.read_excel reads them.
+
+        Parameters:
+        file_path (str): Path to the Excel file.
+        usecols (list or callable, optional): List of column indices to read, or a function that is given the
+                                              header row and returns them. Default is None.
+        skiprows (int, optional): Number of rows to skip at the start. Default is None.
+        keep_row (callable, optional): A function that is given the cells of each row below the header, in the
+                                       columns read, and returns whether to keep the row. Default is None.
+
+        Returns:
+        df (DataFrame): Pandas DataFrame containing the data read from the Excel file.
+
+        Raises:
+        ValueError: If the file is empty.
+        ValueError: If usecols exceeds the total number of columns in the Excel file.
+        ValueError: If skiprows exceeds the total number of rows in the Excel file.
+        """
+        import openpyxl
+
+        skiprows = skiprows or 0
+        has_data = False  # Whether any cell in the sheet holds a value
+        n_columns = 0  # Width of the widest non-blank row
+        header = None
+        rows = []
+        blank_rows = 0  # Blank rows below the header, which are only kept if a row with data follows them
+
+        workbook = openpyxl.load_workbook(
+            filename=file_path, read_only=True, data_only=True)
+        try:
+            sheet = workbook.active
+            for row_number, row in enumerate(sheet.iter_rows(values_only=True)):
+                # Ignore empty trailing cells when measuring the width of the row
+                width = len(row)
+                while width and row[width - 1] is None:
+                    width -= 1
+                has_data = has_data or width > 0
+                # Every row counts against skiprows, blank or not, as for pd.read_excel
+                if row_number < skiprows:
+                    continue
+                if header is not None and not width:
+                    blank_rows += 1
+                    continue
+                n_columns = max(n_columns, width)
+
+                # Read empty cells as empty strings, as pandas does, so that empty header cells are named
+                # 'Unnamed: i' and empty data cells are read as NaN
+                cells = ['' if value is None else value for value in row[:width]]
+                if header is None:
+                    # The first row read is the header, even if it is blank. Empty header cells are named
+                    # after their column in the sheet, whichever columns are read.
+                    if callable(usecols):
+                        usecols = usecols(cells)
+                    header = [cell if cell != '' else f'Unnamed: {column}' for column, cell in
+                              zip(usecols or range(len(cells)), self._select_cells(cells, usecols))]
+                    continue
+
+                # Blank rows within the data are kept as rows of NaN, and those at the end of the sheet are not
+                if blank_rows:
+                    blank = self._select_cells([], usecols)
+                    if keep_row is None or keep_row(blank):
+                        rows.extend(list(blank) for _ in range(blank_rows))
+                    blank_rows = 0
+                cells = self._select_cells(cells, usecols)
+                if keep_row is None or keep_row(cells):
+                    rows.append(cells)
+        finally:
+            workbook.close()
+
         # Check if the file is not empty
-        workbook = openpyxl.load_workbook(filename=file_path, read_only=False)
-        sheet = workbook.active
-        if sheet.dimensions == "A1:A1":
+        if not has_data:
             raise ValueError(f"Excel file at {file_path} is empty")
 
-        # Read the Excel file
-        df = pd.read_excel(file_path, usecols=usecols, skiprows=skiprows)
-
         # Check if the requested columns exist
-        if usecols and max(usecols) > len(df.columns) - 1:
+        if usecols and max(usecols) > n_columns - 1:
             raise ValueError(
                 "usecols parameter exceeds the total number of columns in the Excel file")
 
-        # Check if the requested number of rows to skip does not exceed the total number of rows
-        if skiprows and skiprows > len(df):
+        # Check if a header is left once the requested number of rows has been skipped
+        if header is None:
             raise ValueError(
                 "skiprows parameter exceeds the total number of rows in the Excel file")
 
-        # Apply column names if specified
-        if column_names:
-            df.columns = column_names
+        # Pad short rows so every row has the same number of cells
+        rows.insert(0, header)
+        if not usecols:
+            for row in rows:
+                row.extend([''] * (n_columns - len(row)))
 
-        return df
+        # Let pandas infer the header and column types, as pd.read_excel would
+        return TextParser(rows, header=0).read()
 
-    def read_all_sample_data(self, taxon_level=None):
+    @staticmethod
+    def _select_cells(cells, usecols):
+        # Returns the cells of a row in the columns read, or all of them if no columns are given
+        if usecols:
+            return [cells[i] if i < len(cells) else '' for i in usecols]
+        return cells
+
+    @staged('read_all_sample_data', rows=len)
+    def read_all_sample_data(self, taxon_level=None, query=None):
         """
         Reads and preprocesses the Sample Data file.
 
+        Args:
+        query (HeatmapQuery, optional): If given, only the columns of its samples, and only the taxa that pass
+                                        its threshold and top_n limit in those samples, are read. Samples of the
+                                        query that are not in the file are left out, so the data may have no
+                                        samples. Default is None.
+
         Returns:
         all_sample_data (DataFrame): Pandas DataFrame containing the preprocessed Sample Data.
 
         Raises:
         ValueError: If the sample data file does not have the expected structure.
         """
+        if self.all_sample_data_path.endswith('.biom'):
+            # BIOM tables are read directly, in the same layout as the Excel exports
+            return ReadBiomFile(self.all_sample_data_path).read_sample_data(query)
+
+        usecols, keep_row = None, None
+        if query is not None:
+            # Select the rank columns and the query's sample columns, and the taxa above the threshold,
+            # as the file is streamed
+            def query_columns(header):
+                return list(range(6)) + [6 + position for position in query.sample_columns(header[6:])]
+            usecols = query_columns
+            if query.filters_taxa:
+                def passes_threshold(cells):
+                    return query.passes_threshold(cells[6:])
+                keep_row = passes_threshold
+
         # Read the file, skipping the first row
         all_sample_data = self.read_excel_file(
-            self.all_sample_data_path, skiprows=1)
+            self.all_sample_data_path, skiprows=1, usecols=usecols, keep_row=keep_row)
 
-        # Check if the file has the expected structure (at least 7 columns)
-        if len(all_sample_data.columns) < 7:
+        # Check if the file has the expected structure (at least 7 columns, or the 6 rank columns when the
+        # query has no samples in the file)
+        if len(all_sample_data.columns) < (6 if query is not None else 7):
             raise ValueError(
                 f"The sample data file at {self.all_sample_data_path} does not have the expected structure")
 
         # Set column names for the first six columns
-        all_sample_data.columns.values[:6] = [
-            'Domain', 'Phylum', 'Class', 'Order', 'Family', 'Genus']
+        all_sample_data.columns.values[:6] = TAXON_RANKS
 
-        # Delete any columns that are completely empty (have no sample data)
-        all_sample_data = all_sample_data.dropna(axis=1, how='all')
+        # Delete any sample columns that are completely empty (have no sample data)
+        samples = all_sample_data.iloc[:, 6:]
+        all_sample_data = all_sample_data.drop(columns=samples.columns[samples.isna().all()])
 
-        # Combine the first six columns into a single 'Taxon' column,
+        # Combine the six rank columns into a single 'Taxon' column,
         # ignore values that are "__", and separate each taxon with "; "
-        cols_to_drop = ['Domain', 'Phylum',
-                        'Class', 'Order', 'Family', 'Genus']
-        all_sample_data['Taxon'] = all_sample_data[cols_to_drop].apply(
-            lambda row: '; '.join(filter(lambda x: x != "__", row)), axis=1)
-        all_sample_data = all_sample_data.drop(columns=cols_to_drop)
+        ranks = all_sample_data[TAXON_RANKS].astype(object)
+        ranks = ranks.where(ranks.notna() & (ranks != "__"))
+        taxon = self.join_ranks(ranks)
 
-        # Reorder columns to move 'Taxon' to the first position
-        cols = list(all_sample_data.columns)
-        cols = [cols[-1]] + cols[:-1]
-        all_sample_data = all_sample_data[cols]
+        # Keep the ranks themselves as the row index, so that taxa can later be grouped by
+        # level without parsing the 'Taxon' strings again
+        all_sample_data = all_sample_data.drop(columns=TAXON_RANKS)
+        all_sample_data.index = pd.MultiIndex.from_frame(ranks)
+        all_sample_data.insert(0, 'Taxon', taxon.to_numpy())
+
+        if query is not None and query.filters_taxa and query.top_n is not None:
+            # Only the taxa that passed the threshold are left to rank
+            all_sample_data = all_sample_data[query.taxon_mask(all_sample_data.iloc[:, 1:].to_numpy(dtype=float))]
 
         return all_sample_data
 
+    @staticmethod
+    def join_ranks(ranks):
+        """
+        Joins the ranks of each taxon into its taxon string, such as 'd__Bacteria; p__Firmicutes'.
+
+        Args:
+        ranks (DataFrame): The six ranks of each taxon, in the columns TAXON_RANKS, with missing ranks as None or NaN.
+
+        Returns:
+        (Series): The present ranks of each taxon, separated by "; ".
+        """
+        taxon = pd.Series('', index=ranks.index)
+        for rank in TAXON_RANKS:
+            present = ranks[rank].notna()
+            separator = np.where(present & (taxon != ''), '; ', '')
+            taxon = taxon + separator + ranks[rank].where(present, '').astype(str)
+        return taxon
+
+    @staged('read_taxon_dict', rows=len)
     def read_taxon_dict(self):
         """
         Reads the Taxon Dictionary file.
@@ -369,6 +1632,7 @@ class ReadDataFiles:
         taxon_dict.columns = ['Taxon ID', 'Taxon']
         return taxon_dict
 
+    @staged('read_function_dict', rows=len)
     def read_function_dict(self):
         """
         Reads the Function Dictionary file.
@@ -392,6 +1656,7 @@ class ReadDataFiles:
         function_dict.columns = ['Pathway', 'Pathway description']
         return function_dict
 
+    @staged('read_parent', rows=len)
     def read_parent(self):
         """
         Reads the Parent file.
@@ -426,6 +1691,648 @@ class ReadDataFiles:
         parent.columns = ['Pathway', 'Taxon ID']
         return parent
 
+    @staged('read_parent_index', rows=lambda index: index.incidence.nnz)
+    def read_parent_index(self, max_bytes=1024 ** 3, chunk_size=None):
+        """
+        Reads the Parent file in chunks straight into a PathwayIndex, without holding the whole file in memory.
+
+        The pathways and taxon IDs of each chunk are converted to integer codes shared by all chunks, and its
+        pathway-taxon pairs are de-duplicated, so the memory used grows with the number of distinct pairs
+        rather than with the number of rows. Taxon IDs are numbers when they are all numeric, as in
+        read_parent.
+
+        Args:
+        max_bytes (int): The memory the reader may use for parsed chunks and pairs, in bytes. A quarter is
+                         used for each chunk, and the rest for the distinct pairs. Merging the pairs of new
+                         chunks takes up to three times the memory of the pairs, so at most a third of the
+                         rest can be kept. Default is 1 GiB.
+        chunk_size (int, optional): The number of rows in each chunk. Default is None, in which case it is
+                                    chosen from max_bytes and the size of the first rows.
+
+        Returns:
+        (PathwayIndex): The pathway index, as PathwayIndex.from_parent(self.read_parent()) would return.
+
+        Raises:
+        FileNotFoundError: If the file does not exist.
+        pd.errors.ParserError: If the file cannot be parsed as a CSV.
+        ValueError: If the file does not contain the necessary columns.
+        MemoryError: If the distinct pairs do not fit in the memory left by max_bytes.
+        """
+        # Check if the file exists
+        if not os.path.isfile(self.parent_path):
+            raise FileNotFoundError(
+                f"Parent file at {self.parent_path} does not exist")
+
+        try:
+            # Pathways are always text, while the type of the taxon IDs is inferred, as read_parent does
+            reader = pd.read_csv(self.parent_path, usecols=[1, 2], dtype={1: str}, iterator=True)
+        except pd.errors.ParserError:
+            raise pd.errors.ParserError(
+                f"Cannot parse Parent file at {self.parent_path} as a CSV file")
+        except ValueError:
+            # usecols refers to columns that the file does not have
+            raise ValueError(
+                f"The Parent file at {self.parent_path} does not have the necessary columns")
+
+        # The pathways and taxon IDs seen so far, in order of first appearance, whose positions are their codes
+        known = [None, None]
+        # Each pair is stored as one integer, with the pathway code in the high 32 bits
+        pairs, pending, pending_bytes = np.empty(0, dtype=np.int64), [], 0
+        pair_budget = max_bytes - max_bytes // 4
+        rows, sized = chunk_size or 1000, chunk_size is not None
+
+        with reader:
+            while True:
+                try:
+                    chunk = reader.get_chunk(rows)
+                except StopIteration:
+                    break
+                except pd.errors.ParserError:
+                    raise pd.errors.ParserError(
+                        f"Cannot parse Parent file at {self.parent_path} as a CSV file")
+                if not sized and len(chunk):
+                    # Size the following chunks from the memory taken by the first rows
+                    row_bytes = chunk.memory_usage(deep=True).sum() / len(chunk) + 64
+                    rows, sized = max(1000, int(max_bytes // 4 // row_bytes)), True
+
+                chunk_pairs = []
+                for column, position in zip(chunk.columns, (0, 1)):
+                    # Code the chunk's values in order of appearance, and add the new ones to the known values
+                    chunk_codes, values = pd.factorize(chunk[column])
+                    values = pd.Index(values)
+                    if known[position] is None:
+                        known[position], shared = values, np.arange(len(values))
+                    else:
+                        if (pd.api.types.is_numeric_dtype(known[position]) !=
+                                pd.api.types.is_numeric_dtype(values)):
+                            # Chunks whose IDs were inferred as numbers and as text are compared as text
+                            known[position], values = known[position].astype(str), values.astype(str)
+                        shared = known[position].get_indexer(values)
+                        new = shared < 0
+                        shared[new] = len(known[position]) + np.arange(new.sum())
+                        known[position] = known[position].append(values[new])
+                    # A missing value has code -1, which picks the -1 appended at the end
+                    chunk_pairs.append(np.append(shared, -1)[chunk_codes])
+                pathway, taxon = chunk_pairs
+                valid = (pathway >= 0) & (taxon >= 0)  # Ignore rows with a missing pathway or taxon ID
+                pending.append(np.unique((pathway[valid] << 32) | taxon[valid]))
+                pending_bytes += pending[-1].nbytes
+
+                # Merge the chunks' pairs while the merge, which copies them twice, fits in the memory for pairs
+                if 3 * (pairs.nbytes + pending_bytes) > pair_budget:
+                    pairs = np.unique(np.concatenate([pairs] + pending))
+                    pending, pending_bytes = [], 0
+                    if 3 * pairs.nbytes > pair_budget:
+                        raise MemoryError(
+                            f"The {len(pairs)} distinct pathway-taxon pairs in {self.parent_path} need more "
+                            f"memory than max_bytes={max_bytes} allows")
+        pairs = np.unique(np.concatenate([pairs] + pending))
+        del pending
+
+        pathways, taxon_ids = [pd.Index([], dtype=object) if values is None else values for values in known]
+        if taxon_ids.dtype == object:
+            # If the taxon IDs were compared as text, convert them back to numbers where they all are
+            try:
+                taxon_ids = pd.Index(pd.to_numeric(taxon_ids))
+            except (ValueError, TypeError):
+                pass
+        # Sorting the pair integers sorted the pairs by pathway code and then taxon code
+        return PathwayIndex(pathways, taxon_ids, pairs >> 32, (pairs & 0xFFFFFFFF).astype(np.int32),
+                            sorted_unique=True)
+
+
+class ReadBiomFile:
+    """
+    A class used to read a BIOM table, such as a QIIME2 feature table, directly into an AbundanceMatrix.
+
+    BIOM v2.1 (HDF5) tables are streamed from the file's sample-major matrix in chunks of samples, so
+    only the requested samples are ever read. BIOM v1 (JSON) tables are parsed whole by the json module,
+    after which only the requested samples are kept. Observations that share the same domain to genus
+    taxonomy are summed into one taxon, as in the Excel exports read by ReadDataFiles.
+
+    Attributes
+    ----------
+    biom_path : str
+        Path to the BIOM file.
+    taxon_dict : pandas.DataFrame or None
+        The taxon dictionary used to look up the Taxon ID of each taxon, if given.
+    taxonomy : dict or None
+        A mapping of observation IDs to taxonomy strings or lists, used when the BIOM file has no
+        taxonomy metadata (e.g. a QIIME2 table whose taxonomy was exported separately).
+    """
+
+    HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+
+    def __init__(self, biom_path, taxon_dict=None, taxonomy=None):
+        """Initialises the ReadBiomFile with the path to the BIOM file."""
+        self.biom_path = biom_path
+        self.taxon_dict = taxon_dict
+        self.taxonomy = taxonomy
+
+    @staged('read_biom', rows=lambda matrix: matrix.shape[0])
+    def read(self, sample_names=None, relative=True, chunk_size=1000, collapse=True, skip_missing=False):
+        """
+        Reads the BIOM file.
+
+        Parameters:
+        sample_names (list, optional): The samples to read. Default is None, in which case all samples are read.
+        relative (bool): Whether to convert each sample's counts into relative abundances. Default is True.
+        chunk_size (int): The largest number of samples read from an HDF5 file at a time. Default is 1000.
+        collapse (bool): Whether to sum observations that share the same domain to genus taxonomy. Default is True.
+        skip_missing (bool): Whether to leave out requested samples that are not in the table, rather than raising
+                             an error. Default is False.
+
+        Returns:
+        matrix (AbundanceMatrix): The abundances, with one row per taxon and one column per sample.
+
+        Raises:
+        FileNotFoundError: If the file does not exist.
+        ValueError: If the file is not a BIOM table.
+        ValueError: If a requested sample is not in the table.
+        """
+        from scipy import sparse
+
+        # Check if the file exists
+        if not os.path.isfile(self.biom_path):
+            raise FileNotFoundError(f"BIOM file at {self.biom_path} does not exist")
+
+        with open(self.biom_path, 'rb') as f:
+            is_hdf5 = f.read(len(self.HDF5_SIGNATURE)) == self.HDF5_SIGNATURE
+        if is_hdf5:
+            observation_ids, all_sample_names, taxonomy, positions, columns = self._read_hdf5(
+                sample_names, chunk_size, skip_missing)
+        else:
+            observation_ids, all_sample_names, taxonomy, positions, columns = self._read_json(
+                sample_names, skip_missing)
+        sample_names = [all_sample_names[position] for position in positions]
+
+        # Assemble a sparse observations x samples matrix from the (rows, values) of each sample
+        indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+        np.cumsum([len(rows) for rows, _ in columns], out=indptr[1:])
+        values = sparse.csc_matrix(
+            (np.concatenate([values for _, values in columns] + [np.zeros(0)]).astype(float),
+             np.concatenate([rows for rows, _ in columns] + [np.zeros(0, dtype=np.int64)]), indptr),
+            shape=(len(observation_ids), len(columns)))
+
+        if relative:
+            totals = np.asarray(values.sum(axis=0)).ravel()
+            totals[totals == 0] = 1
+            values = values @ sparse.diags(1 / totals)
+
+        if self.taxonomy is not None:
+            taxonomy = [self.taxonomy.get(observation_id) for observation_id in observation_ids]
+        if taxonomy is None:
+            return AbundanceMatrix(observation_ids, observation_ids, sample_names, sparse.csc_matrix(values))
+
+        ranks = pd.DataFrame([self._parse_ranks(lineage) for lineage in taxonomy], columns=TAXON_RANKS)
+        taxon_ids = observation_ids
+        if collapse:
+            # Sum the observations that share the same ranks
+            codes, groups = pd.MultiIndex.from_frame(ranks).factorize()
+            group_matrix = sparse.csr_matrix(
+                (np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(len(groups), len(codes)))
+            values = group_matrix @ values
+            ranks = groups.to_frame(index=False).set_axis(TAXON_RANKS, axis=1)
+            taxon_ids = np.full(len(ranks), np.nan)
+
+        taxa = ReadDataFiles.join_ranks(ranks)
+        if self.taxon_dict is not None:
+            taxon_ids = taxa.map(self.taxon_dict.set_index('Taxon')['Taxon ID'].to_dict()).to_numpy()
+        return AbundanceMatrix(taxa, taxon_ids, sample_names, sparse.csc_matrix(values), TaxonomyTable(ranks))
+
+    @staged('read_biom_sample_data', rows=len)
+    def read_sample_data(self, query=None, chunk_size=1000):
+        """
+        Reads the BIOM file into the layout returned by ReadDataFiles.read_all_sample_data, so that a BIOM table
+        can be used wherever a sample data file can, e.g. by get_data and in job files.
+
+        The relative abundances of the taxa, collapsed by their domain to genus taxonomy, are returned as a dense
+        DataFrame, as from an Excel export. Use read for a sparse AbundanceMatrix. If the table has no taxonomy
+        metadata, each observation is a taxon named by its ID, with no ranks.
+
+        Parameters:
+        query (HeatmapQuery, optional): If given, only the query's samples that are in the table are read, and only
+                                        the taxa that pass its threshold and top_n limit in them are kept. Default
+                                        is None.
+        chunk_size (int): The largest number of samples read from an HDF5 file at a time. Default is 1000.
+
+        Returns:
+        all_sample_data (DataFrame): A 'Taxon' column followed by one column per sample, indexed by the ranks.
+        """
+        sample_names = query.sample_list if query is not None else None
+        matrix = self.read(sample_names, chunk_size=chunk_size, skip_missing=True)
+        values = matrix.values.toarray()
+        if matrix.taxonomy is not None:
+            ranks = matrix.taxonomy.ranks.astype(object).set_axis(TAXON_RANKS, axis=1)
+        else:
+            ranks = pd.DataFrame(None, index=range(len(matrix.taxa)), columns=TAXON_RANKS, dtype=object)
+
+        if query is not None and query.filters_taxa:
+            rows = query.taxon_mask(values)
+            values, ranks, taxa = values[rows], ranks[rows], matrix.taxa[rows]
+        else:
+            taxa = matrix.taxa
+
+        all_sample_data = pd.DataFrame(values, columns=matrix.sample_names, index=pd.MultiIndex.from_frame(ranks))
+        all_sample_data.insert(0, 'Taxon', np.asarray(taxa, dtype=object))
+        return all_sample_data
+
+    def _read_hdf5(self, sample_names, chunk_size, skip_missing):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError('Reading BIOM v2 (HDF5) files requires h5py')
+
+        with h5py.File(self.biom_path, 'r') as f:
+            if 'sample/matrix/indptr' not in f:
+                raise ValueError(f"File at {self.biom_path} is not a BIOM table")
+            observation_ids = f['observation/ids'].asstr()[:].tolist()
+            all_sample_names = f['sample/ids'].asstr()[:].tolist()
+            taxonomy = None
+            if 'observation/metadata/taxonomy' in f:
+                taxonomy = f['observation/metadata/taxonomy'].asstr()[:].tolist()
+
+            positions = self._sample_positions(all_sample_names, sample_names, skip_missing)
+            indptr = f['sample/matrix/indptr'][:]
+            data, indices = f['sample/matrix/data'], f['sample/matrix/indices']
+
+            # Read runs of consecutive samples, up to chunk_size at a time, with one slice per run
+            columns = [None] * len(positions)
+            order = np.argsort(positions, kind='stable')
+            run_start = 0
+            for i in range(1, len(order) + 1):
+                if (i < len(order) and positions[order[i]] == positions[order[i - 1]] + 1
+                        and i - run_start < chunk_size):
+                    continue
+                first, last = positions[order[run_start]], positions[order[i - 1]]
+                offset = indptr[first]
+                run_data = data[offset:indptr[last + 1]]
+                run_indices = indices[offset:indptr[last + 1]]
+                for j in order[run_start:i]:
+                    start, end = indptr[positions[j]] - offset, indptr[positions[j] + 1] - offset
+                    columns[j] = (run_indices[start:end], run_data[start:end])
+                run_start = i
+        return observation_ids, all_sample_names, taxonomy, positions, columns
+
+    def _read_json(self, sample_names, skip_missing):
+        try:
+            with open(self.biom_path) as f:
+                table = json.load(f)
+            observation_ids = [row['id'] for row in table['rows']]
+            all_sample_names = [column['id'] for column in table['columns']]
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+            raise ValueError(f"File at {self.biom_path} is not a BIOM table")
+
+        taxonomy = None
+        if all((row.get('metadata') or {}).get('taxonomy') is not None for row in table['rows']):
+            taxonomy = [row['metadata']['taxonomy'] for row in table['rows']]
+
+        positions = self._sample_positions(all_sample_names, sample_names, skip_missing)
+        if table.get('matrix_type') == 'dense':
+            dense = np.asarray(table['data'], dtype=float).reshape(len(observation_ids), len(all_sample_names))
+            columns = [(np.flatnonzero(dense[:, j]), dense[np.flatnonzero(dense[:, j]), j]) for j in positions]
+        else:
+            entries = np.asarray(table['data'], dtype=float).reshape(-1, 3)
+            entries = entries[np.argsort(entries[:, 1], kind='stable')]
+            bounds = np.searchsorted(entries[:, 1], np.arange(len(all_sample_names) + 1))
+            columns = [(entries[bounds[j]:bounds[j + 1], 0].astype(np.int64), entries[bounds[j]:bounds[j + 1], 2])
+                       for j in positions]
+        return observation_ids, all_sample_names, taxonomy, positions, columns
+
+    def _sample_positions(self, all_sample_names, sample_names, skip_missing=False):
+        if sample_names is None:
+            return np.arange(len(all_sample_names))
+        lookup = {name: position for position, name in enumerate(all_sample_names)}
+        if skip_missing:
+            sample_names = [sample for sample in sample_names if sample in lookup]
+        for sample in sample_names:
+            if sample not in lookup:
+                raise ValueError(f"No data found for sample: {sample}")
+        return np.array([lookup[sample] for sample in sample_names], dtype=np.int64)
+
+    def _parse_ranks(self, lineage):
+        # Split a 'd__X; p__Y; ...' string or list into its first six ranks, with missing ranks as None
+        if lineage is None:
+            lineage = []
+        elif isinstance(lineage, str):
+            lineage = lineage.split(';')
+        ranks = []
+        for name in list(lineage)[:6]:
+            name = name.strip() if isinstance(name, str) else ''
+            ranks.append(None if re.fullmatch(r'([A-Za-z]?__)?', name) else name)
+        return ranks + [None] * (6 - len(ranks))
+
+
+class IngestCache:
+    """
+    IngestCache Class.
+
+    An opt-in on-disk cache of the preprocessed DataFrames returned by the ReadDataFiles readers.
+    Each DataFrame is stored as a Parquet file. Entries are keyed on the kind of data, the source
+    path, its size and modification time, and a hash of its contents, so a changed input is always
+    re-read. When the cache grows beyond max_bytes, the least recently used entries are evicted.
+    Files may be loaded through one cache from several threads at once.
+
+    Attributes
+    ----------
+    cache_dir : str
+        The directory in which the cached files and their index are stored.
+    max_bytes : int
+        The maximum total size of the cached files, in bytes.
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        if importlib.util.find_spec('pyarrow') is None and importlib.util.find_spec('fastparquet') is None:
+            raise ImportError(
+                'IngestCache requires pyarrow or fastparquet to store DataFrames as Parquet')
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._entries = self._read_index()
+        # Guards the entries and the index file, but not the reading and writing of the cached files
+        self._lock = threading.RLock()
+
+    def key(self, kind, source_path):
+        """
+        Computes the cache key of a source file.
+
+        Args:
+        kind (str): The kind of data read from the file, e.g. 'taxon_dict'.
+        source_path (str): Path to the source file.
+
+        Returns:
+        (str): A hex digest identifying the file and the way it is read.
+        """
+        stat = os.stat(source_path)
+        content_hash = hashlib.sha256()
+        with open(source_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                content_hash.update(block)
+        key_fields = [INGEST_CACHE_VERSION, kind, os.path.abspath(source_path),
+                      stat.st_size, stat.st_mtime_ns, content_hash.hexdigest()]
+        return hashlib.sha256(json.dumps(key_fields).encode()).hexdigest()
+
+    def load(self, kind, source_path, reader):
+        """
+        Returns the cached DataFrame for a source file, reading and caching it on a miss.
+
+        Args:
+        kind (str): The kind of data read from the file, e.g. 'taxon_dict'.
+        source_path (str): Path to the source file.
+        reader (callable): A function with no arguments that reads and preprocesses the file.
+
+        Returns:
+        (DataFrame): The preprocessed DataFrame.
+        """
+        with stage('ingest_cache_load', kind=kind, hit=False) as timer:
+            key = self.key(kind, source_path)
+            entry = self._entries.get(key)
+            if entry is not None:
+                try:
+                    df = pd.read_parquet(os.path.join(self.cache_dir, entry['file']))
+                except (OSError, ValueError):
+                    # The cached file is missing or unreadable, so drop it and read the source again
+                    with self._lock:
+                        if key in self._entries:
+                            self._remove(key)
+                else:
+                    df.columns = entry['columns']
+                    with self._lock:
+                        entry['last_used'] = time.time()
+                        self._write_index()
+                    timer.update(hit=True, rows=len(df))
+                    return df
+
+            df = reader()
+            self._store(key, kind, source_path, df)
+            timer.update(rows=len(df))
+            return df
+
+    def invalidate(self, source_path=None):
+        """
+        Removes the cached entries of a source file, or every entry if no path is given.
+
+        Args:
+        source_path (str, optional): Path to the source file. Default is None.
+        """
+        source = os.path.abspath(source_path) if source_path is not None else None
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if source is None or entry['source'] == source:
+                    self._remove(key)
+            self._write_index()
+
+    def size(self):
+        """
+        Returns the total size of the cached files, in bytes.
+        """
+        with self._lock:
+            return sum(entry['bytes'] for entry in self._entries.values())
+
+    def _store(self, key, kind, source_path, df):
+        columns = df.columns.tolist()
+        file_name = key + '.parquet'
+        file_path = os.path.join(self.cache_dir, file_name)
+        try:
+            json.dumps(columns)  # Column names are restored from the index
+            stored = df.copy(deep=False)
+            stored.columns = [str(column) for column in columns]
+            stored.to_parquet(file_path)
+        except (TypeError, ValueError):
+            # Columns of mixed or unsupported types cannot be stored as Parquet, so don't cache them
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            return
+
+        with self._lock:
+            self._entries[key] = {'kind': kind, 'source': os.path.abspath(source_path), 'file': file_name,
+                                  'bytes': os.path.getsize(file_path), 'columns': columns,
+                                  'last_used': time.time()}
+            self._evict()
+            self._write_index()
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache fits within max_bytes
+        total = self.size()
+        for key in sorted(self._entries, key=lambda k: self._entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= self._entries[key]['bytes']
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        file_path = os.path.join(self.cache_dir, entry['file'])
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def _read_index(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if not os.path.isfile(index_path):
+            return {}
+        try:
+            with open(index_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}  # A corrupt index makes every entry a miss
+
+    def _write_index(self):
+        # Write to a temporary file first so a crash never leaves a partially written index
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(index_path + '.tmp', index_path)
+
+
+class TableExport:
+    """
+    TableExport Class.
+
+    This class writes tables, such as the processed data behind a heatmap (see HeatmapPlot.export), to Arrow
+    IPC, Parquet, HDF5 or CSV files. Each table is given as an iterable of DataFrame chunks with the same
+    columns, and is written one chunk at a time, as a record batch, row group or block of rows, so that no
+    table is ever held in memory whole in a second form.
+
+    Arrow, Parquet and CSV tables are each written to a file named after the table in the output directory.
+    HDF5 tables are written to groups of one file. In each group, every text column is a dataset named after
+    the column, and the numeric columns together form a 2D 'values' dataset whose 'columns' attribute names
+    them. The group's 'columns' attribute gives the order of all of the table's columns.
+
+    Attributes
+    ----------
+    path : str
+        The output directory, or the HDF5 file.
+    file_format : str
+        One of 'arrow', 'parquet', 'hdf5' or 'csv'.
+    """
+
+    # The file extension of each format
+    FORMATS = {'arrow': '.arrow', 'parquet': '.parquet', 'hdf5': '.h5', 'csv': '.csv'}
+
+    def __init__(self, path, file_format='parquet'):
+        """
+        Initialise the TableExport class, creating the output directory or an empty HDF5 file.
+
+        Args:
+        path (str): The directory to write the tables to, or the HDF5 file to write them to.
+        file_format (str): One of 'arrow', 'parquet', 'hdf5' or 'csv'. Default is 'parquet'.
+
+        Raises:
+        ValueError: If file_format is not a supported format.
+        ImportError: If the library that writes the format is not installed: pyarrow for Arrow and
+                     Parquet, or h5py for HDF5.
+        """
+        if file_format not in self.FORMATS:
+            raise ValueError('file_format must be one of ' + ', '.join(self.FORMATS))
+        if file_format in ('arrow', 'parquet') and importlib.util.find_spec('pyarrow') is None:
+            raise ImportError(f'Exporting {file_format} files requires pyarrow')
+        if file_format == 'hdf5' and importlib.util.find_spec('h5py') is None:
+            raise ImportError('Exporting HDF5 files requires h5py')
+        self.path = path
+        self.file_format = file_format
+
+        if file_format == 'hdf5':
+            import h5py
+
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            h5py.File(path, 'w').close()
+        else:
+            os.makedirs(path, exist_ok=True)
+
+    def write(self, name, chunks):
+        """
+        Writes a table, replacing any table of the same name.
+
+        Args:
+        name (str): The name of the table.
+        chunks (iterable): DataFrames of consecutive rows of the table, with the same columns and types. There
+                           must be at least one, which may be empty.
+
+        Returns:
+        (str): The path of the file written.
+        """
+        chunks = iter(chunks)
+        first = next(chunks)
+        with stage('export', table=name, format=self.file_format) as timer:
+            if self.file_format == 'hdf5':
+                path = self.path
+                rows = self._write_hdf5(name, first, chunks)
+            else:
+                path = os.path.join(self.path, name + self.FORMATS[self.file_format])
+                if self.file_format == 'csv':
+                    rows = self._write_csv(path, first, chunks)
+                else:
+                    rows = self._write_arrow(path, first, chunks)
+            timer.update(rows=rows)
+        return path
+
+    def _write_csv(self, path, first, chunks):
+        # Only the first chunk has a header
+        with open(path, 'w', newline='') as f:
+            first.to_csv(f, index=False)
+            rows = len(first)
+            for chunk in chunks:
+                chunk.to_csv(f, index=False, header=False)
+                rows += len(chunk)
+        return rows
+
+    def _write_arrow(self, path, first, chunks):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        # Every chunk is converted to the schema of the first, and written as a record batch or row group
+        table = pa.Table.from_pandas(first.rename(columns=str), preserve_index=False)
+        if self.file_format == 'arrow':
+            writer = pa.ipc.new_file(path, table.schema)
+        else:
+            writer = pq.ParquetWriter(path, table.schema)
+        with writer:
+            writer.write_table(table)
+            rows = len(first)
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk.rename(columns=str), schema=table.schema,
+                                                        preserve_index=False))
+                rows += len(chunk)
+        return rows
+
+    def _write_hdf5(self, name, first, chunks):
+        import h5py
+
+        columns = [str(column) for column in first.columns]
+        numeric = [pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                   for dtype in first.dtypes]
+        text = [position for position, is_numeric in enumerate(numeric) if not is_numeric]
+        values = [position for position, is_numeric in enumerate(numeric) if is_numeric]
+
+        with h5py.File(self.path, 'a') as f:
+            if name in f:
+                del f[name]
+            group = f.create_group(name)
+            group.attrs['columns'] = columns
+            # Create resizable datasets, which each chunk is appended to
+            datasets = {position: group.create_dataset(columns[position], shape=(0,), maxshape=(None,),
+                                                       dtype=h5py.string_dtype(), chunks=True)
+                        for position in text}
+            if values:
+                dtype = np.result_type(*first.dtypes.iloc[values])
+                values_dataset = group.create_dataset('values', shape=(0, len(values)), maxshape=(None, len(values)),
+                                                      dtype=dtype, chunks=True)
+                values_dataset.attrs['columns'] = [columns[position] for position in values]
+
+            rows = 0
+            for chunk in itertools.chain([first], chunks):
+                end = rows + len(chunk)
+                for position, dataset in datasets.items():
+                    dataset.resize((end,))
+                    dataset[rows:end] = chunk.iloc[:, position].astype(str).to_numpy(dtype=object)
+                if values:
+                    values_dataset.resize((end, len(values)))
+                    values_dataset[rows:end] = chunk.iloc[:, values].to_numpy(dtype=values_dataset.dtype)
+                rows = end
+        return rows
+
 
 class HeatmapData:
     """
@@ -441,6 +2348,7 @@ class HeatmapData:
         """
         self.samples = samples
 
+    @staged('process_heatmap_data', rows=len)
     def process_heatmap_data(self, taxon_level=None):
         """
         Processes the sample data to be used for the heatmap visualisation.
@@ -451,23 +2359,27 @@ class HeatmapData:
         Returns:
         heatmap_data (DataFrame): A pandas DataFrame containing taxa and abundance information for each sample.
         """
-        heatmap_data = pd.DataFrame(data=[self.samples[0].taxa.Taxon.tolist(
-        )] + [sample.abundances for sample in self.samples]).T
-        heatmap_data.columns = ['Taxa'] + \
-            [sample.sample_name for sample in self.samples]
+        if taxon_level is not None and taxon_level not in TAXON_LEVELS:
+            raise ValueError(
+                'taxon_level must be one of ' + ', '.join(TAXON_LEVELS))
+
+        matrix = self.samples[0].matrix
+        if matrix is not None and all(sample.matrix is matrix for sample in self.samples):
+            # The samples are views into one matrix, so read their columns from it directly
+            sample_names = [sample.sample_name for sample in self.samples]
+            if taxon_level is not None and matrix.taxonomy is not None:
+                # Grouping uses the ranks kept at ingest, and is a lookup once computed
+                return matrix.rollup_frame(taxon_level, sample_names)
+            heatmap_data = matrix.to_frame(sample_names)
+        else:
+            # Align the abundances of each sample by its own taxa, which may differ from sample to sample
+            heatmap_data = AbundanceMatrix.from_samples(self.samples).to_frame()
 
         if taxon_level is not None:
-            taxon_levels = ['domain', 'phylum',
-                            'class', 'order', 'family', 'genus']
-
-            if taxon_level not in taxon_levels:
-                raise ValueError(
-                    'taxon_level must be one of ' + ', '.join(taxon_levels))
-
             # Split the 'Taxa' column into separate taxonomic levels
             taxa_split = heatmap_data['Taxa'].str.split("; ", expand=True)
 
-            taxa_split.columns = taxon_levels
+            taxa_split.columns = TAXON_LEVELS
 
             # Aggregate by the specified taxon_level
             heatmap_data = heatmap_data.drop('Taxa', axis=1)
@@ -480,20 +2392,746 @@ class HeatmapData:
         return heatmap_data
 
 
+class PathwayHeatmapData:
+    """
+    PathwayHeatmapData Class.
+
+    This class represents pathway x sample abundances for the heatmap visualisation, and can be given to
+    HeatmapPlot in place of a HeatmapData object. The abundance of a pathway in a sample is the total
+    abundance of the taxa associated with it in the Parent data (see PathwayIndex.abundances), and every
+    pathway in the index is included.
+
+    Attributes
+    ----------
+    index : PathwayIndex
+        The links between pathways and taxa.
+    samples : list
+        The Sample objects whose abundances are used.
+    """
+
+    def __init__(self, index, samples):
+        """
+        Initialise the PathwayHeatmapData class.
+
+        Args:
+        index (PathwayIndex): The links between pathways and taxa, e.g. the index of the PathwayTaxa returned
+                              by Pathways.create.
+        samples (list): A list of sample objects.
+        """
+        self.index = index
+        self.samples = samples
+
+    @staged('process_pathway_heatmap_data', rows=len)
+    def process_heatmap_data(self, taxon_level=None):
+        """
+        Computes the abundance of every pathway in every sample.
+
+        Args:
+        taxon_level (None): Pathways cannot be grouped by taxon level, so this must be None.
+
+        Returns:
+        heatmap_data (DataFrame): A pandas DataFrame with the pathways in a 'Taxa' column, followed by their
+                                  abundance in each sample.
+
+        Raises:
+        ValueError: If taxon_level is not None.
+        """
+        if taxon_level is not None:
+            raise ValueError('Pathway abundances cannot be grouped by taxon level')
+
+        sample_names = [sample.sample_name for sample in self.samples]
+        matrix = self.samples[0].matrix
+        if matrix is None or any(sample.matrix is not matrix for sample in self.samples):
+            matrix = AbundanceMatrix.from_samples(self.samples)
+        abundances = self.index.abundances(matrix, sample_names)
+        if not isinstance(abundances, np.ndarray):
+            abundances = abundances.toarray()
+
+        heatmap_data = pd.DataFrame(abundances, columns=sample_names)
+        heatmap_data.insert(0, 'Taxa', self.index.pathways.astype(object))
+        return heatmap_data
+
+
+class IncrementalAitchison:
+    """
+    IncrementalAitchison Class.
+
+    This class holds the CLR of a set of compositions (e.g. samples) and the Aitchison distances between
+    them, so that compositions can be appended later by computing only their own CLR and their distances
+    to the others. The distances of the existing pairs are reused as they are.
+
+    Attributes
+    ----------
+    clr : numpy.ndarray
+        The CLR of each composition, with one row per composition.
+    distances : numpy.ndarray
+        The condensed distance matrix, in the order used by scipy's pdist.
+    """
+
+    def __init__(self, data):
+        """
+        Initialise the IncrementalAitchison class.
+
+        Args:
+        data (array-like): A 2D array with one composition (e.g. one sample) per row.
+        """
+        from scipy.spatial.distance import pdist
+
+        self.clr = clr_matrix(data)
+        self.distances = pdist(self.clr, metric='euclidean')
+
+    def __len__(self):
+        return len(self.clr)
+
+    def append(self, data):
+        """
+        Adds compositions, computing their CLR and their distances to every composition.
+
+        Args:
+        data (array-like): A 2D array with one new composition per row, over the same parts (e.g. the
+                           same taxa, in the same order) as the existing compositions.
+
+        Raises:
+        ValueError: If the new compositions do not have the same number of parts as the existing ones.
+        """
+        from scipy.spatial.distance import cdist, pdist
+
+        new_clr = clr_matrix(data)
+        if new_clr.shape[1] != self.clr.shape[1]:
+            raise ValueError(f'Expected compositions of {self.clr.shape[1]} parts, got {new_clr.shape[1]}')
+        cross = cdist(self.clr, new_clr, metric='euclidean')
+
+        # Row i of the condensed matrix holds the distances from composition i to every later one,
+        # so each existing row is followed by its distances to the new compositions
+        n = len(self.clr)
+        ends = np.cumsum(np.arange(n - 1, -1, -1))
+        pieces = []
+        for i, end in enumerate(ends):
+            pieces.append(self.distances[end - (n - 1 - i):end])
+            pieces.append(cross[i])
+        pieces.append(pdist(new_clr, metric='euclidean'))
+        self.distances = np.concatenate(pieces)
+        self.clr = np.vstack([self.clr, new_clr])
+
+    def linkage(self, method='complete'):
+        """
+        Computes a hierarchical clustering linkage of the compositions from the stored distances.
+
+        Args:
+        method (str): The scipy linkage method. Default is 'complete'.
+
+        Returns:
+        linkage_matrix (numpy array): The scipy linkage matrix.
+        """
+        from scipy.cluster.hierarchy import linkage
+
+        return linkage(self.distances, method=method)
+
+
+class BlockedAitchison:
+    """
+    BlockedAitchison Class.
+
+    This class computes the condensed Aitchison distance matrix between compositions a block of rows at
+    a time, and stores it as float32 in a memory-mapped temporary file, for cohorts whose distances do
+    not fit in memory as float64 alongside the data. Only one block of distances is held in memory while
+    they are computed, and the file is deleted when the object is.
+
+    In the approximate mode, the CLR of each composition is projected onto a few random directions, which
+    preserves the distances between compositions up to a small relative error (the Johnson-Lindenstrauss
+    lemma) and makes each distance cost the number of directions rather than the number of parts.
+
+    Attributes
+    ----------
+    distances : numpy.memmap
+        The condensed float32 distance matrix, in the order used by scipy's pdist.
+    projection : int or None
+        The number of random directions the CLR is projected onto, or None if the distances are exact.
+    """
+
+    def __init__(self, data, directory=None, block_bytes=256 * 1024 ** 2, projection=None, seed=None):
+        """
+        Initialise the BlockedAitchison class, computing the distances.
+
+        Args:
+        data (array-like): A 2D array with one composition (e.g. one sample) per row.
+        directory (str, optional): The directory of the temporary file. Default is None, in which case the
+                                   system's temporary directory is used.
+        block_bytes (int): The memory used by each block of float64 distances. Default is 256 MiB.
+        projection (int, optional): If given, the distances are approximated by projecting the CLR onto this
+                                    many random directions. Default is None.
+        seed (int, optional): The seed of the random directions. Default is None.
+        """
+        import tempfile
+        from scipy.spatial.distance import cdist, pdist, squareform
+
+        self.projection = projection
+        data = np.asarray(data)
+        self._n = n = len(data)
+
+        if projection is not None:
+            directions = np.random.default_rng(seed).standard_normal((data.shape[1], projection))
+            directions /= np.sqrt(projection)
+
+        # Transform the compositions in blocks, so that only the (projected) CLR is held in full
+        clr_data = np.empty((n, data.shape[1] if projection is None else projection))
+        rows_per_block = max(1, block_bytes // (8 * max(data.shape[1], 1)))
+        for start in range(0, n, rows_per_block):
+            block = clr_matrix(data[start:start + rows_per_block])
+            clr_data[start:start + len(block)] = block if projection is None else block @ directions
+
+        size = n * (n - 1) // 2
+        if size == 0:
+            self.distances = np.empty(0, dtype=np.float32)
+            return
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self.distances = np.memmap(self._file, dtype=np.float32, mode='w+', shape=(size,))
+
+        # Row i of the condensed matrix holds the distances from composition i to every later one, so a
+        # block of rows is the upper triangle of the distances among its compositions, followed by their
+        # distances to the compositions after the block
+        rows_per_block = max(1, block_bytes // (8 * n))
+        for start in range(0, n - 1, rows_per_block):
+            stop = min(start + rows_per_block, n)
+            block = np.empty((stop - start, n - start))
+            block[:, :stop - start] = squareform(pdist(clr_data[start:stop], metric='euclidean'))
+            block[:, stop - start:] = cdist(clr_data[start:stop], clr_data[stop:], metric='euclidean')
+            upper = np.arange(n - start) > np.arange(stop - start)[:, None]
+            offset = start * n - start * (start + 1) // 2
+            self.distances[offset:offset + np.count_nonzero(upper)] = block[upper]
+        self.distances.flush()
+
+    def __len__(self):
+        return self._n
+
+    def linkage(self, method='complete'):
+        """
+        Computes a hierarchical clustering linkage of the compositions from the stored distances.
+
+        scipy's linkage works on a float64 copy of the distances, so this needs 8 bytes per pair of
+        compositions in memory (about 1.6 GB for 20,000 samples), and twice that for every method but
+        'single'.
+
+        Args:
+        method (str): The scipy linkage method. Default is 'complete'.
+
+        Returns:
+        linkage_matrix (numpy array): The scipy linkage matrix.
+        """
+        from scipy.cluster.hierarchy import linkage
+
+        return linkage(self.distances, method=method)
+
+
+class LRUCache:
+    """
+    LRUCache Class.
+
+    A small thread-safe dictionary that holds at most maxsize items, discarding the least
+    recently used item when it is full.
+
+    Attributes
+    ----------
+    maxsize : int
+        The maximum number of items held.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def items(self):
+        with self._lock:
+            return list(self._items.items())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+class PlotCache:
+    """
+    PlotCache Class.
+
+    A cache of sample clusterings and rendered figures, which may be shared by any number of HeatmapPlot
+    objects. A clustering is keyed on a hash of the filtered abundances it clusters, the distance metric and
+    the linkage method, so a heatmap whose filter keeps the same data is not clustered again, whatever its
+    pathways. A figure is keyed on a hash of everything drawn in it. The most recently used entries are held
+    in memory, and if a cache_dir is given every entry is also written there, to be reused by later runs and
+    by other processes, with the least recently used files removed when they grow beyond max_bytes.
+
+    Attributes
+    ----------
+    maxsize : int
+        The number of entries held in memory.
+    cache_dir : str or None
+        The directory in which entries are stored, or None to hold them in memory only.
+    max_bytes : int
+        The maximum total size of the files in cache_dir, in bytes.
+    """
+
+    SUFFIXES = ('.npy', '.bin')
+
+    def __init__(self, maxsize=64, cache_dir=None, max_bytes=1024 ** 3):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._memory = LRUCache(maxsize)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """
+        Computes the cache key of an entry from the parts that determine it.
+
+        Args:
+        *parts: Strings, numbers, None, numpy arrays and pandas objects, or lists, tuples and dicts of these.
+
+        Returns:
+        (str): A hex digest of the parts.
+        """
+        digest = hashlib.sha256(f'pylomap plot cache {PLOT_CACHE_VERSION}'.encode())
+        PlotCache._update_key(digest, parts)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _update_key(digest, part):
+        # Each part is prefixed with its type and size, so that different parts never hash alike
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            names = part.columns if isinstance(part, pd.DataFrame) else [part.name]
+            PlotCache._update_key(digest, ('pandas', [str(name) for name in names],
+                                           pd.util.hash_pandas_object(part).to_numpy()))
+        elif isinstance(part, np.ndarray):
+            if part.dtype == object:
+                part = pd.util.hash_array(part.ravel()).reshape(part.shape)
+            array = np.ascontiguousarray(part)
+            digest.update(f'array {array.dtype.str} {array.shape} '.encode())
+            digest.update(array.data)
+        elif isinstance(part, (list, tuple)):
+            digest.update(f'sequence {len(part)} '.encode())
+            for item in part:
+                PlotCache._update_key(digest, item)
+        elif isinstance(part, dict):
+            PlotCache._update_key(digest, sorted(part.items(), key=lambda item: str(item[0])))
+        else:
+            text = repr(part)
+            digest.update(f'value {len(text)} {text}'.encode())
+
+    def get(self, key, default=None):
+        """
+        Returns a cached entry, looking in memory and then in cache_dir.
+
+        Args:
+        key (str): The key of the entry, as returned by key.
+        default (optional): The value returned if there is no such entry. Default is None.
+
+        Returns:
+        The entry, either a numpy array or bytes, or default.
+        """
+        value = self._memory.get(key)
+        if self.cache_dir is not None:
+            if value is None:
+                value = self._read(key)
+                if value is not None:
+                    self._memory.put(key, value)
+            else:
+                # Mark the file as recently used too, so that it is not the next to be evicted from cache_dir
+                try:
+                    self._touch(self._path(key, value))
+                except FileNotFoundError:
+                    pass  # Evicted by another process, though still held in memory
+        return default if value is None else value
+
+    def put(self, key, value):
+        """
+        Caches an entry.
+
+        Args:
+        key (str): The key of the entry, as returned by key.
+        value (numpy array or bytes): The entry.
+        """
+        self._memory.put(key, value)
+        if self.cache_dir is not None:
+            self._write(key, value)
+            self._evict()
+
+    def clear(self):
+        """
+        Removes every entry, from memory and from cache_dir.
+        """
+        self._memory.clear()
+        if self.cache_dir is not None:
+            for _, _, path in self._files():
+                self._remove(path)
+
+    def _read(self, key):
+        for suffix in self.SUFFIXES:
+            path = os.path.join(self.cache_dir, key + suffix)
+            try:
+                if suffix == '.npy':
+                    value = np.load(path, allow_pickle=False)
+                else:
+                    with open(path, 'rb') as f:
+                        value = f.read()
+                self._touch(path)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError):
+                # The file is unreadable or was removed as it was read, so treat it as a miss
+                self._remove(path)
+                return None
+            return value
+        return None
+
+    @staticmethod
+    def _touch(path):
+        # Set the last used time from the precise clock, as file systems may set it from a coarse one
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+
+    def _path(self, key, value):
+        return os.path.join(self.cache_dir, key + ('.npy' if isinstance(value, np.ndarray) else '.bin'))
+
+    def _write(self, key, value):
+        # Write to a temporary file first, so that other processes never read a partially written entry
+        path = self._path(key, value)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            if isinstance(value, np.ndarray):
+                np.save(f, value, allow_pickle=False)
+            else:
+                f.write(value)
+        os.replace(temporary_path, path)
+        self._touch(path)
+
+    def _files(self):
+        # The (last used time, size, path) of each entry in cache_dir
+        files = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.SUFFIXES):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return files
+
+    def _evict(self):
+        # Remove the least recently used files until the cache fits within max_bytes
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # Already removed by another process
+
+
+class PathwaySearchIndex:
+    """
+    PathwaySearchIndex Class.
+
+    This class indexes the pathway descriptions of the function dictionary once, so that they
+    can be searched without scanning every description. Each description is indexed by its word
+    tokens and by its character n-grams. A substring search only checks the descriptions that
+    contain every n-gram of the search string. Results are kept in an LRU cache, so repeated
+    searches, for example by a heatmap and its LaTeX table, are only computed once.
+
+    Attributes
+    ----------
+    function_dict : pandas.DataFrame
+        The function dictionary being indexed.
+    ngram : int
+        The length of the character n-grams.
+    """
+
+    # Characters that make a search string a regular expression rather than plain text
+    REGEX_CHARACTERS = set('.^$*+?{}[]\\|()')
+
+    def __init__(self, function_dict, ngram=3, cache_size=256):
+        self.function_dict = function_dict
+        self.ngram = ngram
+        self._pathways = function_dict['Pathway'].tolist()
+        # Regular expressions are matched against the descriptions as they are, and the index is built
+        # from their lowercase forms
+        self._original_descriptions = [description if isinstance(description, str) else None
+                                       for description in function_dict['Pathway description']]
+        self._descriptions = [description.lower() if description is not None else ''
+                              for description in self._original_descriptions]
+        self._cache = LRUCache(cache_size)
+
+        # Build the posting lists of the row positions containing each token and n-gram
+        tokens, ngrams = {}, {}
+        for row, description in enumerate(self._descriptions):
+            for token in set(re.findall(r'\w+', description)):
+                tokens.setdefault(token, []).append(row)
+            for start in range(len(description) - ngram + 1):
+                ngrams.setdefault(description[start:start + ngram], set()).add(row)
+        self._tokens = {token: np.array(rows) for token, rows in tokens.items()}
+        self._ngrams = {gram: np.array(sorted(rows)) for gram, rows in ngrams.items()}
+
+    def search(self, search_string, match='substring'):
+        """
+        Search for pathways whose description matches the search string, ignoring case.
+
+        Args:
+        search_string (str): The string to search for in the pathway descriptions. A string that
+                             contains regular expression characters is matched as a regular
+                             expression, as pandas' str.contains would.
+        match (str): How to match the search string. 'substring' matches the whole string,
+                     'all' requires every whitespace-separated term to appear as a substring,
+                     'any' requires at least one of them, and 'words' requires every term to
+                     appear as a whole word. Default is 'substring'.
+
+        Returns:
+        (list): A list of pathways that match the search string, in function dictionary order.
+
+        Raises:
+        ValueError: If match is not one of the supported modes.
+        """
+        key = (search_string, match)
+        pathways = self._cache.get(key)
+        if pathways is None:
+            if match == 'substring':
+                rows = self._substring_rows(search_string)
+            elif match in ('all', 'any'):
+                term_rows = [self._substring_rows(term) for term in search_string.split()]
+                combine = np.intersect1d if match == 'all' else np.union1d
+                rows = term_rows[0] if term_rows else np.arange(len(self._descriptions))
+                for other in term_rows[1:]:
+                    rows = combine(rows, other)
+            elif match == 'words':
+                rows = np.arange(len(self._descriptions))
+                for term in search_string.lower().split():
+                    rows = np.intersect1d(rows, self._tokens.get(term, np.array([], dtype=int)))
+            else:
+                raise ValueError("match must be one of 'substring', 'all', 'any', 'words'")
+            pathways = tuple(self._pathways[row] for row in rows)
+            self._cache.put(key, pathways)
+        return list(pathways)
+
+    def _substring_rows(self, search_string):
+        if self.REGEX_CHARACTERS.intersection(search_string):
+            # Compile the string as given, since lowercasing it would change escapes such as \S and \W
+            pattern = re.compile(search_string, re.IGNORECASE)
+            return np.array([row for row, description in enumerate(self._original_descriptions)
+                             if description is not None and pattern.search(description)], dtype=int)
+
+        query = search_string.lower()
+
+        if len(query) < self.ngram:
+            candidates = range(len(self._descriptions))
+        else:
+            # Only descriptions containing every n-gram of the query can contain the query
+            postings = sorted((self._ngrams.get(query[start:start + self.ngram], np.array([], dtype=int))
+                               for start in range(len(query) - self.ngram + 1)), key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        return np.array([row for row in candidates if query in self._descriptions[row]], dtype=int)
+
+
+_cell_labels_class = None
+
+
+def cell_labels_class():
+    """
+    Returns the CellLabels artist class, defining it on first use.
+
+    CellLabels subclasses a matplotlib type, so it is defined the first time it is needed rather
+    than when pylomap is imported.
+
+    Returns:
+    (type): The CellLabels class.
+    """
+    global _cell_labels_class
+    if _cell_labels_class is not None:
+        return _cell_labels_class
+
+    import matplotlib
+    from matplotlib.artist import Artist
+    from matplotlib.colors import to_rgba
+    from matplotlib.font_manager import FontProperties, findfont, get_font
+
+    class CellLabels(Artist):
+        """
+        CellLabels Class.
+
+        A single matplotlib artist that draws a text label in the centre of every cell of a heatmap,
+        in place of one Text artist per cell. Up to vector_limit labels are drawn as text. Beyond that,
+        each distinct label is rasterised once and stamped into one image layer, so the drawing time
+        grows linearly with the number of cells. Nothing is drawn when the cells are too small for the
+        labels to be read.
+
+        Attributes
+        ----------
+        labels : numpy.ndarray
+            The label of each cell, with one row per heatmap row.
+        fontsize : float
+            The font size of the labels, in points.
+        vector_limit : int
+            The largest number of labels that are drawn as text rather than as an image.
+        """
+
+        def __init__(self, values, fmt='%.1f', fontsize=8, vector_limit=2000):
+            """
+            Initialise the CellLabels class.
+
+            Args:
+            values (numpy array): The values to label, with one row per heatmap row and one column per heatmap column.
+            fmt (str): The printf-style format of the labels. Default is '%.1f'.
+            fontsize (float): The font size of the labels, in points. Default is 8.
+            vector_limit (int): The largest number of labels drawn as text rather than as an image. Default is 2000.
+            """
+            super().__init__()
+            self.labels = np.char.mod(fmt, np.asarray(values, dtype=float))
+            self.fontsize = fontsize
+            self.vector_limit = vector_limit
+            rows, columns = np.indices(self.labels.shape)
+            self._centres = np.column_stack([columns.ravel() + 0.5, rows.ravel() + 0.5])
+            self.set_zorder(3)
+
+        def draw(self, renderer):
+            if not self.get_visible() or self.labels.size == 0:
+                return
+            transform = self.axes.transData
+            (x0, y0), (x1, y1) = transform.transform([(0, 0), (1, 1)])
+            cell_width, cell_height = abs(x1 - x0), abs(y1 - y0)
+
+            # Skip the labels when a line of text does not fit in a cell
+            if cell_height < renderer.points_to_pixels(self.fontsize):
+                return
+
+            centres = transform.transform(self._centres)
+            labels = self.labels.ravel()
+            gc = renderer.new_gc()
+            gc.set_clip_rectangle(self.axes.bbox)
+            try:
+                if labels.size <= self.vector_limit:
+                    self._draw_text(renderer, gc, centres, labels, cell_width)
+                else:
+                    self._draw_layer(renderer, gc, centres, labels, cell_width)
+            finally:
+                gc.restore()
+
+        def _draw_text(self, renderer, gc, centres, labels, cell_width):
+            prop = FontProperties(size=self.fontsize)
+            gc.set_foreground(matplotlib.rcParams['text.color'])
+            sizes = {label: renderer.get_text_width_height_descent(label, prop, ismath=False)
+                     for label in np.unique(labels)}
+            if max(width for width, _, _ in sizes.values()) > cell_width:
+                return
+            # Renderers that measure y from the top of the canvas expect flipped coordinates, as for Text
+            canvas_height = renderer.get_canvas_width_height()[1] if renderer.flipy() else None
+            for (x, y), label in zip(centres, labels):
+                width, height, descent = sizes[label]
+                baseline = y - height / 2 + descent
+                if canvas_height is not None:
+                    baseline = canvas_height - baseline
+                renderer.draw_text(gc, x - width / 2, baseline, label, prop, 0)
+
+        def _draw_layer(self, renderer, gc, centres, labels, cell_width):
+            # Rasterise each distinct label once, at the resolution the renderer draws images at
+            magnification = renderer.get_image_magnification()
+            font = get_font(findfont(FontProperties(size=self.fontsize)))
+            glyphs = {}
+            for label in np.unique(labels):
+                font.clear()
+                font.set_size(self.fontsize, renderer.points_to_pixels(72) * magnification)
+                font.set_text(label, 0)
+                font.draw_glyphs_to_bitmap(antialiased=matplotlib.rcParams['text.antialiased'])
+                glyphs[label] = np.asarray(font.get_image(), dtype=np.float32) / 255
+            if max(glyph.shape[1] for glyph in glyphs.values()) > cell_width * magnification:
+                return
+
+            # Stamp the labels into one alpha layer covering the axes, with row 0 at the top
+            left, bottom, width, height = self.axes.bbox.bounds
+            layer = np.zeros((int(np.ceil(height * magnification)), int(np.ceil(width * magnification))),
+                             dtype=np.float32)
+            columns = np.rint((centres[:, 0] - left) * magnification).astype(int)
+            rows = np.rint((bottom + height - centres[:, 1]) * magnification).astype(int)
+            for row, column, label in zip(rows, columns, labels):
+                glyph = glyphs[label]
+                top, start = row - glyph.shape[0] // 2, column - glyph.shape[1] // 2
+                glyph = glyph[max(-top, 0):, max(-start, 0):]
+                top, start = max(top, 0), max(start, 0)
+                target = layer[top:top + glyph.shape[0], start:start + glyph.shape[1]]
+                np.maximum(target, glyph[:target.shape[0], :target.shape[1]], out=target)
+
+            red, green, blue, alpha = to_rgba(matplotlib.rcParams['text.color'])
+            image = np.empty(layer.shape + (4,), dtype=np.uint8)
+            image[..., :3] = np.array([red, green, blue]) * 255
+            image[..., 3] = layer * alpha * 255
+            renderer.draw_image(gc, left, bottom, image[::-1])
+
+    _cell_labels_class = CellLabels
+    return CellLabels
+
+
+def __getattr__(name):
+    # Allow pylomap.CellLabels to be used as if it were defined at module level
+    if name == 'CellLabels':
+        return cell_labels_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class HeatmapPlot:
     """
     This class is used for creating a heatmap plot from the processed data.
     It provides methods to search for pathways, check user-specified pathways, and create the heatmap plot.
     """
 
-    def __init__(self, heatmap_data_object, all_pathways, function_dict, taxon_level=None):
+    def __init__(self, heatmap_data_object, all_pathways, function_dict, taxon_level=None, search_index=None,
+                 distance_backend=None, plot_cache=None):
         """
         Initialise the HeatmapPlot class.
 
         Args:
         heatmap_data_object (HeatmapData object): An object of the HeatmapData class.
-        all_pathways (dict): A dictionary of all pathways.
+        all_pathways (dict): A dictionary of all pathways, such as the PathwayTaxa view returned by Pathways.create.
         function_dict (DataFrame): A pandas DataFrame containing the function dictionary.
+        search_index (PathwaySearchIndex, optional): An index of function_dict to search. Default is None,
+                                                     in which case one is built on the first search.
+        distance_backend (callable, optional): Computes the distances between samples that they are clustered on,
+                                               given the samples x taxa data, and returns an object with a
+                                               linkage(method) method. For example BlockedAitchison, or
+                                               functools.partial(BlockedAitchison, projection=64) for approximate
+                                               distances. Default is None, in which case IncrementalAitchison is used.
+        plot_cache (PlotCache, optional): A cache of clusterings and figures, which may be shared with other
+                                          HeatmapPlot objects and runs. Default is None, in which case each
+                                          clustering is only reused by this object.
         """
         self.heatmap_data_object = heatmap_data_object
         self.heatmap_data = self.heatmap_data_object.process_heatmap_data(
@@ -501,6 +3139,11 @@ class HeatmapPlot:
         self.all_pathways = all_pathways
         self.function_dict = function_dict
         self.taxon_level = taxon_level
+        self.search_index = search_index
+        self.distance_backend = distance_backend
+        self.plot_cache = plot_cache
+        self._clusterings = {}
+        self._supports = {}
 
     def search_pathways(self, search_string):
         """
@@ -510,36 +3153,162 @@ class HeatmapPlot:
         search_string (str): The string to search for in the pathway descriptions.
 
         Returns:
-        (list): A list of pathways that match the search string.
+        (list): A list of pathways that match the search string.
+        """
+        if self.search_index is None:
+            self.search_index = PathwaySearchIndex(self.function_dict)
+        return self.search_index.search(search_string)
+
+    def check_user_pathways(self, user_pathways):
+        """
+        Checks if the user-specified pathways are a list, string, or None and processes them accordingly.
+
+        Args:
+        user_pathways (str/list/None): The user-specified pathways.
+
+        Returns:
+        (list): A list of user-specified pathways or None.
+
+        Raises:
+        TypeError: If user_pathways is not a string, list or None.
+        """
+        if isinstance(user_pathways, list):
+            return user_pathways
+        elif isinstance(user_pathways, str):
+            return self.search_pathways(user_pathways)
+        elif user_pathways is None:
+            return None
+        else:
+            raise TypeError(
+                'user_pathways must be either a string or a list (or None)')
+
+    def pathway_taxa(self, user_pathways, taxon_dict):
+        """
+        Finds the taxa associated with each of the user-specified pathways, which are coloured in the heatmap.
+
+        Args:
+        user_pathways (list/None): The user-specified pathways, as returned by check_user_pathways.
+        taxon_dict (DataFrame): A pandas DataFrame containing the taxon dictionary.
+
+        Returns:
+        (list or None): A list of taxon names for each pathway, or None if the heatmap has no row colours, because
+                        there are no pathways or its rows are taxon levels or pathways.
+        """
+        pathway_rows = isinstance(self.heatmap_data_object, PathwayHeatmapData)
+        if user_pathways is None or self.taxon_level is not None or pathway_rows:
+            return None
+        if isinstance(self.all_pathways, PathwayTaxa):
+            # Look up every pathway against the whole taxon dictionary in one sparse slice
+            membership = self.all_pathways.index.membership(
+                user_pathways, taxon_dict['Taxon ID'])
+            return [taxon_dict['Taxon'][row].tolist() for row in membership]
+        user_pathways_taxa = []
+        for pathway in user_pathways:
+            taxa_ids = self.all_pathways.get(pathway, [])
+            taxa_names = taxon_dict[taxon_dict['Taxon ID'].isin(
+                taxa_ids)]['Taxon'].tolist()
+            user_pathways_taxa.append(taxa_names)
+        return user_pathways_taxa
+
+    def clustering(self, threshold, top_n=None):
+        """
+        Filters the heatmap data by a threshold and clusters the remaining samples.
+
+        The result depends only on the threshold and top_n, so it is computed once for each and reused
+        by later plots of the same data, whatever their pathways. With a plot_cache, the linkage is also
+        reused by any other plot whose filter keeps the same data.
+
+        Args:
+        threshold (float): The threshold for filtering data.
+        top_n (int, optional): If given, only the top_n taxa with the highest abundance are kept. Default is None.
+
+        Returns:
+        tuple: The filtered data with its 'Taxa' column, the y tick labels, and the Aitchison
+               linkage of the samples. The filtered data must not be modified.
         """
-        matching_pathways = self.function_dict[self.function_dict['Pathway description'].str.contains(
-            search_string, case=False)]
-        return matching_pathways['Pathway'].tolist()
+        key = (threshold, top_n)
+        if key not in self._clusterings:
+            filtered_data, yticklabels = self._filter(threshold, top_n)
+            data = filtered_data.drop('Taxa', axis=1).values.T
+            with stage('clustering', rows=len(data), cached=False) as timer:
+                # Look the linkage up by a hash of the data it clusters
+                col_linkage, distances = None, None
+                if self.plot_cache is not None:
+                    metric = 'aitchison' if self.distance_backend is None else f'aitchison {self.distance_backend!r}'
+                    cache_key = PlotCache.key('clustering', metric, 'complete', data)
+                    col_linkage = self.plot_cache.get(cache_key)
+                    timer.update(cached=col_linkage is not None)
+                if col_linkage is None:
+                    # Cluster the samples on their Aitchison distances, computing the CLR once per sample.
+                    # The distances are kept so that samples can be appended without computing them again.
+                    distances = (self.distance_backend or IncrementalAitchison)(data)
+                    col_linkage = distances.linkage(method="complete")
+                    if self.plot_cache is not None:
+                        self.plot_cache.put(cache_key, col_linkage)
+            self._clusterings[key] = (filtered_data, yticklabels, col_linkage, distances)
+        return self._clusterings[key][:3]
+
+    def _filter(self, threshold, top_n=None):
+        # Compute the mask of the rows to keep once, then take both the data and its labels from it
+        mask = HeatmapQuery(threshold=threshold, top_n=top_n).taxon_mask(
+            self.heatmap_data.drop('Taxa', axis=1).to_numpy(dtype=float))
+        filtered_data = self.heatmap_data[mask].fillna(0)
+        # For yticklabels, split each string in 'Taxa' on "; " and take the rightmost substring
+        yticklabels = self.heatmap_data['Taxa'][mask].str.split("; ").str[-1]
+        return filtered_data, yticklabels
 
-    def check_user_pathways(self, user_pathways):
+    def append_samples(self, samples):
         """
-        Checks if the user-specified pathways are a list, string, or None and processes them accordingly.
+        Adds samples to the heatmap, such as those returned by AbundanceMatrix.append, and updates the
+        clusterings computed so far.
+
+        For each threshold whose filter keeps the same taxa as before, only the CLR of the new samples and
+        their distances to the others are computed, and the samples are linked again from the stored
+        distances. If the new samples bring other taxa above a threshold, the CLR of every sample changes,
+        so that clustering is dropped and computed again when it is next used, as are clusterings whose
+        distance backend cannot append samples and those taken from the plot_cache.
 
         Args:
-        user_pathways (str/list/None): The user-specified pathways.
+        samples (list): The Sample objects to add.
+        """
+        self.heatmap_data_object.samples = self.heatmap_data_object.samples + list(samples)
+        self.heatmap_data = self.heatmap_data_object.process_heatmap_data(self.taxon_level)
+        self._supports = {}
+
+        sample_names = [sample.sample_name for sample in samples]
+        clusterings, self._clusterings = self._clusterings, {}
+        for key, (old_data, _, _, distances) in clusterings.items():
+            filtered_data, yticklabels = self._filter(*key)
+            if hasattr(distances, 'append') and filtered_data['Taxa'].tolist() == old_data['Taxa'].tolist():
+                with stage('append_clustering', rows=len(sample_names)):
+                    distances.append(filtered_data[sample_names].values.T)
+                    col_linkage = distances.linkage(method="complete")
+                self._clusterings[key] = (filtered_data, yticklabels, col_linkage, distances)
+
+    def clade_support(self, threshold, bootstrap, top_n=None):
+        """
+        Estimates the support of each clade of the sample clustering at a threshold. See clade_support.
 
-        Returns:
-        (list): A list of user-specified pathways or None.
+        Args:
+        threshold (float): The threshold for filtering data.
+        bootstrap (int or dict): The number of bootstrap replicates, or the keyword arguments of clade_support,
+                                 e.g. {'replicates': 1000, 'resample': 'jackknife', 'seed': 0}.
+        top_n (int, optional): If given, only the top_n taxa with the highest abundance are kept. Default is None.
 
-        Raises:
-        TypeError: If user_pathways is not a string, list or None.
+        Returns:
+        support (numpy array): The support of the cluster formed by each row of the linkage matrix.
         """
-        if isinstance(user_pathways, list):
-            return user_pathways
-        elif isinstance(user_pathways, str):
-            return self.search_pathways(user_pathways)
-        elif user_pathways is None:
-            return None
-        else:
-            raise TypeError(
-                'user_pathways must be either a string or a list (or None)')
-
-    def heatmap_plot(self, user_pathways, threshold, taxon_dict):
+        options = bootstrap if isinstance(bootstrap, dict) else {'replicates': bootstrap}
+        key = (threshold, top_n, tuple(sorted(options.items())))
+        if key not in self._supports:
+            filtered_data, _, col_linkage = self.clustering(threshold, top_n)
+            self._supports[key] = clade_support(filtered_data.drop('Taxa', axis=1).values.T,
+                                                linkage_matrix=col_linkage, **options)
+        return self._supports[key]
+
+    @staged('heatmap_plot')
+    def heatmap_plot(self, user_pathways, threshold, taxon_dict, show=True, bootstrap=None, top_n=None, raster=False,
+                     max_pixels=None):
         """
         Creates a heatmap plot using seaborn, with user-specified pathways and a given threshold.
 
@@ -547,32 +3316,45 @@ class HeatmapPlot:
         user_pathways (str/list/None): The user-specified pathways.
         threshold (float): The threshold for filtering data.
         taxon_dict (DataFrame): A pandas DataFrame containing the taxon dictionary.
+        show (bool): Whether to display the plot with plt.show(). Default is True.
+        bootstrap (int or dict, optional): If given, the support of each sample cluster is estimated by
+                                           resampling the taxa, and shown as a percentage on the dendrogram.
+                                           Either the number of bootstrap replicates or the keyword arguments
+                                           of clade_support. Default is None.
+        top_n (int, optional): If given, only the top_n taxa with the highest abundance in any sample are shown.
+                               Default is None.
+        raster (bool): Whether to draw the heatmap cells as one image rather than as one vector polygon per cell, which
+                       keeps SVG and PDF files of large heatmaps small. The dendrogram, row colours, labels and
+                       colourbar are still drawn as vectors. Default is False.
+        max_pixels (int, optional): When raster is True, the largest number of pixels in the image. Larger heatmaps
+                                    are shrunk by averaging neighbouring cells (see downsample_matrix). Default is None,
+                                    in which case the size of the heatmap in pixels at the figure's dpi is used.
+
+        Returns:
+        g (seaborn.matrix.ClusterGrid): The clustermap, e.g. for saving with g.savefig.
 
         Raises:
         Exception: If there's an issue during the plotting process.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
         user_pathways = self.check_user_pathways(user_pathways)
-        # Filter data by threshold and fill NaNs
-        filtered_data = self.heatmap_data[(self.heatmap_data.drop(
-            'Taxa', axis=1) > threshold / 100).any(axis=1)].fillna(0)
+        # Filter data by threshold and cluster the samples, reusing the result of an earlier plot
+        filtered_data, yticklabels, col_linkage = self.clustering(threshold, top_n)
+        # The rows are pathways rather than taxa when plotting PathwayHeatmapData
+        pathway_rows = isinstance(self.heatmap_data_object, PathwayHeatmapData)
 
         # Identify microbes that are associated with the user-specified pathways
-        user_pathways_taxa = []
-        if user_pathways is not None and self.taxon_level is None:
-            for pathway in user_pathways:
-                if pathway in self.all_pathways:
-                    taxa_ids = self.all_pathways[pathway]
-                    taxa_names = taxon_dict[taxon_dict['Taxon ID'].isin(
-                        taxa_ids)]['Taxon'].tolist()
-                    user_pathways_taxa.append(taxa_names)
-
+        user_pathways_taxa = self.pathway_taxa(user_pathways, taxon_dict)
+        if user_pathways_taxa is not None:
             # Define colours for each pathway
             colors = sns.color_palette("pastel", len(
                 user_pathways))  # change palette if needed
             # filtered_data.iloc[:, 1:] *= 100
             # Create a DataFrame for row_colours
             row_colors = pd.DataFrame(index=filtered_data['Taxa'])
-            filtered_data.set_index('Taxa', inplace=True)
+            filtered_data = filtered_data.set_index('Taxa')
 
             # Map colours to taxa for each pathway
             for pathway, taxa, color in zip(user_pathways, user_pathways_taxa, colors):
@@ -580,24 +3362,34 @@ class HeatmapPlot:
                     dict([(taxon, color) for taxon in taxa]))
         else:
             row_colors = None
-            filtered_data.set_index('Taxa', inplace=True)
+            filtered_data = filtered_data.set_index('Taxa')
         # print(filtered_data.head(1))
-        # For yticklabels, split each string in 'Taxa' on "; " and take the rightmost substring
-        yticklabels = self.heatmap_data[(self.heatmap_data.drop(
-            'Taxa', axis=1) > threshold / 100).any(axis=1)].fillna(0).Taxa.str.split("; ").str[-1]
+
         # Create clustermap
-        g = sns.clustermap(data=filtered_data, cmap="Blues", metric=aitchison, method="complete",
+        g = sns.clustermap(data=filtered_data, cmap="Blues", col_linkage=col_linkage,
                            row_cluster=False, col_cluster=True, cbar_kws={'orientation': 'horizontal'},
                            yticklabels=yticklabels, row_colors=row_colors)
 
+        if raster:
+            self._draw_raster(g, max_pixels)
+
         column_order = g.dendrogram_col.reordered_ind
 
-        # Annotate heatmap with data values
-        filtered_data.iloc[:, 1:] *= 100
-        for i in range(filtered_data.shape[0]):
-            for j, j_new in enumerate(column_order):
-                g.ax_heatmap.text(j+0.5, i+0.5, '{:.1f}'.format(filtered_data.values[i, j_new]),
-                                  ha='center', va='center', fontsize=8)
+        if bootstrap:
+            # Label each cluster, other than the one of all samples, with its support at the top of its link.
+            # The dendrogram puts leaf i at x = 10 * i + 5 and each link at the middle of its two children.
+            support = self.clade_support(threshold, bootstrap, top_n)
+            x = np.empty(2 * len(column_order) - 1)
+            x[column_order] = 10 * np.arange(len(column_order)) + 5
+            for row, (a, b, height, _) in enumerate(col_linkage):
+                x[len(column_order) + row] = (x[int(a)] + x[int(b)]) / 2
+                if row < len(col_linkage) - 1:
+                    g.ax_col_dendrogram.text(x[len(column_order) + row], height, f'{support[row]:.0%}',
+                                             fontsize=7, ha='center', va='bottom')
+
+        # Annotate heatmap with data values, as percentages, using one artist for every cell
+        percentages = filtered_data.values[:, column_order].astype(float) * 100
+        g.ax_heatmap.add_artist(cell_labels_class()(percentages, fontsize=8))
 
         # Set colourbar position and title
         colorbar = g.ax_heatmap.collections[0].colorbar
@@ -611,12 +3403,138 @@ class HeatmapPlot:
         g.ax_heatmap.set_xlabel("Sample")
         g.ax_heatmap.yaxis.tick_right()
         g.ax_heatmap.yaxis.set_label_position("right")
-        g.ax_heatmap.set_ylabel("Taxon")
+        g.ax_heatmap.set_ylabel("Pathway" if pathway_rows else "Taxon")
         if row_colors is not None:
             g.ax_heatmap.annotate("Pathways", xy=(-0.0176*(
                 row_colors.shape[1]-3), 1.01), xycoords='axes fraction', va='bottom', ha='right', rotation='horizontal')
         # Display the plot
-        plt.show()
+        if show:
+            plt.show()
+        return g
+
+    def render(self, user_pathways, threshold, taxon_dict, file_format='png', **options):
+        """
+        Renders the heatmap to the contents of a file of the given format, without displaying it.
+
+        With a plot_cache, the figure is identified by a hash of the filtered data and its labels, the linkage,
+        the pathways and the taxa they colour, the options, the file format, and the matplotlib and seaborn
+        versions and resolution. A figure rendered before, by any plot sharing the cache, is returned without drawing it again.
+
+        Args:
+        user_pathways (str/list/None): The user-specified pathways.
+        threshold (float): The threshold for filtering data.
+        taxon_dict (DataFrame): A pandas DataFrame containing the taxon dictionary.
+        file_format (str): The file format, e.g. 'png', 'svg' or 'pdf'. Default is 'png'.
+        **options: The other keyword arguments of heatmap_plot, such as top_n or bootstrap.
+
+        Returns:
+        (bytes): The contents of the figure's file.
+        """
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+
+        user_pathways = self.check_user_pathways(user_pathways)
+        cache_key = None
+        if self.plot_cache is not None:
+            filtered_data, yticklabels, col_linkage = self.clustering(threshold, options.get('top_n'))
+            cache_key = PlotCache.key(
+                'figure', file_format, type(self.heatmap_data_object).__name__, self.taxon_level, filtered_data,
+                yticklabels, col_linkage, user_pathways, self.pathway_taxa(user_pathways, taxon_dict), options,
+                matplotlib.__version__, sns.__version__, plt.rcParams['figure.dpi'], plt.rcParams['savefig.dpi'])
+            figure_bytes = self.plot_cache.get(cache_key)
+            if figure_bytes is not None:
+                return figure_bytes
+
+        g = self.heatmap_plot(user_pathways, threshold, taxon_dict, show=False, **options)
+        buffer = io.BytesIO()
+        with stage('save_figure', format=file_format):
+            g.savefig(buffer, format=file_format)
+        plt.close(g.fig)
+        figure_bytes = buffer.getvalue()
+        if cache_key is not None:
+            self.plot_cache.put(cache_key, figure_bytes)
+        return figure_bytes
+
+    def export(self, path, threshold, file_format='parquet', user_pathways=None, top_n=None, chunk_rows=100000):
+        """
+        Writes the data behind the heatmap at a threshold, for use by other tools, in four tables:
+
+        - 'matrix': the filtered abundances, with the 'Taxa' column followed by one column per sample.
+        - 'sample_order': the samples in the order of the dendrogram's leaves, in a 'Sample' column.
+        - 'linkage': the linkage matrix of the sample clustering, in the columns 'first', 'second',
+          'distance' and 'size', as returned by scipy.cluster.hierarchy.linkage.
+        - 'incidence': the pathway incidence, as one ('Pathway', 'Taxon ID') row for each taxon of each pathway.
+
+        The tables are written by TableExport, chunk_rows rows at a time.
+
+        Args:
+        path (str): The directory to write the tables to, one file per table, or the HDF5 file to write them to.
+        threshold (float): The threshold for filtering data.
+        file_format (str): One of 'arrow', 'parquet', 'hdf5' or 'csv'. Default is 'parquet'.
+        user_pathways (str/list/None): The pathways whose taxa are written to the incidence table. Default is
+                                       None, in which case the taxa of every pathway are written.
+        top_n (int, optional): If given, only the top_n taxa with the highest abundance are kept. Default is None.
+        chunk_rows (int): The number of rows written at a time. Default is 100000.
+
+        Returns:
+        dict: The path written for each table.
+        """
+        from scipy.cluster.hierarchy import leaves_list
+
+        user_pathways = self.check_user_pathways(user_pathways)
+        filtered_data, _, col_linkage = self.clustering(threshold, top_n)
+        sample_names = filtered_data.columns[1:]
+
+        export = TableExport(path, file_format)
+        # Write at least one chunk of each table, so that an empty table still has its columns
+        tables = {
+            'matrix': (filtered_data.iloc[start:start + chunk_rows]
+                       for start in range(0, max(len(filtered_data), 1), chunk_rows)),
+            'sample_order': [pd.DataFrame({'Sample': sample_names[leaves_list(col_linkage)].astype(object)})],
+            'linkage': [pd.DataFrame(col_linkage, columns=['first', 'second', 'distance', 'size'])],
+            'incidence': self._incidence_chunks(user_pathways, chunk_rows),
+        }
+        return {name: export.write(name, chunks) for name, chunks in tables.items()}
+
+    def _incidence_chunks(self, user_pathways, chunk_rows):
+        # Yield the (pathway, taxon ID) pairs of the pathways in chunks of chunk_rows pairs
+        if isinstance(self.all_pathways, PathwayTaxa):
+            index = self.all_pathways.index
+            rows = np.arange(len(index.pathways))
+            if user_pathways is not None:
+                rows = index.pathways.get_indexer(user_pathways)
+                rows = rows[rows >= 0]
+            incidence = index.incidence[rows]
+            # Find the pathway of each pair in a chunk from the row pointers of the incidence matrix
+            for start in range(0, max(incidence.nnz, 1), chunk_rows):
+                pairs = np.arange(start, min(start + chunk_rows, incidence.nnz))
+                pathway_rows = rows[np.searchsorted(incidence.indptr, pairs, side='right') - 1]
+                yield pd.DataFrame({'Pathway': index.pathways[pathway_rows].astype(object),
+                                    'Taxon ID': index.taxon_ids[incidence.indices[pairs]]})
+            return
+
+        pathways = self.all_pathways.keys() if user_pathways is None else user_pathways
+        pairs = [(pathway, taxon_id) for pathway in pathways for taxon_id in self.all_pathways.get(pathway, [])]
+        for start in range(0, max(len(pairs), 1), chunk_rows):
+            yield pd.DataFrame(pairs[start:start + chunk_rows], columns=['Pathway', 'Taxon ID'])
+
+    def _draw_raster(self, g, max_pixels=None):
+        # Hide the QuadMesh drawn by seaborn and draw the same cells as one image in its place, with the
+        # mesh's colour map and normalisation so that the colourbar still applies
+        ax = g.ax_heatmap
+        mesh = ax.collections[0]
+        values = g.data2d.to_numpy(dtype=float)
+        if max_pixels is None:
+            max_pixels = max(1, int(ax.bbox.width * ax.bbox.height))
+        image = downsample_matrix(values, max_pixels)
+
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        mesh.set_visible(False)
+        ax.imshow(np.ma.masked_invalid(image), cmap=mesh.cmap, norm=mesh.norm, aspect='auto', interpolation='none',
+                  extent=(0, values.shape[1], values.shape[0], 0))
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
 
 
 class LatexTable:
@@ -624,45 +3542,318 @@ class LatexTable:
     This class is used to create a LaTeX formatted table from the function dictionary.
     """
 
-    def __init__(self, function_dict, user_pathways, heatmap_plot_instance):
+    def __init__(self, function_dict, user_pathways, heatmap_plot_instance=None, search_index=None):
         """
         Initialise the LatexTable class.
 
         Args:
         function_dict (DataFrame): A pandas DataFrame containing the function dictionary.
         user_pathways (str/list): A list of user-specified pathways or a string to search.
-        heatmap_plot_instance (HeatmapPlot): An instance of the HeatmapPlot class for searching pathways by string.
+        heatmap_plot_instance (HeatmapPlot, optional): An instance of the HeatmapPlot class for searching pathways by
+                                                       string. Default is None, in which case the table can be made
+                                                       without any sample data or plotting libraries.
+        search_index (PathwaySearchIndex, optional): An index of function_dict used to search pathways by string when
+                                                     no heatmap_plot_instance is given. Default is None.
+
+        Raises:
+        TypeError: If user_pathways is not a string, list or None.
         """
         self.function_dict = function_dict
         self.heatmap_plot_instance = heatmap_plot_instance
-        self.user_pathways = self.heatmap_plot_instance.check_user_pathways(
-            user_pathways)
+        if self.heatmap_plot_instance is not None:
+            self.user_pathways = self.heatmap_plot_instance.check_user_pathways(
+                user_pathways)
+        elif isinstance(user_pathways, str):
+            if search_index is None:
+                search_index = PathwaySearchIndex(function_dict)
+            self.user_pathways = search_index.search(user_pathways)
+        elif user_pathways is None or isinstance(user_pathways, list):
+            self.user_pathways = user_pathways
+        else:
+            raise TypeError(
+                'user_pathways must be either a string or a list (or None)')
 
+    @staged('latex_table')
     def create_table(self):
         """
         Generate a LaTeX table with the pathways specified by the user.
 
         The table includes all rows from the function dictionary that match the user-specified pathways.
-        The table is returned as a string in LaTeX table format.
+        The table is returned as a string in LaTeX table format, as written by write_table without longtable.
 
         Returns:
         (str): A string representing the LaTeX table.
         """
         if self.user_pathways is not None:
-            # Filter the function_dict to only include the user-specified pathways
-            function_dict_filtered = self.function_dict[self.function_dict['Pathway'].isin(
-                self.user_pathways)].reset_index(drop=True)
+            buffer = io.StringIO()
+            self.write_table(buffer, longtable=False)
+            return buffer.getvalue()
 
-            # Disable truncation
-            pd.options.display.max_colwidth = None
+    def write_table(self, file, longtable=True, escape=False, caption=None, label=None):
+        """
+        Writes a LaTeX table of the pathways specified by the user to a file, one row at a time.
+
+        Each value is written in full, and no pandas options are read or changed, so tables can be written from
+        several threads at once. A longtable breaks across pages, repeating its header on each, so it can list
+        thousands of pathways; it needs the longtable and booktabs packages.
+
+        Args:
+        file (str or file object): The path of the .tex file to write, or an open text file to write to.
+        longtable (bool): Whether to write a longtable rather than a tabular environment. Default is True.
+        escape (bool): Whether to escape the characters that LaTeX treats as special, such as & and _, in the
+                       pathways and their descriptions. Default is False, in which case they are written as they
+                       are, as create_table does, so that descriptions may contain LaTeX.
+        caption (str, optional): The caption of a longtable. Default is None.
+        label (str, optional): The label of a longtable, for references to it. Default is None.
+
+        Returns:
+        (int): The number of rows written, which is 0 if there are no user-specified pathways, in which case
+               nothing is written.
+        """
+        if self.user_pathways is None:
+            return 0
+        if isinstance(file, str):
+            with open(file, 'w') as f:
+                return self.write_table(f, longtable, escape, caption, label)
+
+        # Filter the function_dict to only include the user-specified pathways
+        function_dict_filtered = self.function_dict[self.function_dict['Pathway'].isin(self.user_pathways)]
+
+        # Numbers are aligned right and text left, as DataFrame.to_latex does
+        column_format = ''.join('r' if pd.api.types.is_numeric_dtype(dtype) else 'l'
+                                for dtype in function_dict_filtered.dtypes)
+        header = self._latex_row(function_dict_filtered.columns, escape)
+        environment = 'longtable' if longtable else 'tabular'
+        file.write(f'\\begin{{{environment}}}{{{column_format}}}\n')
+        if longtable:
+            # The first page's header, the header repeated on later pages, and the page footers
+            title = ([f'\\caption{{{caption}}}'] if caption is not None else []) + \
+                ([f'\\label{{{label}}}'] if label is not None else [])
+            if title:
+                file.write(' '.join(title) + ' \\\\\n')
+            file.write(f'\\toprule\n{header}\\midrule\n\\endfirsthead\n')
+            if caption is not None:
+                file.write(f'\\caption[]{{{caption}}} \\\\\n')
+            file.write(f'\\toprule\n{header}\\midrule\n\\endhead\n\\midrule\n'
+                       f'\\multicolumn{{{len(column_format)}}}{{r}}{{Continued on next page}} \\\\\n'
+                       f'\\midrule\n\\endfoot\n\\bottomrule\n\\endlastfoot\n')
+        else:
+            file.write(f'\\toprule\n{header}\\midrule\n')
+
+        # Write the rows as they are formatted, rather than building the whole table in memory
+        rows = 0
+        for row in function_dict_filtered.itertuples(index=False, name=None):
+            file.write(self._latex_row(row, escape))
+            rows += 1
+        if not longtable:
+            file.write('\\bottomrule\n')
+        file.write(f'\\end{{{environment}}}\n')
+        return rows
+
+    @staticmethod
+    def _latex_row(values, escape):
+        cells = ('NaN' if pd.isna(value) else str(value) for value in values)
+        if escape:
+            cells = (cell.translate(LATEX_ESCAPES) for cell in cells)
+        return ' & '.join(cells) + ' \\\\\n'
+
+
+class AnalysisSession:
+    """
+    AnalysisSession Class.
+
+    This class reads and indexes the data files once, and then runs any number of heatmap jobs
+    against them. Jobs that plot the same samples at the same taxon level share one HeatmapPlot,
+    so its heatmap data, and the filtered data and sample clustering for each threshold, are only
+    computed by the first of those jobs.
+
+    Attributes
+    ----------
+    all_sample_data : pandas.DataFrame or list
+        The data containing all sample information, or the data of each sample data file.
+    taxon_dict : pandas.DataFrame
+        The dictionary mapping taxa to their IDs.
+    function_dict : pandas.DataFrame
+        The function dictionary.
+    parent : pandas.DataFrame or PathwayIndex
+        The parent data, or its PathwayIndex if it was read in chunks.
+    samples : list
+        A Sample object for every sample in the data.
+    all_pathways : PathwayTaxa
+        The taxon IDs of every pathway.
+    search_index : PathwaySearchIndex
+        The index used to search the pathway descriptions.
+    distance_backend : callable or None
+        The distance backend of every HeatmapPlot.
+    plot_cache : PlotCache or None
+        The cache of clusterings and figures shared by every HeatmapPlot.
+    """
+
+    def __init__(self, all_sample_data, taxon_dict, function_dict, parent, cache=None, max_plots=32,
+                 parent_max_bytes=None, distance_backend=None, plot_cache=None, parallel=None):
+        """
+        Initialise the AnalysisSession class, reading every data file.
+
+        Args:
+        all_sample_data (str or list): File path for all sample data, or a list of the file paths of several sample
+                                       data files to be merged. See get_data.
+        taxon_dict (str): File path for the taxon dictionary.
+        function_dict (str): File path for the function dictionary.
+        parent (str): File path for the parent file.
+        cache (IngestCache, optional): A cache of previously read files. Default is None.
+        max_plots (int): The number of HeatmapPlot objects kept for reuse by later jobs. Default is 32.
+        parent_max_bytes (int, optional): If given, the parent file is read in chunks using at most this much
+                                          memory. See get_data. Default is None.
+        distance_backend (callable, optional): The distance backend of every HeatmapPlot, such as BlockedAitchison
+                                               for large cohorts. See HeatmapPlot. Default is None.
+        plot_cache (PlotCache, optional): A cache of clusterings and figures, e.g. one with a cache_dir so that jobs
+                                          run again are not clustered or drawn again. Default is None.
+        parallel (str, optional): 'threads' or 'processes' to read the data files at the same time. See get_data.
+                                  Default is None, in which case they are read one after another.
+        """
+        self.all_sample_data, self.taxon_dict, self.function_dict, self.parent = get_data(
+            all_sample_data, taxon_dict, function_dict, parent, cache, parent_max_bytes, parallel=parallel)
+        self.samples, self.all_pathways = create_samples_and_pathways(
+            self.all_sample_data, self.taxon_dict, self.parent, None)
+        self.search_index = PathwaySearchIndex(self.function_dict)
+        self.distance_backend = distance_backend
+        self.plot_cache = plot_cache
+        self._plots = LRUCache(max_plots)
+
+    def heatmap(self, sample_list=None, taxon_level=None, rows='taxa'):
+        """
+        Returns the HeatmapPlot of some samples at a taxon level, creating it on first use.
+
+        Args:
+        sample_list (list, optional): The names of the samples to plot. Default is None, in which case every
+                                      sample is plotted.
+        taxon_level (str or None): The level at which to group taxa. If None, no grouping is done.
+        rows (str): 'taxa' to plot the abundance of each taxon, or 'pathways' to plot the abundance of each
+                    pathway (see PathwayHeatmapData). Default is 'taxa'.
+
+        Returns:
+        (HeatmapPlot): The heatmap plot, shared with every other job for the same samples, taxon level and rows.
+
+        Raises:
+        ValueError: If a sample is not in the data, or taxon_level or rows is not valid.
+        """
+        if rows not in ('taxa', 'pathways'):
+            raise ValueError("rows must be either 'taxa' or 'pathways'")
+        key = (None if sample_list is None else tuple(sample_list), taxon_level, rows)
+        heatmap_plot = self._plots.get(key)
+        if heatmap_plot is None:
+            samples = select_samples(self.samples, sample_list)
+            if rows == 'pathways':
+                heatmap_data = PathwayHeatmapData(self.all_pathways.index, samples)
+            else:
+                heatmap_data = HeatmapData(samples)
+            heatmap_plot = HeatmapPlot(heatmap_data, self.all_pathways, self.function_dict,
+                                       taxon_level, self.search_index, self.distance_backend, self.plot_cache)
+            self._plots.put(key, heatmap_plot)
+        return heatmap_plot
+
+    def append_samples(self, all_sample_data, cache=None):
+        """
+        Reads a sample data file of new samples, such as a new sequencing batch, and adds them to the session.
+
+        The new samples are added as columns of the existing abundance matrix, so the other data files are not
+        read again and the existing samples and pathways are kept. Heatmaps of every sample are updated
+        incrementally (see HeatmapPlot.append_samples), and heatmaps of chosen samples are unchanged.
+        all_sample_data keeps the data of the files read before.
 
-            # Generate the LaTeX table and return it
-            latex_table = function_dict_filtered.to_latex(index=False)
+        Args:
+        all_sample_data (str): File path for the new sample data.
+        cache (IngestCache, optional): A cache of previously read files. Default is None.
+
+        Returns:
+        list: The Sample objects of the new samples.
+
+        Raises:
+        ValueError: If a sample is already in the session.
+        """
+        data = ReadDataFiles(all_sample_data, None, None, None)
+        if cache is None:
+            new_sample_data = data.read_all_sample_data()
+        else:
+            new_sample_data = cache.load('all_sample_data', data.all_sample_data_path, data.read_all_sample_data)
+
+        new_samples = self.samples[0].matrix.append(new_sample_data, self.taxon_dict)
+        self.samples = self.samples + new_samples
+        for (sample_list, _, _), heatmap_plot in self._plots.items():
+            if sample_list is None:
+                heatmap_plot.append_samples(new_samples)
+        return new_samples
+
+    def run_job(self, spec, output_dir=None, file_format='png', show=False):
+        """
+        Plots the heatmap described by one job, and optionally writes or prints its LaTeX table.
+
+        Args:
+        spec (dict): The job. It may contain 'name' (the output file name without extension), 'user_pathways',
+                     'threshold', 'taxon_level', 'sample_list', 'rows', 'format', 'print_table', 'longtable',
+                     'export', and the keys in HEATMAP_PLOT_OPTIONS, as for plot_heatmaps_batch.
+        output_dir (str, optional): The directory to write the figure, table and exported data to (see
+                                    write_job_files). Default is None, in which case nothing is written, and the
+                                    table is printed.
+        file_format (str): The default file format, e.g. 'png', 'svg' or 'pdf'. Default is 'png'.
+        show (bool): Whether to display the plot with plt.show(). Default is False.
+
+        Returns:
+        dict: The 'name' and 'path' of the figure (None if it was not saved), the wall time taken in 'seconds',
+              and an 'error' message if the job failed (otherwise None).
+        """
+        import matplotlib.pyplot as plt
+
+        name = spec.get('name', 'heatmap')
+        file_format = spec.get('format', file_format)
+        record = {'name': name, 'path': None, 'seconds': None, 'error': None}
+        start = time.perf_counter()
+        try:
+            heatmap_plot = self.heatmap(spec.get('sample_list'), spec.get('taxon_level'), spec.get('rows', 'taxa'))
+            options = {key: spec[key] for key in HEATMAP_PLOT_OPTIONS if key in spec}
+            if output_dir is not None:
+                os.makedirs(output_dir, exist_ok=True)
+                record['path'] = os.path.join(output_dir, f'{name}.{file_format}')
+            if output_dir is not None and not show:
+                # Render the file's contents, which the plot cache may hold from an earlier job or run
+                figure_bytes = heatmap_plot.render(spec.get('user_pathways'), spec.get('threshold', 0),
+                                                   self.taxon_dict, file_format, **options)
+                with open(record['path'], 'wb') as f:
+                    f.write(figure_bytes)
+            else:
+                g = heatmap_plot.heatmap_plot(spec.get('user_pathways'), spec.get('threshold', 0),
+                                              self.taxon_dict, show=show, **options)
+                if output_dir is not None:
+                    with stage('save_figure', format=file_format):
+                        g.savefig(record['path'], format=file_format)
+                plt.close(g.fig)
+
+            if output_dir is not None:
+                write_job_files(heatmap_plot, self.function_dict, spec, output_dir, name)
+            elif spec.get('print_table'):
+                table = LatexTable(self.function_dict, spec.get('user_pathways'), heatmap_plot).create_table()
+                if table is not None:
+                    print(table)
+        except Exception as error:  # One failed job should not stop the rest of the job file
+            record['error'] = f'{type(error).__name__}: {error}'
+        record['seconds'] = time.perf_counter() - start
+        return record
+
+    def run_jobs(self, specs, output_dir=None, file_format='png', show=False):
+        """
+        Runs a list of jobs in order. See run_job.
 
-            # Restore previous max_colwidth value
-            pd.options.display.max_colwidth = 50
+        Args:
+        specs (list): The jobs. A job without a 'name' is named after its position in the list.
+        output_dir (str, optional): The directory to write the figures and tables to. Default is None.
+        file_format (str): The default file format. Default is 'png'.
+        show (bool): Whether to display each plot. Default is False.
 
-            return latex_table
+        Returns:
+        list: One record per job, in order, as returned by run_job.
+        """
+        return [self.run_job({'name': f'heatmap_{number}', **spec}, output_dir, file_format, show)
+                for number, spec in enumerate(specs)]
 
 
 def aitchison(u, v):
@@ -681,53 +3872,417 @@ def aitchison(u, v):
     Returns:
     dist (float): Aitchison distance between u and v.
     """
-    u[u == 0] = 0.000000001  # Replace 0s with small finite numbers
-    v[v == 0] = 0.000000001
+    from scipy.spatial.distance import euclidean
+    from skbio.stats.composition import clr
+
+    # Replace 0s with small finite numbers, without modifying the caller's arrays
+    u = np.where(u == 0, AITCHISON_ZERO, u)
+    v = np.where(v == 0, AITCHISON_ZERO, v)
     dist = euclidean(clr(u), clr(v))
     return dist
 
 
-def get_data(all_sample_data, taxon_dict, function_dict, parent):
+def clr_matrix(data):
+    """
+    Applies the zero replacement and centred log-ratio transformation used by aitchison()
+    to every row of a matrix at once.
+
+    Args:
+    data (array-like): A 2D array with one composition (e.g. one sample) per row.
+
+    Returns:
+    clr_data (numpy array): A new float array of the same shape containing the CLR of each row.
+    The input is never modified.
+    """
+    clr_data = np.array(data, dtype=float)  # Always copy so the input is left untouched
+    clr_data[clr_data == 0] = AITCHISON_ZERO
+    np.log(clr_data, out=clr_data)
+    clr_data -= clr_data.mean(axis=1, keepdims=True)
+    return clr_data
+
+
+def aitchison_distances(data):
+    """
+    Computes the condensed Aitchison distance matrix between the rows of a matrix.
+
+    The CLR transformation is applied once per row and the pairwise distances are then computed
+    with a vectorised Euclidean pdist, which gives the same result as calling aitchison() on
+    every pair of rows.
+
+    Args:
+    data (array-like): A 2D array with one composition (e.g. one sample) per row.
+
+    Returns:
+    distances (numpy array): The condensed distance matrix, in the order used by scipy's pdist.
+    """
+    from scipy.spatial.distance import pdist
+
+    return pdist(clr_matrix(data), metric='euclidean')
+
+
+@staged('clustering', rows=lambda linkage_matrix: len(linkage_matrix) + 1)
+def aitchison_linkage(data, method='complete'):
+    """
+    Computes a hierarchical clustering linkage of the rows of a matrix using Aitchison distances.
+
+    The result can be passed directly to seaborn's clustermap as row_linkage or col_linkage.
+
+    Args:
+    data (array-like): A 2D array with one composition (e.g. one sample) per row.
+    method (str): The scipy linkage method. Default is 'complete'.
+
+    Returns:
+    linkage_matrix (numpy array): The scipy linkage matrix.
+    """
+    from scipy.cluster.hierarchy import linkage
+
+    return linkage(aitchison_distances(data), method=method)
+
+
+def linkage_clades(linkage_matrix):
+    """
+    Lists the clades of a hierarchical clustering, one per row of its linkage matrix.
+
+    Args:
+    linkage_matrix (numpy array): A scipy linkage matrix of n observations.
+
+    Returns:
+    clades (list): For each row of the linkage matrix, the observations in the cluster it forms, as an
+    integer with bit i set for observation i.
+    """
+    n = len(linkage_matrix) + 1
+    members = [1 << i for i in range(n)]
+    for a, b in linkage_matrix[:, :2].astype(int):
+        members.append(members[a] | members[b])
+    return members[n:]
+
+
+def resampled_distances(clr_data, weights):
+    """
+    Computes the condensed Aitchison distances between the rows of a CLR matrix after its columns
+    (e.g. taxa) have been resampled.
+
+    Resampling column k weights[k] times and taking the CLR of the resampled compositions gives
+    squared distances of sum(w * dL**2) - (sum(w * dL))**2 / sum(w), where dL is the difference of
+    two rows of clr_data. This is computed for all pairs at once from one weighted Gram matrix, so
+    the CLR is never recomputed for a resample.
+
+    Args:
+    clr_data (numpy array): The CLR of every row, as returned by clr_matrix.
+    weights (numpy array): The number of times each column is drawn.
+
+    Returns:
+    distances (numpy array): The condensed distance matrix, in the order used by scipy's pdist.
+    """
+    from scipy.spatial.distance import squareform
+
+    # Columns that were not drawn do not contribute, so leave them out of the products
+    drawn = np.flatnonzero(weights)
+    clr_drawn, drawn_weights = clr_data[:, drawn], weights[drawn].astype(float)
+    gram = (clr_drawn * drawn_weights) @ clr_drawn.T
+    sums = clr_drawn @ drawn_weights
+    squared = np.diag(gram)
+    squared = squared[:, None] + squared[None, :] - 2 * gram
+    squared -= (sums[:, None] - sums[None, :]) ** 2 / drawn_weights.sum()
+    np.maximum(squared, 0, out=squared)  # Rounding can leave tiny negative values
+    return np.sqrt(squareform(squared, checks=False))
+
+
+# The data shared by the worker processes of clade_support. As for plot_heatmaps_batch, it is inherited
+# when the workers are forked and otherwise sent once to each worker by its initialiser.
+_stability_data = None
+
+
+def _init_stability_worker(data):
+    global _stability_data
+    if data is not None:
+        _stability_data = data
+
+
+def _count_clade_support(seeds):
+    """
+    Reclusters one resample per seed and counts how many times each reference clade is found.
+    """
+    from scipy.cluster.hierarchy import linkage
+
+    clr_data, clades, method, resample, fraction = _stability_data
+    n_columns = clr_data.shape[1]
+    counts = np.zeros(len(clades), dtype=np.int64)
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        if resample == 'bootstrap':
+            # Draw as many columns as there are, with replacement
+            weights = np.bincount(rng.integers(0, n_columns, n_columns), minlength=n_columns)
+        else:
+            # Keep a fraction of the columns, without replacement
+            weights = np.zeros(n_columns, dtype=np.int64)
+            weights[rng.choice(n_columns, max(1, round(n_columns * fraction)), replace=False)] = 1
+        found = set(linkage_clades(linkage(resampled_distances(clr_data, weights), method=method)))
+        counts += [clade in found for clade in clades]
+    return counts
+
+
+@staged('clade_support')
+def clade_support(data, replicates=1000, method='complete', resample='bootstrap', jackknife_fraction=0.5,
+                  seed=None, processes=None, linkage_matrix=None):
+    """
+    Estimates how stable the clusters of an Aitchison hierarchical clustering are, by resampling the
+    columns (e.g. taxa) of the data, reclustering, and counting how often each clade is found again.
+
+    The CLR is computed once and shared by every resample, whose distances are computed by
+    resampled_distances. Each resample draws from its own random stream, spawned from one seed, so the
+    result depends only on the seed and not on the number of processes.
+
+    Args:
+    data (array-like): A 2D array with one composition (e.g. one sample) per row.
+    replicates (int): The number of resamples. Default is 1000.
+    method (str): The scipy linkage method. Default is 'complete'.
+    resample (str): Either 'bootstrap', which draws as many columns as there are with replacement, or
+                    'jackknife', which keeps jackknife_fraction of the columns. Default is 'bootstrap'.
+    jackknife_fraction (float): The fraction of columns kept by each jackknife resample. Default is 0.5.
+    seed (int or numpy.random.SeedSequence, optional): The seed of the random streams. Default is None,
+                                                        in which case fresh entropy is used.
+    processes (int, optional): The number of worker processes. Default is None, in which case the number
+                               of CPUs is used. If 1, or if called from a pool worker, the resamples
+                               are run in the current process.
+    linkage_matrix (numpy array, optional): The clustering whose clades are tested. Default is None, in
+                                            which case it is computed with aitchison_linkage.
+
+    Returns:
+    support (numpy array): For each row of the linkage matrix, the fraction of resamples in which the
+    cluster formed by that row was found.
+
+    Raises:
+    ValueError: If resample is not 'bootstrap' or 'jackknife', or replicates is less than 1.
+    """
+    global _stability_data
+    if resample not in ('bootstrap', 'jackknife'):
+        raise ValueError("resample must be either 'bootstrap' or 'jackknife'")
+    if replicates < 1:
+        raise ValueError('replicates must be at least 1')
+
+    clr_data = clr_matrix(data)
+    if linkage_matrix is None:
+        linkage_matrix = aitchison_linkage(data, method=method)
+    data = (clr_data, linkage_clades(linkage_matrix), method, resample, jackknife_fraction)
+
+    # Give every resample its own stream, and split them into a few chunks per process
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(replicates)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    chunk_size = max(1, -(-replicates // (4 * processes)))
+    chunks = [seeds[i:i + chunk_size] for i in range(0, replicates, chunk_size)]
+
+    # Pool workers, e.g. those of plot_heatmaps_batch, cannot start processes of their own
+    if processes == 1 or multiprocessing.current_process().daemon:
+        _stability_data = data
+        try:
+            counts = [_count_clade_support(chunk) for chunk in chunks]
+        finally:
+            _stability_data = None
+    else:
+        context = multiprocessing.get_context()
+        forked = context.get_start_method() == 'fork'
+        if forked:
+            _stability_data = data  # Inherited by the forked workers without being copied or pickled
+        try:
+            with context.Pool(processes, initializer=_init_stability_worker,
+                              initargs=(None if forked else data,)) as pool:
+                counts = pool.map(_count_clade_support, chunks)
+        finally:
+            _stability_data = None
+    return np.sum(counts, axis=0) / replicates
+
+
+def downsample_matrix(values, max_pixels):
+    """
+    Shrinks a matrix to at most max_pixels cells by averaging blocks of neighbouring cells, ignoring NaNs.
+
+    The longer side is shrunk first, so a matrix of a few taxa and many samples keeps one row per taxon
+    for as long as possible.
+
+    Args:
+    values (numpy array): The matrix.
+    max_pixels (int): The largest number of cells in the result.
+
+    Returns:
+    (numpy array): The matrix itself if it is small enough, otherwise the mean of each block of cells,
+                   which is NaN where every cell of the block is NaN.
+    """
+    n_rows, n_columns = values.shape
+    row_factor, column_factor = 1, 1
+    while -(-n_rows // row_factor) * -(-n_columns // column_factor) > max_pixels:
+        if -(-n_rows // row_factor) >= -(-n_columns // column_factor):
+            row_factor += 1
+        else:
+            column_factor += 1
+    if row_factor == column_factor == 1:
+        return values
+
+    # Pad the matrix with NaNs to whole blocks, then average the numbers in each block
+    padded = np.full((-(-n_rows // row_factor) * row_factor, -(-n_columns // column_factor) * column_factor), np.nan)
+    padded[:n_rows, :n_columns] = values
+    blocks = padded.reshape(padded.shape[0] // row_factor, row_factor, padded.shape[1] // column_factor, column_factor)
+    counts = np.count_nonzero(~np.isnan(blocks), axis=(1, 3))
+    sums = np.nansum(blocks, axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+@staged('get_data')
+def get_data(all_sample_data, taxon_dict, function_dict, parent, cache=None, parent_max_bytes=None, query=None,
+             parallel=None):
     """
     Function to read in all data files required for processing.
 
     Args:
-    all_sample_data (str): File path for all sample data.
+    all_sample_data (str or list): File path for all sample data, or for a BIOM table (.biom), or a list of the file
+                                   paths of several sample data files, such as the exports of different sequencing
+                                   runs, to be merged.
     taxon_dict (str): File path for the taxon dictionary.
     function_dict (str): File path for the function dictionary.
     parent (str): File path for the parent file.
+    cache (IngestCache, optional): A cache of previously read files. If given, unchanged files are
+                                   loaded from the cache instead of being parsed again. Default is None.
+    parent_max_bytes (int, optional): If given, the parent file is read in chunks by ReadDataFiles.read_parent_index
+                                      using at most this much memory, and a PathwayIndex is returned in place of the
+                                      parent data. The index is not cached. Default is None.
+    query (HeatmapQuery, optional): If given, only the samples and taxa of the query are read from the sample data
+                                    file, or only its samples from each of several files. With a cache, the whole
+                                    file is cached instead. Either way, the query is also given to
+                                    create_samples_and_pathways, which applies the rest of it. Default is None.
+    parallel (str, optional): 'threads' to read the files at the same time in a pool of threads, one per file, or
+                              'processes' to parse them in a pool of worker processes, which avoids the GIL but
+                              copies each file's data back to this process. Stages measured in worker processes
+                              are not passed to this process's stage hooks. The peak memory of readers that run
+                              at the same time in threads may include that of the others, but get_data's own
+                              peak is that of the whole load, as when the files are read one after another (see
+                              StageTimer). Default is None, in which case the files are read one after another.
+                              See _load_files.
 
     Returns:
-    tuple: A tuple containing the loaded all sample data, taxon dictionary, function dictionary, and parent data.
+    tuple: A tuple containing the loaded all sample data (a list of the data of each file if all_sample_data is a
+           list), taxon dictionary, function dictionary, and parent data.
+
+    Raises:
+    ValueError: If parallel is not None, 'threads' or 'processes'. Errors reading the files are raised as they are by
+                the ReadDataFiles readers.
     """
-    data = ReadDataFiles(all_sample_data, taxon_dict, function_dict, parent)
-    all_sample_data = data.read_all_sample_data()
-    taxon_dict = data.read_taxon_dict()
-    parent = data.read_parent()
-    function_dict = data.read_function_dict()
+    sample_paths = all_sample_data if isinstance(all_sample_data, list) else [all_sample_data]
+    sample_readers = [ReadDataFiles(path, None, None, None) for path in sample_paths]
+    data = ReadDataFiles(sample_paths[0], taxon_dict, function_dict, parent)
+    if cache is not None:
+        query = None  # The whole sample data file is cached
+    elif query is not None and len(sample_readers) > 1:
+        # Filtering each file's taxa would leave out their abundances in the files where they are below
+        # the threshold, so only the query's samples are selected, and the taxa are filtered on merging
+        query = HeatmapQuery(query.sample_list)
+
+    # The files, as (kind, path, reader), in the order in which they are read one after another
+    files = [('all_sample_data', reader.all_sample_data_path,
+              functools.partial(reader.read_all_sample_data, query=query)) for reader in sample_readers]
+    files.append(('taxon_dict', data.taxon_dict_path, data.read_taxon_dict))
+    if parent_max_bytes is None:
+        files.append(('parent', data.parent_path, data.read_parent))
+    files.append(('function_dict', data.function_dict_path, data.read_function_dict))
+    if parent_max_bytes is not None:
+        files.append((None, data.parent_path, functools.partial(data.read_parent_index, max_bytes=parent_max_bytes)))
+
+    loaded = _load_files(files, cache, parallel)
+    sample_data, taxon_dict = loaded[:len(sample_readers)], loaded[len(sample_readers)]
+    if parent_max_bytes is None:
+        parent, function_dict = loaded[-2:]
+    else:
+        function_dict, parent = loaded[-2:]
+    all_sample_data = sample_data if isinstance(all_sample_data, list) else sample_data[0]
     return all_sample_data, taxon_dict, function_dict, parent
 
 
-def create_samples_and_pathways(all_sample_data, taxon_dict, parent, sample_list):
+def _load_files(files, cache=None, parallel=None):
+    """
+    Loads files with their readers, through a cache if one is given, one after another or at the same time.
+
+    When the files are loaded at the same time, each is looked up in the cache in its own thread, and read in that
+    thread or, with parallel='processes', in a worker process. Errors are raised as if the files had been loaded one
+    after another: once every file has been loaded or has failed, the error of the first file in order that failed
+    is raised, with its own exception type.
+
+    Args:
+    files (list): The files, as (kind, path, reader) tuples. The reader is a function with no arguments that reads
+                  and preprocesses the file, and must be picklable with parallel='processes'. A file whose kind is
+                  None is not cached.
+    cache (IngestCache, optional): A cache of previously read files. Default is None.
+    parallel (str, optional): None, 'threads' or 'processes'. See get_data. Default is None.
+
+    Returns:
+    list: The data of each file, in order.
+
+    Raises:
+    ValueError: If parallel is not None, 'threads' or 'processes'.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    if parallel not in (None, 'threads', 'processes'):
+        raise ValueError("parallel must be None, 'threads' or 'processes'")
+
+    def load(kind, path, reader):
+        if cache is None or kind is None:
+            return reader()
+        return cache.load(kind, path, reader)
+
+    if parallel is None or len(files) < 2:
+        return [load(*file) for file in files]
+
+    # Pool workers, e.g. those of plot_heatmaps_batch, cannot start processes of their own
+    processes = None
+    if parallel == 'processes' and not multiprocessing.current_process().daemon:
+        processes = ProcessPoolExecutor(len(files), mp_context=multiprocessing.get_context())
+        files = [(kind, path, functools.partial(_run_in_pool, processes, reader)) for kind, path, reader in files]
+    try:
+        # The threads are all joined before the first error in order is raised
+        with ThreadPoolExecutor(len(files)) as threads:
+            futures = [threads.submit(load, *file) for file in files]
+        return [future.result() for future in futures]
+    finally:
+        if processes is not None:
+            processes.shutdown()
+
+
+def _run_in_pool(pool, function):
+    # Runs a function in a pool and waits for its result, from one of the threads of _load_files
+    return pool.submit(function).result()
+
+
+def create_samples_and_pathways(all_sample_data, taxon_dict, parent, sample_list, query=None):
     """
     Function to create samples and pathways.
 
     Args:
-    all_sample_data (DataFrame): DataFrame containing all sample data.
+    all_sample_data (DataFrame or list): DataFrame containing all sample data, or a list of the DataFrames of several
+                                         sample data files, which are merged on their taxa.
     taxon_dict (DataFrame): DataFrame containing the taxon dictionary.
-    parent (DataFrame): DataFrame containing the parent data.
+    parent (DataFrame or PathwayIndex): DataFrame containing the parent data, or its PathwayIndex.
     sample_list (list): A list of sample names to include.
+    query (HeatmapQuery, optional): If given, only the samples of the query (when sample_list is None) and the taxa
+                                    that pass its threshold and top_n limit are included. Default is None.
 
     Returns:
     tuple: A tuple containing a list of created Sample objects and a dictionary of all pathways.
     """
     samples = CreateSamples(all_sample_data, taxon_dict,
-                            parent).create(sample_list)
+                            parent).create(sample_list, query)
     all_pathways = Pathways(parent).create()
     return samples, all_pathways
 
 
-def plot_heatmap(samples, all_pathways, function_dict, taxon_dict, user_pathways, print_table, threshold, taxon_level=None):
+# The clusterings shared by calls of plot_heatmap that are given no other plot cache
+_plot_heatmap_cache = PlotCache()
+
+
+def plot_heatmap(samples, all_pathways, function_dict, taxon_dict, user_pathways, print_table, threshold, taxon_level=None,
+                 search_index=None, top_n=None, plot_cache=None):
     """
     Function to create and plot a heatmap, and optionally print a LaTeX table of the pathways.
 
@@ -741,62 +4296,282 @@ def plot_heatmap(samples, all_pathways, function_dict, taxon_dict, user_pathways
     threshold (int): The threshold value for percent abundance.
     taxon_level (str or None): The level at which to group taxa. If None, no grouping is done. 
                                Can be 'domain', 'phylum', 'class', 'order', 'family', or 'genus'.
+    search_index (PathwaySearchIndex, optional): An index of function_dict, shared by the heatmap and the LaTeX
+                                                 table and reusable between calls. Default is None.
+    top_n (int, optional): If given, only the top_n taxa with the highest abundance are shown. Default is None.
+    plot_cache (PlotCache, optional): A cache of sample clusterings, so that a call whose filter keeps the same data
+                                      as an earlier one, e.g. one that changes only user_pathways or print_table,
+                                      does not cluster the samples again. Default is None, in which case a cache
+                                      shared by every call is used.
 
     Returns:
     None
     """
     heatmap_data_object = HeatmapData(samples)
     heatmap_plot = HeatmapPlot(
-        heatmap_data_object, all_pathways, function_dict, taxon_level)
-    heatmap_plot.heatmap_plot(user_pathways, threshold, taxon_dict)
+        heatmap_data_object, all_pathways, function_dict, taxon_level, search_index,
+        plot_cache=_plot_heatmap_cache if plot_cache is None else plot_cache)
+    heatmap_plot.heatmap_plot(user_pathways, threshold, taxon_dict, top_n=top_n)
     if print_table:
         print(LatexTable(function_dict, user_pathways, heatmap_plot).create_table())
 
 
-def main():
+def select_samples(samples, sample_list):
     """
-    The main function of the script which runs the entire data processing, plotting, and printing process.
+    Function to select samples by name, in the order given.
 
     Args:
-    None
+    samples (list): A list of Sample objects.
+    sample_list (list or None): The names of the samples to select. If None, every sample is selected.
 
     Returns:
-    None
+    list: The selected Sample objects.
+
+    Raises:
+    ValueError: If a name in sample_list is not the name of any of the samples.
+    """
+    if sample_list is None:
+        return samples
+    samples_by_name = {sample.sample_name: sample for sample in samples}
+    missing = [sample for sample in sample_list if sample not in samples_by_name]
+    if missing:
+        raise ValueError(f"No data found for sample: {missing[0]}")
+    return [samples_by_name[sample] for sample in sample_list]
+
+
+# The data shared by the worker processes of plot_heatmaps_batch. With the fork start method it is
+# inherited from the parent process; otherwise it is sent once to each worker by its initialiser.
+_batch_data = None
+
+
+def write_job_files(heatmap_plot, function_dict, spec, output_dir, name):
+    """
+    Function to write the LaTeX table and the exported data that a job asks for, beside its figure.
+
+    Args:
+    heatmap_plot (HeatmapPlot): The heatmap plot of the job.
+    function_dict (DataFrame): DataFrame containing the function dictionary.
+    spec (dict): The job. If 'print_table' is set, the table is written to name.tex, as a longtable if
+                 'longtable' is also set. If 'export' names a format of TableExport, the data behind the
+                 heatmap is written by HeatmapPlot.export to the directory name_data, or to name.h5 for 'hdf5'.
+    output_dir (str): The directory to write the files to.
+    name (str): The name of the job's files, without extension.
+    """
+    if spec.get('print_table'):
+        LatexTable(function_dict, spec.get('user_pathways'), heatmap_plot).write_table(
+            os.path.join(output_dir, f'{name}.tex'), longtable=spec.get('longtable', False))
+    if spec.get('export'):
+        path = os.path.join(output_dir, f'{name}.h5' if spec['export'] == 'hdf5' else f'{name}_data')
+        heatmap_plot.export(path, spec.get('threshold', 0), spec['export'], spec.get('user_pathways'),
+                            spec.get('top_n'))
+
+
+def _init_batch_worker(data):
+    import matplotlib.pyplot as plt
+
+    global _batch_data
+    if data is not None:
+        _batch_data = data
+    plt.switch_backend('Agg')  # Workers render headless
+
+
+def _render_batch_job(job):
+    """
+    Renders one plot specification of plot_heatmaps_batch and returns its timing record.
+    """
+    number, spec, output_dir, file_format = job
+    name = spec.get('name', f'heatmap_{number}')
+    file_format = spec.get('format', file_format)
+    record = {'name': name, 'path': os.path.join(output_dir, f'{name}.{file_format}'),
+              'seconds': None, 'error': None}
+    start = time.perf_counter()
+    try:
+        samples = select_samples(_batch_data['samples'], spec.get('sample_list'))
+        if spec.get('rows', 'taxa') == 'pathways':
+            heatmap_data = PathwayHeatmapData(_batch_data['all_pathways'].index, samples)
+        else:
+            heatmap_data = HeatmapData(samples)
+        heatmap_plot = HeatmapPlot(heatmap_data, _batch_data['all_pathways'], _batch_data['function_dict'],
+                                   spec.get('taxon_level'), _batch_data['search_index'],
+                                   plot_cache=_batch_data['plot_cache'])
+        figure_bytes = heatmap_plot.render(spec.get('user_pathways'), spec.get('threshold', 0),
+                                           _batch_data['taxon_dict'], file_format,
+                                           **{key: spec[key] for key in HEATMAP_PLOT_OPTIONS if key in spec})
+        with open(record['path'], 'wb') as f:
+            f.write(figure_bytes)
+
+        write_job_files(heatmap_plot, _batch_data['function_dict'], spec, output_dir, name)
+    except Exception as error:  # One failed plot should not stop the rest of the batch
+        record['error'] = f'{type(error).__name__}: {error}'
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def plot_heatmaps_batch(specs, samples, all_pathways, function_dict, taxon_dict, output_dir, file_format='png',
+                        processes=None, plot_cache=None):
+    """
+    Function to render many heatmaps to files without displaying them, using a pool of worker processes.
+
+    The workers render on matplotlib's Agg backend. The loaded data is given to each worker once, by
+    inheritance when processes are forked or otherwise when each worker starts, rather than once per plot.
+
+    Args:
+    specs (list): A list of plot specifications. Each is a dictionary which may contain 'name' (the output file name
+                  without extension), 'user_pathways', 'threshold', 'taxon_level', 'sample_list', 'rows' ('taxa' or
+                  'pathways', as for AnalysisSession.heatmap), 'format', 'print_table' (whether to also write the
+                  LaTeX table to name.tex), 'longtable' and 'export' (see write_job_files), and 'bootstrap', 'top_n',
+                  'raster' and 'max_pixels' (as for HeatmapPlot.heatmap_plot).
+    samples (list): A list of Sample objects containing every sample that a specification may select.
+    all_pathways (dict): A dictionary of all pathways.
+    function_dict (DataFrame): DataFrame containing the function dictionary.
+    taxon_dict (DataFrame): DataFrame containing the taxon dictionary.
+    output_dir (str): The directory to write the files to. It is created if it does not exist.
+    file_format (str): The default file format, e.g. 'png', 'svg' or 'pdf'. Default is 'png'.
+    processes (int, optional): The number of worker processes. Default is None, in which case the number of CPUs is
+                               used. If 1, the plots are rendered in the current process.
+    plot_cache (PlotCache, optional): A cache of clusterings and figures. Each worker has its own copy of the entries
+                                      held in memory, so with several processes only the entries written to its
+                                      cache_dir are shared between them. Default is None.
+
+    Returns:
+    list: One dictionary per specification, in order, with the 'name' and 'path' of the output file, the wall
+          time taken in 'seconds', and an 'error' message if the plot failed (otherwise None).
     """
-    # Define the file paths for the data sources
-    all_sample_data = '/content/drive/MyDrive/Pylomap/pylomap/F data.xlsx'
-    taxon_dict = '/content/drive/MyDrive/Pylomap/pylomap/Taxon Dictionary.xlsx'
-    function_dict = '/content/drive/MyDrive/Pylomap/pylomap/Function Dictionary.xlsx'
-    parent = '/content/drive/MyDrive/Pylomap/pylomap/FL Parent.csv'
+    global _batch_data
+    os.makedirs(output_dir, exist_ok=True)
+    data = {'samples': samples, 'all_pathways': all_pathways, 'function_dict': function_dict,
+            'taxon_dict': taxon_dict, 'search_index': PathwaySearchIndex(function_dict), 'plot_cache': plot_cache}
+    jobs = [(number, spec, output_dir, file_format) for number, spec in enumerate(specs)]
+
+    if processes == 1:
+        _batch_data = data
+        try:
+            return [_render_batch_job(job) for job in jobs]
+        finally:
+            _batch_data = None
 
-    # Specify which samples should be plotted. If None, all samples are plotted
-    sample_list = None
+    context = multiprocessing.get_context()
+    forked = context.get_start_method() == 'fork'
+    if forked:
+        _batch_data = data  # Inherited by the forked workers without being copied or pickled
+    try:
+        with context.Pool(processes, initializer=_init_batch_worker,
+                          initargs=(None if forked else data,)) as pool:
+            return pool.map(_render_batch_job, jobs, chunksize=1)
+    finally:
+        _batch_data = None
 
-    # Specify pathways to plot as a list OR a string to search OR None
-    # user_pathways = ['1CMET2-PWY', 'PWY-5430', 'PWY-5431']
-    user_pathways = 'sulf'
 
-    # Percentage above which is displayed on the clustermap
-    threshold = 3
+# The data files a job file must name, as the arguments of get_data
+JOB_FILE_DATA = ['all_sample_data', 'taxon_dict', 'function_dict', 'parent']
+
+
+def read_job_file(job_path):
+    """
+    Function to read a JSON or TOML job file.
+
+    The file names the data files in a 'data' table, in which 'all_sample_data' may be a list of files to merge.
+    The table may also give a 'cache_dir' for an IngestCache, a 'plot_cache_dir' for a PlotCache, a
+    'parent_max_bytes' memory cap for reading the parent file in chunks and 'parallel' to read the files at the
+    same time (see get_data). The file lists the jobs
+    in 'jobs' (a [[jobs]] array of tables in TOML). Each job may contain the keys described in
+    AnalysisSession.run_job, and any key it leaves out is taken from an optional 'defaults' table. The
+    optional top-level 'output_dir' and 'format' give where and how the figures are written. Relative paths
+    are relative to the directory of the job file.
 
-    # Specify whether a LaTeX table of the pathways should be printed
-    print_latex_table = True
+    Args:
+    job_path (str): File path for the job file. Files ending in '.toml' are read as TOML, others as JSON.
 
-    # Specify the taxon level for grouping. If None, no grouping is done. Can be 'domain', 'phylum', 'class', 'order', 'family', or 'genus'
-    taxon_level = None
+    Returns:
+    dict: The job file, with its paths made absolute and its defaults applied to every job.
 
-    # Get data from all required files
-    all_sample_data, taxon_dict, function_dict, parent = get_data(
-        all_sample_data, taxon_dict, function_dict, parent)
+    Raises:
+    ValueError: If the file does not name every data file or does not list any jobs.
+    """
+    if job_path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        with open(job_path, 'rb') as f:
+            job_file = tomllib.load(f)
+    else:
+        with open(job_path) as f:
+            job_file = json.load(f)
+
+    data = job_file.get('data', {})
+    missing = [key for key in JOB_FILE_DATA if key not in data]
+    if missing:
+        raise ValueError(f"The job file has no 'data' entry for: {', '.join(missing)}")
+    if not job_file.get('jobs'):
+        raise ValueError("The job file does not list any jobs")
+
+    # Resolve relative paths against the job file's directory rather than the working directory
+    base_dir = os.path.dirname(os.path.abspath(job_path))
+    for key in JOB_FILE_DATA + ['cache_dir', 'plot_cache_dir']:
+        if isinstance(data.get(key), list):  # Several sample data files to merge
+            data[key] = [os.path.join(base_dir, os.path.expanduser(path)) for path in data[key]]
+        elif key in data:
+            data[key] = os.path.join(base_dir, os.path.expanduser(data[key]))
+    if 'output_dir' in job_file:
+        job_file['output_dir'] = os.path.join(base_dir, os.path.expanduser(job_file['output_dir']))
+
+    defaults = job_file.get('defaults', {})
+    job_file['jobs'] = [{**defaults, **job} for job in job_file['jobs']]
+    return job_file
+
+
+def main(argv=None):
+    """
+    The main function of the script, which reads a job file, loads its data once and runs every job in it.
 
-    # Create samples and pathways
-    samples, all_pathways = create_samples_and_pathways(
-        all_sample_data, taxon_dict, parent, sample_list)
+    Args:
+    argv (list, optional): The command line arguments. Default is None, in which case sys.argv is used.
 
-    # Plot the heatmap and optionally print the LaTeX table
-    plot_heatmap(samples, all_pathways, function_dict, taxon_dict,
-                 user_pathways, print_latex_table, threshold, taxon_level)
+    Returns:
+    int: The exit status, which is 1 if any job failed and 0 otherwise.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Plot heatmaps of sample abundances and their pathways, as listed in a job file.')
+    parser.add_argument('job_file', help='a JSON or TOML file naming the data files and listing the jobs')
+    parser.add_argument('--output-dir', help="directory to write the figures and tables to, overriding the "
+                                             "job file's output_dir")
+    parser.add_argument('--format', help="default figure format, e.g. png, svg or pdf, overriding the job "
+                                         "file's format")
+    parser.add_argument('--show', action='store_true', help='display each heatmap as well')
+    parser.add_argument('--no-cache', action='store_true', help="ignore the job file's cache_dir and plot_cache_dir")
+    parser.add_argument('--log', help='file to append the timing and memory of each stage to, as JSON lines')
+    args = parser.parse_args(argv)
+
+    if args.log:
+        add_stage_hook(JsonLogHook(args.log))
+
+    job_file = read_job_file(args.job_file)
+    data = job_file['data']
+    output_dir = args.output_dir or job_file.get('output_dir')
+    if output_dir is None and not args.show:
+        output_dir = os.getcwd()
+    cache, plot_cache = None, None
+    if 'cache_dir' in data and not args.no_cache:
+        cache = IngestCache(data['cache_dir'])
+    if 'plot_cache_dir' in data and not args.no_cache:
+        plot_cache = PlotCache(cache_dir=data['plot_cache_dir'])
+
+    # Get data from all required files, once for every job
+    session = AnalysisSession(*[data[key] for key in JOB_FILE_DATA], cache=cache,
+                              parent_max_bytes=data.get('parent_max_bytes'), plot_cache=plot_cache,
+                              parallel=data.get('parallel'))
+
+    # Plot the heatmaps and optionally write the LaTeX tables
+    records = session.run_jobs(job_file['jobs'], output_dir, args.format or job_file.get('format', 'png'),
+                               args.show)
+    for record in records:
+        outcome = record['error'] or record['path'] or 'shown'
+        print(f"{record['name']}: {outcome} ({record['seconds']:.2f}s)")
+    return 1 if any(record['error'] for record in records) else 0
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
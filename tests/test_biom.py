@@ -0,0 +1,188 @@
+"""
+Tests of reading BIOM tables with ReadBiomFile, and through the sample data path of get_data.
+
+The BIOM fixtures are generated in a temporary directory: a v2.1 (HDF5) table written with h5py, and
+v1 (JSON) tables in both the sparse and the dense layout, all holding the same counts.
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylomap  # noqa: E402
+
+SAMPLES = ['S1', 'S2', 'S3']
+OBSERVATIONS = ['O1', 'O2', 'O3', 'O4']
+# O1 and O2 share a taxonomy, which is unresolved below class, and so collapse into one taxon
+TAXONOMY = [
+    ['d__Bacteria', 'p__Firmicutes', 'c__Bacilli', 'o__', 'f__', 'g__', 's__'],
+    ['d__Bacteria', 'p__Firmicutes', 'c__Bacilli', 'o__', 'f__', 'g__', 's__'],
+    ['d__Bacteria', 'p__Proteobacteria', 'c__', 'o__', 'f__', 'g__', 's__'],
+    ['d__Archaea', 'p__', 'c__', 'o__', 'f__', 'g__', 's__'],
+]
+COUNTS = np.array([[10, 0, 5], [30, 10, 0], [60, 0, 15], [0, 90, 0]], dtype=float)
+
+# The collapsed taxa and their relative abundances in S1, S2 and S3
+TAXA = ['d__Bacteria; p__Firmicutes; c__Bacilli', 'd__Bacteria; p__Proteobacteria', 'd__Archaea']
+RELATIVE = np.array([[0.4, 0.1, 0.25], [0.6, 0.0, 0.75], [0.0, 0.9, 0.0]])
+
+
+def write_hdf5_biom(path):
+    h5py = pytest.importorskip('h5py')
+    from scipy import sparse
+
+    strings = h5py.string_dtype()
+    with h5py.File(path, 'w') as f:
+        f.attrs['id'] = 'test'
+        f.attrs['type'] = 'OTU table'
+        f.attrs['format-url'] = 'http://biom-format.org'
+        f.attrs['format-version'] = (2, 1)
+        f.attrs['generated-by'] = 'test_biom'
+        f.attrs['creation-date'] = '2024-01-01T00:00:00'
+        f.attrs['shape'] = COUNTS.shape
+        f.attrs['nnz'] = np.count_nonzero(COUNTS)
+        for axis, ids, matrix in [('observation', OBSERVATIONS, sparse.csr_matrix(COUNTS)),
+                                  ('sample', SAMPLES, sparse.csr_matrix(COUNTS.T))]:
+            f.create_dataset(f'{axis}/ids', data=np.array(ids, dtype=object), dtype=strings)
+            f.create_dataset(f'{axis}/matrix/data', data=matrix.data)
+            f.create_dataset(f'{axis}/matrix/indices', data=matrix.indices)
+            f.create_dataset(f'{axis}/matrix/indptr', data=matrix.indptr)
+            f.create_group(f'{axis}/metadata')
+            f.create_group(f'{axis}/group-metadata')
+        f.create_dataset('observation/metadata/taxonomy', data=np.array(TAXONOMY, dtype=object), dtype=strings)
+    return path
+
+
+def write_json_biom(path, matrix_type='sparse', taxonomy=True):
+    if matrix_type == 'sparse':
+        rows, columns = np.nonzero(COUNTS)
+        data = [[int(row), int(column), COUNTS[row, column]] for row, column in zip(rows, columns)]
+    else:
+        data = COUNTS.tolist()
+    table = {
+        'id': 'test', 'format': 'Biological Observation Matrix 1.0.0', 'format_url': 'http://biom-format.org',
+        'type': 'OTU table', 'generated_by': 'test_biom', 'date': '2024-01-01T00:00:00',
+        'rows': [{'id': observation, 'metadata': {'taxonomy': lineage} if taxonomy else None}
+                 for observation, lineage in zip(OBSERVATIONS, TAXONOMY)],
+        'columns': [{'id': sample, 'metadata': None} for sample in SAMPLES],
+        'matrix_type': matrix_type, 'matrix_element_type': 'float', 'shape': list(COUNTS.shape), 'data': data,
+    }
+    with open(path, 'w') as f:
+        json.dump(table, f)
+    return path
+
+
+@pytest.fixture(params=['hdf5', 'json', 'json-dense'])
+def biom_path(request, tmp_path):
+    path = str(tmp_path / 'table.biom')
+    if request.param == 'hdf5':
+        return write_hdf5_biom(path)
+    return write_json_biom(path, 'dense' if request.param == 'json-dense' else 'sparse')
+
+
+def test_collapses_taxa_into_relative_abundances(biom_path):
+    matrix = pylomap.ReadBiomFile(biom_path).read()
+
+    assert matrix.taxa.tolist() == TAXA
+    assert matrix.sample_names.tolist() == SAMPLES
+    np.testing.assert_allclose(matrix.values.toarray(), RELATIVE)
+    # Each sample's relative abundances sum to one
+    np.testing.assert_allclose(matrix.values.sum(axis=0), 1)
+    assert matrix.taxonomy.ranks['phylum'].tolist()[:2] == ['p__Firmicutes', 'p__Proteobacteria']
+    assert matrix.taxonomy.ranks['order'].isna().all()
+
+
+def test_reads_counts_without_collapsing(biom_path):
+    matrix = pylomap.ReadBiomFile(biom_path).read(relative=False, collapse=False)
+
+    assert matrix.taxon_ids.tolist() == OBSERVATIONS
+    np.testing.assert_allclose(matrix.values.toarray(), COUNTS)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1000])
+def test_reads_only_the_requested_samples(biom_path, chunk_size):
+    matrix = pylomap.ReadBiomFile(biom_path).read(['S3', 'S1'], chunk_size=chunk_size)
+
+    assert matrix.sample_names.tolist() == ['S3', 'S1']
+    np.testing.assert_allclose(matrix.values.toarray(), RELATIVE[:, [2, 0]])
+
+
+def test_missing_sample_raises(biom_path):
+    with pytest.raises(ValueError, match='No data found for sample: S9'):
+        pylomap.ReadBiomFile(biom_path).read(['S1', 'S9'])
+
+
+def test_table_without_taxonomy_uses_observation_ids(tmp_path):
+    path = write_json_biom(str(tmp_path / 'table.biom'), taxonomy=False)
+    data = pylomap.ReadBiomFile(path).read_sample_data()
+
+    assert data['Taxon'].tolist() == OBSERVATIONS
+    np.testing.assert_allclose(data[SAMPLES].to_numpy(), COUNTS / COUNTS.sum(axis=0))
+
+
+def test_read_all_sample_data_reads_biom_tables(biom_path):
+    data = pylomap.ReadDataFiles(biom_path, None, None, None).read_all_sample_data()
+
+    assert data.columns.tolist() == ['Taxon'] + SAMPLES
+    assert list(data.index.names) == pylomap.TAXON_RANKS
+    assert data['Taxon'].tolist() == TAXA
+    np.testing.assert_allclose(data[SAMPLES].to_numpy(), RELATIVE)
+
+
+def test_read_all_sample_data_applies_the_query(biom_path):
+    # Samples that are not in the table are left out, as they are from an Excel file
+    query = pylomap.HeatmapQuery(sample_list=['S2', 'S9'], threshold=50)
+    data = pylomap.ReadDataFiles(biom_path, None, None, None).read_all_sample_data(query=query)
+
+    assert data.columns.tolist() == ['Taxon', 'S2']
+    assert data['Taxon'].tolist() == ['d__Archaea']
+
+
+def test_get_data_and_session_accept_biom_tables(biom_path, tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+
+    def write_sheet(path, rows):
+        workbook = openpyxl.Workbook()
+        for row in rows:
+            workbook.active.append(row)
+        workbook.save(path)
+        return path
+
+    taxon_dict = write_sheet(str(tmp_path / 'Taxon Dictionary.xlsx'),
+                             [['Taxon dictionary'], [], ['Taxon ID', 'Taxon']] +
+                             [[1000 + i, taxon] for i, taxon in enumerate(TAXA)])
+    function_dict = write_sheet(str(tmp_path / 'Function Dictionary.xlsx'),
+                                [['Function dictionary'], ['Pathway', 'Pathway description'],
+                                 ['PWY-1', 'sulfur oxidation']])
+    parent = str(tmp_path / 'FL Parent.csv')
+    pd.DataFrame({'Pathway': ['PWY-1', 'PWY-1'], 'Taxon ID': [1000, 1002]}).to_csv(parent)
+
+    all_sample_data, taxon_dict_data, _, parent_data = pylomap.get_data(biom_path, taxon_dict, function_dict, parent)
+    samples, all_pathways = pylomap.create_samples_and_pathways(all_sample_data, taxon_dict_data, parent_data,
+                                                                ['S1', 'S3'])
+    assert [sample.sample_name for sample in samples] == ['S1', 'S3']
+    np.testing.assert_allclose(samples[1].abundances, RELATIVE[:, 2])
+    assert samples[0].matrix.taxon_ids.tolist() == [1000, 1001, 1002]
+    assert sorted(all_pathways['PWY-1']) == [1000, 1002]
+
+    session = pylomap.AnalysisSession(biom_path, taxon_dict, function_dict, parent)
+    heatmap_data = session.heatmap().heatmap_data
+    assert heatmap_data['Taxa'].tolist() == TAXA
+    np.testing.assert_allclose(heatmap_data[SAMPLES].to_numpy(), RELATIVE)
+
+
+def test_read_is_measured_as_a_stage(biom_path):
+    records = []
+    pylomap.add_stage_hook(records.append)
+    try:
+        pylomap.ReadBiomFile(biom_path).read_sample_data()
+    finally:
+        pylomap.remove_stage_hook(records.append)
+
+    rows = {record['stage']: record['rows'] for record in records}
+    assert rows == {'read_biom': len(TAXA), 'read_biom_sample_data': len(TAXA)}
@@ -0,0 +1,148 @@
+"""
+Tests of the stage records passed to the hooks registered with add_stage_hook, and of their peak memory when
+stages run at the same time in several threads.
+"""
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pylomap  # noqa: E402
+
+# Large enough to stand out from the memory of the rest of the test process. A peak is only expected to grow by
+# most of it, as the peak before the allocation may be above the memory in use when it is made.
+ALLOCATION_BYTES = 200 * 1024 ** 2
+EXPECTED_GROWTH = 0.9 * ALLOCATION_BYTES
+
+
+def allocate():
+    # Touch every page, so that the allocation counts towards the resident set size
+    data = np.ones(ALLOCATION_BYTES // 8)
+    return float(data[-1])
+
+
+@pytest.fixture
+def records():
+    records = []
+    pylomap.add_stage_hook(records.append)
+    yield records
+    pylomap.remove_stage_hook(records.append)
+
+
+def run_stage(name):
+    with pylomap.stage(name):
+        pass
+
+
+def peaks(records, name):
+    return [record['peak_rss_bytes'] for record in records if record['stage'] == name]
+
+
+def test_stage_started_on_another_thread_keeps_the_earlier_peak(records):
+    if pylomap._read_peak_rss() is None:
+        pytest.skip('peak resident set size is not available')
+    with pylomap.stage('outer'):
+        before = pylomap._read_peak_rss()
+        allocate()
+
+        # A stage starting on another thread must not lose the peak the outer stage has reached
+        thread = threading.Thread(target=run_stage, args=('inner',))
+        thread.start()
+        thread.join()
+
+    assert peaks(records, 'outer')[0] >= before + EXPECTED_GROWTH
+    assert not pylomap._open_stages
+
+
+def test_stages_on_other_threads_report_at_least_their_own_peak(records):
+    if pylomap._read_peak_rss() is None:
+        pytest.skip('peak resident set size is not available')
+    started, release = threading.Barrier(2), threading.Event()
+
+    def worker():
+        with pylomap.stage('worker'):
+            started.wait()
+            release.wait()
+
+    with pylomap.stage('outer'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        started.wait()
+        # The main thread's nested stage runs while the worker's is open, and allocates within it
+        with pylomap.stage('nested'):
+            before = pylomap._read_peak_rss()
+            allocate()
+        release.set()
+        thread.join()
+
+    for name in ['outer', 'nested', 'worker']:
+        assert peaks(records, name)[0] >= before + EXPECTED_GROWTH, name
+
+
+@pytest.fixture
+def data_files(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+
+    def write_sheet(path, rows):
+        workbook = openpyxl.Workbook()
+        for row in rows:
+            workbook.active.append(row)
+        workbook.save(path)
+        return path
+
+    # A BIOM (JSON) table stands in for the sample data file
+    all_sample_data = str(tmp_path / 'table.biom')
+    with open(all_sample_data, 'w') as f:
+        json.dump({'rows': [{'id': 'O1', 'metadata': {'taxonomy': ['d__Bacteria', 'p__Firmicutes']}},
+                            {'id': 'O2', 'metadata': {'taxonomy': ['d__Archaea']}}],
+                   'columns': [{'id': 'S1', 'metadata': None}, {'id': 'S2', 'metadata': None}],
+                   'matrix_type': 'dense', 'shape': [2, 2], 'data': [[3, 1], [1, 1]]}, f)
+    taxon_dict = write_sheet(str(tmp_path / 'Taxon Dictionary.xlsx'),
+                             [['Taxon dictionary'], [], ['Taxon ID', 'Taxon'],
+                              [1000, 'd__Bacteria; p__Firmicutes'], [1001, 'd__Archaea']])
+    function_dict = write_sheet(str(tmp_path / 'Function Dictionary.xlsx'),
+                                [['Function dictionary'], ['Pathway', 'Pathway description'],
+                                 ['PWY-1', 'sulfur oxidation']])
+    parent = str(tmp_path / 'FL Parent.csv')
+    pd.DataFrame({'Pathway': ['PWY-1'], 'Taxon ID': [1000]}).to_csv(parent)
+    return all_sample_data, taxon_dict, function_dict, parent
+
+
+def test_get_data_reports_the_same_peak_when_reading_in_threads(records, data_files, monkeypatch):
+    if pylomap._read_peak_rss() is None:
+        pytest.skip('peak resident set size is not available')
+    read_taxon_dict, read_parent = pylomap.ReadDataFiles.read_taxon_dict.__wrapped__, pylomap.ReadDataFiles.read_parent
+    allocated = threading.Event()
+
+    @pylomap.staged('read_taxon_dict', rows=len)
+    def allocating_read_taxon_dict(self):
+        allocate()
+        allocated.set()
+        return read_taxon_dict(self)
+
+    def waiting_read_parent(self):
+        # Start the read_parent stage only once the taxon dictionary's peak has been reached, as it would on
+        # larger files
+        allocated.wait()
+        return read_parent(self)
+
+    monkeypatch.setattr(pylomap.ReadDataFiles, 'read_taxon_dict', allocating_read_taxon_dict)
+    monkeypatch.setattr(pylomap.ReadDataFiles, 'read_parent', waiting_read_parent)
+
+    get_data_peaks = {}
+    for parallel in [None, 'threads']:
+        del records[:]
+        allocated.clear()
+        pylomap.get_data(*data_files, parallel=parallel)
+        get_data_peaks[parallel] = peaks(records, 'get_data')[0]
+        # get_data encloses every reader, so its peak is at least theirs, including the allocation
+        assert get_data_peaks[parallel] >= max(record['peak_rss_bytes'] for record in records), parallel
+        assert get_data_peaks[parallel] >= peaks(records, 'read_taxon_dict')[0], parallel
+
+    assert get_data_peaks['threads'] >= get_data_peaks[None] - (ALLOCATION_BYTES - EXPECTED_GROWTH)